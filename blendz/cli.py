@@ -0,0 +1,91 @@
+'''
+Command line interface for running blendz in batch jobs, installed as the
+``blendz`` command (and also runnable as ``python -m blendz.cli``).
+
+The run command samples the galaxies of one shard of the catalogue, i.e., every
+n-th galaxy starting from galaxy i for ``--shard i/n``, and saves the result as a
+Photoz save file, e.g., for shard 3 of 100 in an array job,
+
+blendz run data.txt.config run.config --components 1 2 --seed 42 --shard 3/100 --output photoz_3.pkl
+
+and the merge command combines the saved shards into a single save file,
+
+blendz merge photoz_all.pkl photoz_*.pkl
+
+which can be loaded with ``blendz.Photoz(load_state_path='photoz_all.pkl')``.
+'''
+from builtins import *
+import argparse
+import blendz
+from blendz import Configuration, Photoz
+
+
+def parseShard(shard):
+    '''Return the (index, number of shards) of shard, given as "i/n".'''
+    try:
+        index, num_shards = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard should be given as i/n, but got "{}"'.format(shard))
+    if not (0 <= index < num_shards):
+        raise argparse.ArgumentTypeError('shard index should be from 0 to n-1, but got "{}"'.format(shard))
+    return index, num_shards
+
+def shardGalaxies(num_galaxies, index, num_shards):
+    '''Return the indices of the galaxies in shard index of num_shards.'''
+    return list(range(num_galaxies))[index::num_shards]
+
+def run(args):
+    pz = Photoz(config=Configuration(config_path=args.config))
+    galaxies = shardGalaxies(pz.num_galaxies, *args.shard)
+    pz.sample(args.components, galaxy=galaxies, nresample=args.nresample,
+              seed=False if args.seed is None else args.seed, npoints=args.npoints,
+              save_path=args.output, save_interval=args.save_interval, workers=args.workers,
+              use_pymultinest=args.sampler == 'multinest')
+
+def merge(args):
+    pz = Photoz(load_state_path=args.shards[0])
+    for shard_path in args.shards[1:]:
+        pz.mergeSamples(Photoz(load_state_path=shard_path))
+    pz.saveState(args.output)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='blendz', description='Bayesian photometric redshifts of blended sources.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='Sample the posterior of every galaxy in a shard of the catalogue.')
+    run_parser.add_argument('config', nargs='+', help='Configuration files, with later files taking precedence.')
+    run_parser.add_argument('--components', type=int, nargs='+', default=[1, 2],
+                            help='Numbers of components to sample (default 1 2).')
+    run_parser.add_argument('--output', required=True, help='Path to save the Photoz object of the shard to.')
+    run_parser.add_argument('--shard', type=parseShard, default=(0, 1),
+                            help='Sample every n-th galaxy, starting from galaxy i, given as i/n (default 0/1).')
+    run_parser.add_argument('--npoints', type=int, default=150, help='Number of live points (default 150).')
+    run_parser.add_argument('--nresample', type=int, default=1000,
+                            help='Number of equally weighted samples to keep (default 1000).')
+    run_parser.add_argument('--sampler', choices=['nestle', 'multinest'], default='nestle',
+                            help='Nested sampler (default nestle). MultiNest writes to ./chains/, so '
+                                 + 'shards using it must each run in their own working directory.')
+    run_parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed for nestle, so that results are reproducible (default unseeded).')
+    run_parser.add_argument('--workers', type=int, default=1, help='Number of processes (default 1).')
+    run_parser.add_argument('--save-interval', type=int, default=None, dest='save_interval',
+                            help='Also save after every this many galaxies of the shard are sampled.')
+    run_parser.set_defaults(func=run)
+
+    merge_parser = subparsers.add_parser('merge', help='Merge the Photoz objects saved by run into one.')
+    merge_parser.add_argument('output', help='Path to save the merged Photoz object to.')
+    merge_parser.add_argument('shards', nargs='+', help='Photoz objects saved by run.')
+    merge_parser.set_defaults(func=merge)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run' and args.sampler == 'multinest':
+        if args.seed is not None:
+            parser.error('--seed only applies to the nestle sampler')
+        if args.workers != 1:
+            parser.error('--workers only applies to the nestle sampler')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ except ImportError:
     import configparser as ConfigParser
 import numpy as np
 import blendz
+from blendz import packs
 
 class DefaultConfiguration(object):
     def __init__(self):
@@ -38,7 +39,10 @@ class DefaultConfiguration(object):
         configuration files.
         '''
         if key in self.kwargs:
-            return typeFn(self.kwargs[key])
+            if self.kwargs[key] is None:
+                return None
+            else:
+                return typeFn(self.kwargs[key])
         #Put special behaviour for if typeFn is bool, as bool() on any
         #non-empty string returns True, even if that string is "False"
         elif typeFn==bool:
@@ -95,6 +99,21 @@ class DefaultConfiguration(object):
         except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
             pass
 
+        try:
+            self.z_interpolation = self.maybeGet('Run', 'z_interpolation', str)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            pass
+
+        try:
+            self.response_engine = self.maybeGet('Run', 'response_engine', str)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            pass
+
+        try:
+            self.prior_norm_method = self.maybeGet('Run', 'prior_norm_method', str)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            pass
+
         try:
             self.sort_redshifts = self.maybeGet('Run', 'sort_redshifts', bool)
         except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
@@ -155,6 +174,71 @@ class DefaultConfiguration(object):
         except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
             pass
 
+        #Largest error allowed in the log-prior when it is looked up in a table,
+        #None to calculate it exactly
+        try:
+            self.prior_table_tolerance = self.maybeGet('Run', 'prior_table_tolerance', float)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.prior_table_tolerance = None
+
+        #Whether to interpolate the correlation function from a table on the redshift grid
+        try:
+            self.correlation_table = self.maybeGet('Run', 'correlation_table', bool)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.correlation_table = False
+
+        #Largest estimated error in the log prior normalisation from quadrature
+        #before falling back to nested sampling
+        try:
+            self.prior_norm_tolerance = self.maybeGet('Run', 'prior_norm_tolerance', float)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.prior_norm_tolerance = 0.01
+
+        #File to save prior normalisations to and load them from, None to only
+        #keep them in memory
+        try:
+            self.prior_norm_cache_path = self.maybeGet('Run', 'prior_norm_cache_path', str)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.prior_norm_cache_path = None
+
+        #Whether to interpolate prior normalisations from a table over the galaxies
+        try:
+            self.prior_norm_table = self.maybeGet('Run', 'prior_norm_table', bool)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.prior_norm_table = False
+
+        #Folder to cache response tables in, so they are only calculated once
+        #for each set of templates, filters and redshift grid. None to disable.
+        try:
+            self.response_cache_path = self.maybeGet('Run', 'response_cache_path', str)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.response_cache_path = None
+
+        #Number of processes used to calculate response tables
+        try:
+            self.response_workers = self.maybeGet('Run', 'response_workers', int)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.response_workers = 1
+
+        #Whether to store response tables in single precision to save memory
+        try:
+            self.compact_responses = self.maybeGet('Run', 'compact_responses', bool)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.compact_responses = False
+
+        #Galaxies in each chunk of a work queue (see Photoz.sample's queue_path)
+        try:
+            self.queue_galaxies_per_chunk = self.maybeGet('Run', 'queue_galaxies_per_chunk', int)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.queue_galaxies_per_chunk = 10
+
+        #Seconds since a claim on a chunk of a work queue was last renewed
+        #before other processes may take it over
+        try:
+            self.queue_lease_timeout = self.maybeGet('Run', 'queue_lease_timeout', float)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.queue_lease_timeout = 3600.
+
         # _prior_params is either an array of parameters,
         # or np.nan for when we want to do calibration (allow overwrite)
         try:
@@ -253,6 +337,13 @@ class DefaultConfiguration(object):
         except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
             pass
 
+        #Fractional L1 error allowed when reducing the number of points in
+        #each filter curve, None to use the curves as they are
+        try:
+            self.filter_tolerance = self.maybeGet('Data', 'filter_tolerance', float)
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            self.filter_tolerance = None
+
         try:
             self.zero_point_errors = np.array(self.maybeGetList('Data', 'zero_point_errors', float))
         except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
@@ -361,15 +452,16 @@ class DefaultConfiguration(object):
             recalc = True
         if recalc:
             #Use the path and name of the template set to load in the templates
-            #if we need to do it again (because one of those has changed)
-            template_config = ConfigParser.SafeConfigParser()
-            template_config.read(join(self.template_set_path, self.template_set))
-            self._template_dict = {}
-            for i, template_name in enumerate(template_config.sections()):
-                rel_path_t = template_config.get(template_name, 'path')
-                abs_path_t = join(self.template_set_path, rel_path_t)
-                type_t = template_config.get(template_name, 'type')
-                self._template_dict[i] = {'name':template_name, 'path':abs_path_t, 'type':type_t}
+            #if we need to do it again (because one of those has changed),
+            #reading them from a binary pack of the template set if there is an up to date one
+            pack_path = packs.currentPack(packs.templatePackPath(self.template_set_path, self.template_set),
+                                          self.template_set_path)
+            if pack_path is not None:
+                template_info = packs.readTemplatePack(pack_path, self.template_set_path,
+                                                       load_curves=False)
+            else:
+                template_info = packs.readTemplateSet(self.template_set_path, self.template_set)
+            self._template_dict = dict(enumerate(template_info))
             #Mark as not needing recalculating (unless of the properties changes)
             self.recalculate_template_dict = False
         return self._template_dict
@@ -1,7 +1,8 @@
 from builtins import *
-from os.path import join
+from os.path import join, dirname, basename
 import numpy as np
 from blendz import Configuration
+from blendz import packs
 
 class Filters(object):
     """Definitions of the photometric filter bands observations have been made with.
@@ -17,6 +18,11 @@ class Filters(object):
         type: Description of returned object.
 
     """
+    #Widest gap (in Angstroms) between the points kept when reducing filter
+    #curves, so that templates are still sampled finely enough when calculating
+    #responses. This matches the sampling of the included BPZ templates.
+    max_reduced_step = 4.
+
     def __init__(self, config=None, **kwargs):
         self.config = Configuration(**kwargs)
         if config is not None:
@@ -37,18 +43,44 @@ class Filters(object):
         if filepath is None:
             filepath = self.filter_path
 
+        #Binary packs of each folder of filters, None if a folder has no pack
+        filter_packs = {}
         for F in range(len(filenames)):
-            #Read from file
+            #Read from the pack of the filter's folder if it has one, otherwise from file
+            filter_file = join(filepath, filenames[F])
+            filter_folder = dirname(filter_file)
+            if filter_folder not in filter_packs:
+                pack_path = packs.currentPack(packs.filterPackPath(filter_folder), filter_folder)
+                filter_packs[filter_folder] = packs.readFilterPack(pack_path) if pack_path is not None else None
             self._all_filters[F] = {}
-            self._all_filters[F]['lambda'], self._all_filters[F]['response'] = \
-                    np.loadtxt(join(filepath, filenames[F]), unpack=True)
+            if filter_packs[filter_folder] is not None and basename(filter_file) in filter_packs[filter_folder]:
+                self._all_filters[F]['lambda'], self._all_filters[F]['response'] = \
+                        filter_packs[filter_folder][basename(filter_file)]
+            else:
+                self._all_filters[F]['lambda'], self._all_filters[F]['response'] = \
+                        np.loadtxt(filter_file, unpack=True)
             flt_order = np.argsort(self._all_filters[F]['lambda'])
             self._all_filters[F]['lambda'] = self._all_filters[F]['lambda'][flt_order]
             self._all_filters[F]['response'] = self._all_filters[F]['response'][flt_order]
+            #Optionally reduce the number of points in the curve
+            self._all_filters[F]['original_len'] = len(self._all_filters[F]['lambda'])
+            if self.config.filter_tolerance is not None:
+                keep = reduceCurve(self._all_filters[F]['lambda'], self._all_filters[F]['response'],
+                                   self.config.filter_tolerance, max_step=self.max_reduced_step)
+                self._all_filters[F]['lambda'] = self._all_filters[F]['lambda'][keep]
+                self._all_filters[F]['response'] = self._all_filters[F]['response'][keep]
             #Calculate normalisation
             self._all_filters[F]['norm'] = np.trapz(self._all_filters[F]['response'] / self._all_filters[F]['lambda'],\
                                             x = self._all_filters[F]['lambda'])
 
+    def reduction(self):
+        '''
+        Return a list of the number of points in each filter curve as loaded, and
+        after reducing them (the same if filter_tolerance is None).
+        '''
+        return [(self._all_filters[F]['original_len'], len(self._all_filters[F]['lambda']))
+                for F in range(self.num_filters)]
+
     def wavelength(self, F):
         try:
             return self._all_filters[F]['lambda']
@@ -66,3 +98,52 @@ class Filters(object):
             return self._all_filters[F]['norm']
         except (KeyError, TypeError):
             raise ValueError('Filter may be an integer [0...{}], but got a {} of value {} instead'.format(self.num_filters-1, type(F), F))
+
+
+def reduceCurve(wavelength, response, tolerance, max_step=np.inf):
+    '''
+    Return the sorted indices of a subset of the points of a curve such that
+    linearly interpolating between them changes the curve by at most a fraction
+    tolerance of its integral, in the L1 sense
+
+    int |reduced(lambda) - response(lambda)| dlambda <= tolerance * int |response(lambda)| dlambda
+
+    which bounds the change in the integral of the curve against any function by
+    that fraction of the largest value of the function over the curve, and such
+    that no two neighbouring points are more than max_step apart.
+
+    Segments are split Ramer-Douglas-Peucker style at the point furthest from the
+    straight line between their ends, until the L1 error of every segment is
+    within its share (in proportion to its width) of the total allowed error.
+    Segments wider than max_step are then split at their middle.
+
+    Responses are calculated by sampling the templates at the points of the
+    filter curve, so max_step should be small enough that this resolves the
+    templates; otherwise the responses change by more than tolerance.
+    '''
+    lambda_step = np.diff(wavelength)
+    allowed_per_width = tolerance * np.sum(0.5 * lambda_step * np.abs(response[1:] + response[:-1])) / \
+                        (wavelength[-1] - wavelength[0])
+    keep = np.zeros(len(wavelength), dtype=bool)
+    keep[[0, -1]] = True
+    segments = [(0, len(wavelength) - 1)]
+    while len(segments) > 0:
+        lo, hi = segments.pop()
+        if hi - lo < 2:
+            continue
+        inside = slice(lo, hi + 1)
+        line = response[lo] + (response[hi] - response[lo]) * \
+               (wavelength[inside] - wavelength[lo]) / (wavelength[hi] - wavelength[lo])
+        deviation = np.abs(response[inside] - line)
+        error = np.sum(0.5 * lambda_step[lo:hi] * (deviation[1:] + deviation[:-1]))
+        if error > allowed_per_width * (wavelength[hi] - wavelength[lo]):
+            split = lo + np.argmax(deviation)
+        elif wavelength[hi] - wavelength[lo] > max_step:
+            split = np.searchsorted(wavelength, 0.5 * (wavelength[lo] + wavelength[hi]))
+            split = min(max(split, lo + 1), hi - 1)
+        else:
+            continue
+        keep[split] = True
+        segments.append((lo, split))
+        segments.append((split, hi))
+    return np.flatnonzero(keep)
@@ -0,0 +1,65 @@
+'''
+Build the response tables included with blendz, which Responses loads instead of
+calculating the responses whenever the templates, filters and redshift grid
+match exactly.
+
+Each folder of included filters has one table, ``resources/responses/<folder>.npz``,
+of the response of every included template to every filter in that folder on
+the default redshift grid. Templates, filters and the redshift grid are
+identified in the table by a hash of their curves rather than by name, so a
+prebuilt response is only used when it was calculated from exactly the same
+inputs by the same version of the response calculation. The tables are
+rebuilt with
+
+python -m blendz.fluxes.prebuilt
+
+or ``python setup.py build_responses``, which need running whenever the
+included templates or filters, the default redshift grid or
+RESPONSE_CACHE_VERSION change.
+'''
+from builtins import *
+import os
+from os.path import join, isfile
+import numpy as np
+import blendz
+from blendz.fluxes import Responses
+
+class _UnbuiltResponses(Responses):
+    #Calculate the responses from scratch rather than loading existing tables
+    prebuilt_path = None
+
+def buildPrebuiltResponses(prebuilt_path=Responses.prebuilt_path, template_set='BPZ8', **kwargs):
+    '''
+    Calculate and save the response of every template in template_set to every
+    filter in each folder of filter_path, on the redshift grid of the default
+    configuration (updated by kwargs), returning the paths of the tables.
+    '''
+    if not os.path.exists(prebuilt_path):
+        os.makedirs(prebuilt_path)
+    filter_path = blendz.config.Configuration(**kwargs).filter_path
+    table_paths = []
+    for folder in sorted(os.listdir(filter_path)):
+        folder_path = join(filter_path, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        filter_names = [join(folder, name) for name in sorted(os.listdir(folder_path))
+                        if isfile(join(folder_path, name)) and not name.endswith('.npz')
+                        and not name.startswith('.')]
+        if len(filter_names) == 0:
+            continue
+        config = blendz.config.Configuration(template_set=template_set, filters=filter_names,
+                                             compact_responses=False, **kwargs)
+        responses = _UnbuiltResponses(config=config)
+        grid_key, template_keys, filter_keys = responses._prebuilt_keys()
+        table_path = join(prebuilt_path, folder + '.npz')
+        np.savez_compressed(table_path, grid_key=np.array(grid_key),
+                            template_keys=np.array(template_keys),
+                            filter_keys=np.array(filter_keys),
+                            responses=responses._all_responses)
+        table_paths.append(table_path)
+    return table_paths
+
+
+if __name__ == '__main__':
+    for table_path in buildPrebuiltResponses():
+        print(table_path)
@@ -1,13 +1,32 @@
 from builtins import *
+import os
 import warnings
+import hashlib
+from os.path import join
+from multiprocessing import Pool
 import numpy as np
 from tqdm import tqdm
-from scipy.interpolate import interp1d
+from scipy.fftpack import next_fast_len
+import blendz
 from blendz import Configuration
 from blendz.fluxes import Templates
 from blendz.fluxes import Filters
+from blendz.fluxes.interpolation import UniformGridInterpolator, UniformGridSplineInterpolator
+
+#Change this whenever the way responses are calculated changes, so that
+#tables cached by older versions are not reused
+RESPONSE_CACHE_VERSION = '1'
 
 class Responses(object):
+    #Upper limit in bytes on the (N_redshift, N_lambda) arrays built
+    #for each filter when calculating the responses
+    chunk_bytes = 2**24
+    #Folder of prebuilt response tables (see blendz.fluxes.prebuilt), None to
+    #always calculate the responses
+    prebuilt_path = join(blendz.RESOURCE_PATH, 'responses')
+    #Spacing of the log-wavelength grid used by the fft response_engine
+    log_lambda_step = 1e-4
+
     def __init__(self, templates=None, filters=None, config=None, **kwargs):
         #Warn user is config and either/or templates given that config ignored
         if ((templates is not None and config is not None) or
@@ -45,29 +64,359 @@ class Responses(object):
             self.filters = Filters(config=self.config)
 
         self.zGrid = self.config.redshift_grid
-        self._calculate_responses()
-        self._calculate_interpolators()
+        #In compact mode, the table is stored in single precision, halving its
+        #size. Responses are still calculated (and interpolated) in double
+        #precision and only rounded when stored, so every stored value is within
+        #a relative 2**-24 (6e-8) of the double precision value, and interpolated
+        #values are within 6e-8 of the largest neighbouring grid value.
+        self._response_dtype = np.float32 if self.config.compact_responses else np.float64
+        if self.config.response_cache_path is None:
+            self._calculate_responses()
+        else:
+            self._load_or_calculate_responses(self.config.response_cache_path)
+        self.interp = self._make_interpolator(self._all_responses)
+        #Interpolators for each template-filter pair are only built if used
+        self._pair_interpolators = None
+
+    def _make_interpolator(self, table):
+        '''
+        Return the interpolator over the redshift grid set by the z_interpolation
+        setting. Linear interpolation uses the table in place, so a memory-mapped
+        table stays shared.
+        '''
+        if self.config.z_interpolation == 'linear':
+            return UniformGridInterpolator(self.zGrid[0], self.zGrid[-1], table)
+        elif self.config.z_interpolation == 'cubic':
+            return UniformGridSplineInterpolator(self.zGrid[0], self.zGrid[-1], table)
+        else:
+            raise ValueError('z_interpolation may be either "linear" or "cubic", '
+                             + 'but got {} instead.'.format(self.config.z_interpolation))
+
+    def interpolation_error(self, q=100.):
+        '''
+        Return the error of the redshift interpolation of the responses.
+
+        The responses are calculated exactly at the midpoint of every cell of the
+        redshift grid, where interpolation is least accurate, and compared to the
+        interpolated values. Each difference is divided by the largest response of
+        that template-filter pair, and the q-th percentile of these fractional
+        errors is returned (by default the largest). Comparing this for different
+        z_len and z_interpolation settings shows the accuracy given up for a
+        smaller (faster to build, smaller to store) response table.
+
+        Responses have kinks where sharp template features cross a filter edge,
+        which limit the largest error of both linear and cubic interpolation,
+        so the median (q=50) error is a better guide to the typical gain.
+        '''
+        midpoints = 0.5 * (self.zGrid[1:] + self.zGrid[:-1])
+        template_curves = [(self.templates.wavelength(T), self.templates.flux(T))
+                           for T in range(self.templates.num_templates)]
+        exact = np.zeros((self.templates.num_templates, self.filters.num_filters, len(midpoints)))
+        for F in range(self.filters.num_filters):
+            exact[:, F, :] = _filterResponses(self.filters.wavelength(F),
+                                              self.filters.response(F),
+                                              self.filters.norm(F),
+                                              template_curves, midpoints,
+                                              chunk_bytes=self.chunk_bytes)
+        scale = np.max(np.abs(self._all_responses), axis=-1)
+        nonzero = scale > 0.
+        frac_error = np.abs(self.interp(midpoints) - exact)[nonzero] / scale[nonzero][:, np.newaxis]
+        return np.percentile(frac_error, q)
+
+    @property
+    def _interpolators(self):
+        if self._pair_interpolators is None:
+            self._calculate_interpolators()
+        return self._pair_interpolators
 
     def _calculate_interpolators(self):
-        self._interpolators = {}
+        '''
+        Build an interpolator for each template-filter pair, each working on a
+        view of the full table rather than a copy.
+        '''
+        self._pair_interpolators = {}
         for T in range(self.templates.num_templates):
-            self._interpolators[T] = {}
+            self._pair_interpolators[T] = {}
             for F in range(self.filters.num_filters):
-                self._interpolators[T][F] = interp1d(self.zGrid, self._all_responses[T, F, :],\
-                                                     bounds_error=False, fill_value=0.)
+                self._pair_interpolators[T][F] = self._make_interpolator(self._all_responses[T, F, :])
+
+    def _response_cache_key(self):
+        '''
+        Return a hash of everything the response table depends on: the template
+        and filter curves (after loading and sorting) and the redshift grid.
+        '''
+        hasher = hashlib.sha1()
+        hasher.update(RESPONSE_CACHE_VERSION.encode('utf-8'))
+        hasher.update(np.dtype(self._response_dtype).str.encode('utf-8'))
+        if self.config.response_engine != 'direct':
+            hasher.update('{}{!r}'.format(self.config.response_engine, self.log_lambda_step).encode('utf-8'))
+        curves = [self.templates.wavelength(T) for T in range(self.templates.num_templates)] + \
+                 [self.templates.flux(T) for T in range(self.templates.num_templates)] + \
+                 [self.filters.wavelength(F) for F in range(self.filters.num_filters)] + \
+                 [self.filters.response(F) for F in range(self.filters.num_filters)] + \
+                 [self.zGrid]
+        for curve in curves:
+            curve = np.ascontiguousarray(curve, dtype=np.float64)
+            #Include the length so curves can't run into each other
+            hasher.update(str(len(curve)).encode('utf-8'))
+            hasher.update(curve.tobytes())
+        return hasher.hexdigest()
+
+    def _load_or_calculate_responses(self, cache_path):
+        '''
+        Memory-map the response table from the cache folder cache_path if it has
+        already been calculated, otherwise calculate it and save it there first.
+        Every process using the same table then shares one copy in memory.
+        '''
+        table_shape = (self.templates.num_templates, self.filters.num_filters, len(self.zGrid))
+        table_path = os.path.join(cache_path, 'responses_{}.npy'.format(self._response_cache_key()))
+        if os.path.exists(table_path):
+            try:
+                self._all_responses = np.load(table_path, mmap_mode='r')
+                if np.shape(self._all_responses) == table_shape:
+                    return
+            except (IOError, ValueError):
+                pass
+            warnings.warn('Cached response table {} could not be read, '.format(table_path)
+                          + 'so it will be recalculated.')
+
+        self._calculate_responses()
+        try:
+            if not os.path.exists(cache_path):
+                os.makedirs(cache_path)
+            #Write to a temporary file first and rename, so that other processes
+            #never read a partially written table
+            tmp_path = '{}.{}.tmp'.format(table_path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as tmp_file:
+                    np.save(tmp_file, self._all_responses)
+                os.rename(tmp_path, table_path)
+            finally:
+                #Don't leave a partial table behind if writing it failed, e.g., disk full
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        except (IOError, OSError):
+            warnings.warn('Could not save response table to cache folder {}.'.format(cache_path))
+        else:
+            self._all_responses = np.load(table_path, mmap_mode='r')
+
+    def _prebuilt_keys(self):
+        '''
+        Return the keys identifying the redshift grid (and version of the response
+        calculation), each template and each filter in prebuilt response tables.
+        '''
+        grid_key = '{}-{}'.format(RESPONSE_CACHE_VERSION, _curveKey(self.zGrid))
+        template_keys = [_curveKey(self.templates.wavelength(T), self.templates.flux(T))
+                         for T in range(self.templates.num_templates)]
+        filter_keys = [_curveKey(self.filters.wavelength(F), self.filters.response(F))
+                       for F in range(self.filters.num_filters)]
+        return grid_key, template_keys, filter_keys
+
+    def _load_prebuilt_responses(self):
+        '''
+        Copy the responses of every filter found, along with all of the templates,
+        in a prebuilt table into _all_responses, returning the indices of the
+        filters that were not found, which still need calculating.
+        '''
+        filters_left = list(range(self.filters.num_filters))
+        if self.prebuilt_path is None or not os.path.isdir(self.prebuilt_path):
+            return filters_left
+        grid_key, template_keys, filter_keys = self._prebuilt_keys()
+        for table_name in sorted(os.listdir(self.prebuilt_path)):
+            if len(filters_left) == 0 or not table_name.endswith('.npz'):
+                continue
+            with np.load(join(self.prebuilt_path, table_name)) as table:
+                if str(table['grid_key']) != grid_key:
+                    continue
+                table_templates = list(table['template_keys'])
+                table_filters = list(table['filter_keys'])
+                found = [F for F in filters_left if filter_keys[F] in table_filters]
+                if len(found) == 0 or not all(key in table_templates for key in template_keys):
+                    continue
+                template_index = [table_templates.index(key) for key in template_keys]
+                prebuilt = table['responses']
+                for F in found:
+                    self._all_responses[:, F, :] = prebuilt[template_index, table_filters.index(filter_keys[F]), :]
+            filters_left = [F for F in filters_left if F not in found]
+        return filters_left
 
     def _calculate_responses(self):
-        self._all_responses = np.zeros((self.templates.num_templates, self.filters.num_filters, len(self.zGrid)))
-        tot_its = self.templates.num_templates * self.config.z_len * \
-                    self.filters.num_filters
-        with tqdm(total=tot_its) as pbar:
-            for F in range(self.filters.num_filters):
-                for iZ, Z in enumerate(self.zGrid):
-                    for T in range(self.templates.num_templates):
-                        shiftedTemplate = self.templates.interp(T, self.filters.wavelength(F) / (1+Z) )
-                        flux_norm = self.filters.norm(F) * 2.99792458e18
-                        integrand = shiftedTemplate * self.filters.response(F) * \
-                                    self.filters.wavelength(F) / flux_norm
-                        self._all_responses[T, F, iZ] = np.trapz(integrand, x=self.filters.wavelength(F))
-                        pbar.update()
-        self.interp = interp1d(self.zGrid, self._all_responses, bounds_error=False, fill_value=0.)
+        self._all_responses = np.zeros((self.templates.num_templates, self.filters.num_filters, len(self.zGrid)),
+                                       dtype=self._response_dtype)
+        if self.config.response_engine not in ['direct', 'fft']:
+            raise ValueError('response_engine may be either "direct" or "fft", '
+                             + 'but got {} instead.'.format(self.config.response_engine))
+        template_curves = [(self.templates.wavelength(T), self.templates.flux(T))
+                           for T in range(self.templates.num_templates)]
+        if self.config.response_engine == 'fft':
+            #The prebuilt tables are calculated directly, so aren't used here
+            filters_left = list(range(self.filters.num_filters))
+            filter_curves = [(self.filters.wavelength(F), self.filters.response(F), self.filters.norm(F))
+                             for F in filters_left]
+            self._all_responses[:, filters_left, :] = _fftResponses(filter_curves, template_curves, self.zGrid,
+                                                                    self.log_lambda_step)
+            return
+        filters_left = self._load_prebuilt_responses()
+        if len(filters_left) == 0:
+            return
+        if self.config.response_workers > 1:
+            self._calculate_responses_parallel(template_curves, filters_left, self.config.response_workers)
+            return
+        with tqdm(total=len(filters_left)) as pbar:
+            for F in filters_left:
+                self._all_responses[:, F, :] = _filterResponses(self.filters.wavelength(F),
+                                                                self.filters.response(F),
+                                                                self.filters.norm(F),
+                                                                template_curves, self.zGrid,
+                                                                chunk_bytes=self.chunk_bytes)
+                pbar.update()
+
+    def _calculate_responses_parallel(self, template_curves, filters_left, num_workers):
+        '''
+        Fill the filters_left columns of _all_responses using a pool of
+        num_workers processes.
+
+        The work is split into (filter, group of templates) tasks, with enough
+        template groups that there are a few tasks per worker even for a small
+        number of filters. Workers only return their block of the table, which is
+        copied into place and counted towards the progress bar by this process as
+        each task finishes, in whatever order they finish.
+        '''
+        num_templates = self.templates.num_templates
+        num_groups = min(num_templates, -(-4 * num_workers // len(filters_left)))
+        template_groups = np.array_split(np.arange(num_templates), num_groups)
+        tasks = [(F, group, self.filters.wavelength(F), self.filters.response(F),
+                  self.filters.norm(F), [template_curves[T] for T in group],
+                  self.zGrid, self.chunk_bytes)
+                 for F in filters_left for group in template_groups]
+        pool = Pool(num_workers)
+        try:
+            with tqdm(total=len(tasks)) as pbar:
+                for F, group, responses in pool.imap_unordered(_responseTask, tasks):
+                    self._all_responses[group, F, :] = responses
+                    pbar.update()
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _fftResponses(filter_curves, template_curves, redshift_grid, log_lambda_step):
+    '''
+    Return the response of each filter to each template at every redshift in
+    redshift_grid, as an array of shape (N_template, N_filter, N_redshift),
+    calculated as a cross-correlation in log-wavelength.
+
+    filter_curves is a list of (wavelength, response, norm) tuples, one for each
+    filter, and template_curves is a list of (wavelength, flux) array pairs, one
+    for each template. In u = ln(wavelength), redshifting by z shifts a template
+    by s = ln(1+z), so the response integral
+
+    int T(lambda / (1+z)) F(lambda) lambda dlambda = int T(u - s) F(u) exp(2u) du
+
+    is the cross-correlation of the template with F(u) exp(2u). Templates and
+    filters are sampled (by linear interpolation in wavelength) on a common grid
+    of u with spacing log_lambda_step, so that a single FFT product gives the
+    response at every shift on that grid, which is then linearly interpolated
+    onto redshift_grid. The typical difference from the direct integral falls
+    with log_lambda_step, and is around 3e-7 of the largest response for the
+    default of 1e-4. Differences of up to 1e-3 remain where sharp template
+    features cross coarsely sampled filters, which the direct integral (only
+    sampling templates at the filter wavelengths) resolves less well.
+    '''
+    step = log_lambda_step
+    log_redshift = np.log1p(redshift_grid)
+    #Redshifts as shifts in u, on the integer lattice of multiples of step
+    shifts = np.arange(int(np.floor(log_redshift[0] / step)), int(np.ceil(log_redshift[-1] / step)) + 1)
+    #Lattice indices where each filter is sampled
+    filter_lattices = [np.arange(int(np.ceil(np.log(filter_lambda[0]) / step)),
+                                 int(np.floor(np.log(filter_lambda[-1]) / step)) + 1)
+                       for filter_lambda, _, _ in filter_curves]
+    #Templates are needed wherever any filter sees them at any of the shifts
+    template_lattice = np.arange(min(lattice[0] for lattice in filter_lattices) - shifts[-1],
+                                 max(lattice[-1] for lattice in filter_lattices) - shifts[0] + 1)
+    #Long enough that the correlation doesn't wrap around
+    fft_len = next_fast_len(len(template_lattice) + max(len(lattice) for lattice in filter_lattices) - 1)
+
+    #Transform of each (reversed) filter weight F(u) exp(2u) du / norm
+    filter_fts = []
+    for (filter_lambda, filter_response, filter_norm), lattice in zip(filter_curves, filter_lattices):
+        lattice_lambda = np.exp(lattice * step)
+        weight = np.interp(lattice_lambda, filter_lambda, filter_response, left=0., right=0.) * \
+                 lattice_lambda**2 * step / (filter_norm * 2.99792458e18)
+        filter_fts.append(np.fft.rfft(weight[::-1], fft_len))
+
+    responses = np.zeros((len(template_curves), len(filter_curves), len(redshift_grid)))
+    template_lattice_lambda = np.exp(template_lattice * step)
+    for T, (template_lambda, template_flux) in enumerate(tqdm(template_curves)):
+        template_ft = np.fft.rfft(np.interp(template_lattice_lambda, template_lambda, template_flux,
+                                            left=0., right=0.), fft_len)
+        for F, (filter_ft, lattice) in enumerate(zip(filter_fts, filter_lattices)):
+            correlation = np.fft.irfft(template_ft * filter_ft, fft_len)
+            #Element n of the convolution of the template with the reversed filter
+            #weight pairs filter lattice point i with template lattice point
+            #n - len(lattice) + 1 + i, so the shift k is at the n below
+            on_lattice = correlation[lattice[0] - template_lattice[0] + len(lattice) - 1 - shifts]
+            responses[T, F, :] = np.interp(log_redshift, shifts * step, on_lattice)
+    return responses
+
+def _curveKey(*curves):
+    '''
+    Return a hash of the values of the arrays in curves.
+    '''
+    hasher = hashlib.sha1()
+    for curve in curves:
+        curve = np.ascontiguousarray(curve, dtype=np.float64)
+        #Include the length so curves can't run into each other
+        hasher.update(str(len(curve)).encode('utf-8'))
+        hasher.update(curve.tobytes())
+    return hasher.hexdigest()
+
+def _responseTask(task):
+    '''
+    Calculate one (filter, group of templates) block of the response table in a
+    worker process, returning it along with the indices it belongs at.
+    '''
+    F, group, filter_lambda, filter_response, filter_norm, template_curves, redshift_grid, chunk_bytes = task
+    responses = _filterResponses(filter_lambda, filter_response, filter_norm,
+                                 template_curves, redshift_grid, chunk_bytes=chunk_bytes)
+    return F, group, responses
+
+
+def _filterResponses(filter_lambda, filter_response, filter_norm, template_curves,
+                     redshift_grid, chunk_bytes=2**24):
+    '''
+    Return the response of a single filter to each template at every redshift
+    in redshift_grid, as an array of shape (N_template, N_redshift).
+
+    template_curves is a list of (wavelength, flux) array pairs, one for each
+    template. Each template is evaluated at the rest-frame wavelengths of the
+    filter for a whole chunk of redshifts at once, and integrated along the
+    wavelength axis in a single reduction (a dot product with the trapezium
+    rule weights). Chunks are sized so that each
+    (N_redshift_chunk, N_lambda) array is at most chunk_bytes.
+
+    This is the same linear interpolation (with zero outside the template
+    wavelength range) and trapezium rule as evaluating one redshift at a time
+    with Templates.interp and numpy.trapz, so results agree up to floating
+    point rounding (relative differences below 1e-12).
+    '''
+    flux_norm = filter_norm * 2.99792458e18
+    #Trapezium rule weights of each wavelength sample, so the integral of
+    #the integrand y is np.dot(y, trapezium_weights)
+    lambda_step = np.diff(filter_lambda)
+    trapezium_weights = np.zeros(len(filter_lambda))
+    trapezium_weights[:-1] += 0.5 * lambda_step
+    trapezium_weights[1:] += 0.5 * lambda_step
+    #Part of the integral that doesn't depend on the template or redshift
+    filter_weight = filter_response * filter_lambda * trapezium_weights / flux_norm
+    responses = np.zeros((len(template_curves), len(redshift_grid)))
+    chunk_len = max(1, int(chunk_bytes // (8 * len(filter_lambda))))
+    for start in range(0, len(redshift_grid), chunk_len):
+        stop = min(start + chunk_len, len(redshift_grid))
+        #Shape = (N_redshift_chunk, N_lambda)
+        rest_lambda = filter_lambda[np.newaxis, :] / (1. + redshift_grid[start:stop, np.newaxis])
+        for T, (template_lambda, template_flux) in enumerate(template_curves):
+            shifted_template = np.interp(rest_lambda, template_lambda, template_flux,
+                                         left=0., right=0.)
+            responses[T, start:stop] = np.dot(shifted_template, filter_weight)
+    return responses
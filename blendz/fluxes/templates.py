@@ -4,6 +4,7 @@ import warnings
 import numpy as np
 from scipy.interpolate import interp1d
 from blendz import Configuration
+from blendz import packs
 
 class Templates(object):
     def __init__(self, config=None, **kwargs):
@@ -26,11 +27,24 @@ class Templates(object):
 
 
     def loadTemplates(self):
+        #Read every template from a single binary pack of the template set if
+        #there is an up to date one, rather than one text file at a time
+        pack_path = packs.currentPack(packs.templatePackPath(self.config.template_set_path,
+                                                             self.config.template_set),
+                                      self.config.template_set_path)
+        if pack_path is not None:
+            template_pack = packs.readTemplatePack(pack_path, self.config.template_set_path)
+        else:
+            template_pack = None
         self._all_templates = {}
         for T in range(self.num_templates):
             self._all_templates[T] = {}
-            self._all_templates[T]['lambda'], self._all_templates[T]['flux'] = \
-                        np.loadtxt(self.template_dict[T]['path'], unpack=True)
+            if template_pack is not None:
+                self._all_templates[T]['lambda'] = template_pack[T]['lambda']
+                self._all_templates[T]['flux'] = template_pack[T]['flux']
+            else:
+                self._all_templates[T]['lambda'], self._all_templates[T]['flux'] = \
+                            np.loadtxt(self.template_dict[T]['path'], unpack=True)
             tmp_order = np.argsort(self._all_templates[T]['lambda'])
             self._all_templates[T]['lambda'] = self._all_templates[T]['lambda'][tmp_order]
             self._all_templates[T]['flux'] = self._all_templates[T]['flux'][tmp_order]
@@ -0,0 +1,75 @@
+from builtins import *
+import numpy as np
+
+
+class FluxLikelihood(object):
+    '''
+    Flux likelihood of a single galaxy, evaluated as a quadratic form in the
+    component scalings.
+
+    For a blend of model fluxes M_c (one for each component c) scaled by a_c,
+    the chi-squared with W = diag(1/sigma^2) is
+
+    chi^2 = d'Wd - 2 sum_c a_c (M'Wd)_c + sum_cc' a_c a_c' (M'WM)_cc'
+
+    The whitened data d/sigma (and d'Wd) only depend on the galaxy, so are
+    calculated once on creation. The template cross-products M'Wd and M'WM only
+    depend on the redshifts, so are calculated once per set of redshifts by
+    ``setTemplates``. The chi-squared of every template combination is then
+    a sum of num_components^2 precomputed terms, rather than a sum over bands.
+
+    Args:
+        flux_data (numpy.array): Observed fluxes, shape (N_band,).
+
+        flux_sigma (numpy.array): Error on the observed fluxes, shape (N_band,).
+    '''
+    def __init__(self, flux_data, flux_sigma):
+        self.inv_sigma = 1. / flux_sigma
+        self.whitened_data = flux_data * self.inv_sigma
+        self.data_sq = np.dot(self.whitened_data, self.whitened_data)
+
+    def setTemplates(self, template_fluxes):
+        '''
+        Precompute the template cross-products for a set of (unscaled) template
+        fluxes of shape (N_template, N_band, N_component), where the bands
+        match those of the data.
+        '''
+        self.num_templates, _, self.num_components = np.shape(template_fluxes)
+        whitened_templates = template_fluxes * self.inv_sigma[np.newaxis, :, np.newaxis]
+        #M'Wd for each template and component, shape = (N_template, N_component)
+        self.cross_data = np.einsum('tbc,b->tc', whitened_templates, self.whitened_data)
+        #Only one template per component in each combination, so only the diagonal
+        #of M'WM within a component is needed, shape = (N_template, N_component)
+        self.cross_self = np.einsum('tbc,tbc->tc', whitened_templates, whitened_templates)
+        #M'WM between every template of two different components c1 < c2,
+        #each of shape (N_template, N_template)
+        self.cross_pairs = {}
+        for c1 in range(self.num_components):
+            for c2 in range(c1 + 1, self.num_components):
+                self.cross_pairs[(c1, c2)] = np.dot(whitened_templates[:, :, c1],
+                                                    whitened_templates[:, :, c2].T)
+
+    def lnLikelihood(self, template_combos, scalings):
+        '''
+        Return the log-likelihood (defined as -chi^2, like
+        ``Photoz._lnLikelihood_flux``) of each template combination.
+
+        Args:
+            template_combos (tuple of numpy.array): num_components index arrays,
+                where element c holds the template index of component c for
+                each combination.
+
+            scalings (numpy.array): Scaling of each template for each
+                component, shape (N_template, N_component).
+        '''
+        #Terms involving a single component, shape = (N_template, N_component)
+        single = scalings * (scalings * self.cross_self - 2. * self.cross_data)
+        chi_sq = np.full(len(template_combos[0]), self.data_sq)
+        for c in range(self.num_components):
+            chi_sq += single[template_combos[c], c]
+        #Cross terms between components, counted twice by symmetry of M'WM
+        for (c1, c2), cross in self.cross_pairs.items():
+            T1 = template_combos[c1]
+            T2 = template_combos[c2]
+            chi_sq += 2. * scalings[T1, c1] * scalings[T2, c2] * cross[T1, T2]
+        return -1. * chi_sq
@@ -1,16 +1,50 @@
 from builtins import *
+import warnings
 import numpy as np
-from scipy.interpolate import interp1d
 from scipy.optimize import minimize
-from scipy.special import logsumexp
-from itertools import repeat, combinations
+from scipy.special import logsumexp, gammaln, gammainc, gammaincc
+from itertools import repeat
 from blendz.model import ModelBase
+from blendz.fluxes.interpolation import UniformGridInterpolator
 
 class BPZ(ModelBase):
+    #Largest number of magnitudes in the prior table before giving up on
+    #reaching prior_table_tolerance
+    max_prior_table_len = 2**16 + 1
+    #The two-point correlation function of the components
+    has_correlation = True
+
     #def __init__(self, mag_grid_len=100, max_ref_mag_hi=None, **kwargs):
     def __init__(self, mag_grid_len=100, **kwargs):
         super(BPZ, self).__init__(**kwargs)
         self.mag_grid_len = mag_grid_len
+        #Table of the correlation function, with the settings it was calculated for
+        self._correlation_table = None
+        self._correlation_table_key = None
+        #Indices of every pair of components, keyed by the number of components
+        self._pair_indices = {}
+
+    #Make the attributes the prior depends on properties so that changing them
+    #marks the parameter dictionary and prior table as needing recalculation
+    @property #getter
+    def prior_params(self):
+        return self._prior_params
+    @prior_params.setter
+    def prior_params(self, value):
+        self._prior_params = value
+        self._prior_table = None
+        try:
+            del self._prior_params_dict
+        except AttributeError:
+            pass
+
+    @property #getter
+    def max_ref_mag_hi(self):
+        return self._max_ref_mag_hi
+    @max_ref_mag_hi.setter
+    def max_ref_mag_hi(self, value):
+        self._max_ref_mag_hi = value
+        self._prior_table = None
 
     @property #getter, no setter so read-only
     def prior_params_dict(self):
@@ -27,24 +61,6 @@ class BPZ(ModelBase):
                 raise ValueError('Trying to use prior without setting prior parameters. '
                                  + 'Either set in config file or run calibration.')
 
-    @property #getter, no setter so read-only
-    def redshift_prior_norm(self):
-        try:
-            # Return the precalculated value
-            return self._redshift_prior_norm
-        except AttributeError:
-            # First time, precalculate and return if max_ref_mag_hi is set
-            if self.max_ref_mag_hi is not None:
-                self._calculateRedshiftPriorNorm()
-                return self._redshift_prior_norm
-            else:
-                # Complain if it's not
-                raise ValueError('Trying to use prior when max_ref_mag_hi is '
-                                 + 'not known. If you are using ref_mag_hi_sigma, '
-                                 + 'the prior can only be called when set '
-                                 + 'as the model inside a Photoz() object. If you '
-                                 + 'are using ref_mag_hi, you must not set ref_mag_hi_sigma '
-                                 + 'in the config file as it will be preferred.')
     def _loadParameterDict(self):
         nt = len(self.possible_types)
 
@@ -63,15 +79,59 @@ class BPZ(ModelBase):
             'k_t': kt, 'f_t': ft, 'alpha_t': alpt, 'z_0t': z0t, 'k_mt': kmt, 'phi':phi
         }
 
-    def _calculateRedshiftPriorNorm(self):
-        self._redshift_prior_norm = {}
-        mag_range = np.linspace(self.config.ref_mag_lo, self.max_ref_mag_hi, self.mag_grid_len)
-        for T in self.possible_types:
-            norms = np.zeros(self.mag_grid_len)
-            for i, mag in enumerate(mag_range):
-                zi = np.exp(np.array([self.lnRedshiftPrior(zz, T, mag, norm=False) for zz in self.responses.zGrid]))
-                norms[i] = np.log(1./np.trapz(zi[np.isfinite(zi)], x=self.responses.zGrid[np.isfinite(zi)]))
-            self._redshift_prior_norm[T] = interp1d(mag_range, norms)
+        #The same parameters packed into arrays over possible_types, for lnPriorArray
+        #k_t and f_t are zero for the final type, which is not parameterised
+        self._packed_prior_params = {
+            'k_t': np.array([kt.get(t, 0.) for t in self.possible_types]),
+            'f_t': np.array([ft.get(t, 0.) for t in self.possible_types]),
+            'alpha_t': np.array([alpt[t] for t in self.possible_types]),
+            'z_0t': np.array([z0t[t] for t in self.possible_types]),
+            'k_mt': np.array([kmt[t] for t in self.possible_types]),
+            'num_t': np.array([self.responses.templates.numType(t) for t in self.possible_types]),
+        }
+
+    def lnRedshiftPriorNorm(self, template_type, component_ref_mag):
+        '''
+        Return the log of the normalisation of the redshift prior (one over its
+        integral from z_lo to z_hi) of a template type, at one or an array of
+        component reference magnitudes.
+
+        Substituting t = (z/z_m)^alpha, the integral of z^alpha exp(-(z/z_m)^alpha)
+        is z_m^(alpha+1) / alpha * Gamma(s) * [P(s, t_hi) - P(s, t_lo)], where
+        s = 1 + 1/alpha and P is the regularised lower incomplete gamma function,
+        so the normalisation is exact and needs no precalculation. When both ends
+        are far into the upper tail, the difference is taken between the upper
+        incomplete gamma functions instead so that it doesn't cancel to zero.
+        With alpha = 0 the prior is flat.
+        '''
+        try:
+            alpha = self.prior_params_dict['alpha_t'][template_type]
+            z_m = self.prior_params_dict['z_0t'][template_type] + (self.prior_params_dict['k_mt'][template_type] * (np.asarray(component_ref_mag) - self.config.ref_mag_lo))
+        except KeyError:
+            raise ValueError('The possible galaxy types based on your template '
+                             'set are "' + '", "'.join(self.possible_types) + '", but the '
+                             'redshift prior was called with type ' + template_type)
+        return self._lnRedshiftPriorNorm(alpha, z_m)
+
+    def _lnRedshiftPriorNorm(self, alpha, z_m):
+        '''
+        Closed form of lnRedshiftPriorNorm for (broadcastable) arrays of alpha and
+        z_m (which depends on the magnitude).
+        '''
+        z_lo = self.config.z_lo
+        z_hi = self.config.z_hi
+        alpha, z_m = np.broadcast_arrays(np.asarray(alpha, dtype=float), np.asarray(z_m, dtype=float))
+        flat = alpha == 0.
+        #Evaluate the flat case with alpha = 1 and replace it at the end
+        alpha = np.where(flat, 1., alpha)
+        s = 1. + 1. / alpha
+        t_lo = (z_lo / z_m)**alpha
+        t_hi = (z_hi / z_m)**alpha
+        upper_tail = t_lo > s
+        gamma_diff = np.where(upper_tail, gammaincc(s, t_lo) - gammaincc(s, t_hi),
+                              gammainc(s, t_hi) - gammainc(s, t_lo))
+        ln_integral = (alpha + 1.) * np.log(z_m) - np.log(alpha) + gammaln(s) + np.log(gamma_diff)
+        return np.where(flat, 1. - np.log(z_hi - z_lo), -1. * ln_integral)
 
     def _calculateMagnitudePriorNorm(self, photometry):
         #Integrates over P(m) * S(m) - the selection depends on galaxy
@@ -122,13 +182,7 @@ class BPZ(ModelBase):
                              'set are "' + '", "'.join(self.possible_types) + '", but the '
                              'redshift prior was called with type ' + template_type)
         if norm:
-            try:
-                out = out + self.redshift_prior_norm[template_type](component_ref_mag)
-            except ValueError:
-                raise ValueError('Magnitude = {} is outside of prior-precalculation '
-                                 'range. Check your configuration ref-mag limits '
-                                 'cover your input magnitudes.'.format(component_ref_mag))
-            return out
+            return out + self.lnRedshiftPriorNorm(template_type, component_ref_mag)
         else:
             return out
 
@@ -136,18 +190,92 @@ class BPZ(ModelBase):
         if len(redshifts)==1:
             return 0.
         elif len(redshifts)==2:
-            theta = self.config.angular_resolution
-            redshifts = np.sort(redshifts)
-            r_2 = self.comovingSeparation(0., redshifts[1])
-            delta_r = self.comovingSeparation(redshifts[0], redshifts[1])
-            power = 1. - (self.config.gamma/2.)
-            one = (self.config.r0**2.) / (power * r_2 * r_2 * theta * theta)
-            two = (delta_r**2 + (r_2 * r_2 * theta * theta)) / (self.config.r0**2.)
-            three = (delta_r**2) / (self.config.r0**2.)
-            return one * ( (two**power) - (three**power) )
+            z_lo, z_hi = sorted(float(z) for z in redshifts)
+            return self.pairCorrelation(z_lo, z_hi)
         else:
-            # Assume any xi^N, N>2 is zero, call two-point function recursively and sum
-            return logsumexp([self.correlationFunction(np.asarray(cmb)) for cmb in combinations(redshifts, 2)])
+            # Assume any xi^N, N>2 is zero, and sum the two-point function over
+            # every pair, in the order of itertools.combinations
+            redshifts = np.asarray(redshifts, dtype=float)
+            try:
+                first, second = self._pair_indices[len(redshifts)]
+            except KeyError:
+                first, second = self._pair_indices[len(redshifts)] = np.triu_indices(len(redshifts), 1)
+            z_first, z_second = redshifts[first], redshifts[second]
+            return logsumexp(self.pairCorrelation(np.minimum(z_first, z_second),
+                                                  np.maximum(z_first, z_second)))
+
+    def correlationFunctionArray(self, redshifts):
+        redshifts = np.asarray(redshifts, dtype=float)
+        num_components = np.shape(redshifts)[-1]
+        if num_components==1:
+            return np.zeros(np.shape(redshifts)[:-1])
+        first, second = np.triu_indices(num_components, 1)
+        z_first, z_second = redshifts[..., first], redshifts[..., second]
+        xi = self.pairCorrelation(np.minimum(z_first, z_second), np.maximum(z_first, z_second))
+        if num_components==2:
+            return xi[..., 0]
+        else:
+            return logsumexp(xi, axis=-1)
+
+    def pairCorrelation(self, z_lo, z_hi):
+        '''
+        Return the two-point correlation function of objects at redshifts z_lo and
+        z_hi (numbers or arrays, where z_lo <= z_hi). If correlation_table is
+        True, this is interpolated from a table on the redshift grid where possible.
+        '''
+        if self.config.correlation_table:
+            xi = self._lookupCorrelation(np.atleast_1d(z_lo), np.atleast_1d(z_hi))
+            return xi if np.ndim(z_hi) > 0 else xi[0]
+        return self._calculateCorrelation(z_lo, z_hi)
+
+    def _calculateCorrelation(self, z_lo, z_hi):
+        theta = self.config.angular_resolution
+        r_2 = self.cosmology.comovingDistance(z_hi)
+        delta_r = r_2 - self.cosmology.comovingDistance(z_lo)
+        power = 1. - (self.config.gamma/2.)
+        one = (self.config.r0**2.) / (power * r_2 * r_2 * theta * theta)
+        two = (delta_r**2 + (r_2 * r_2 * theta * theta)) / (self.config.r0**2.)
+        three = (delta_r**2) / (self.config.r0**2.)
+        return one * ( (two**power) - (three**power) )
+
+    def _lookupCorrelation(self, z_lo, z_hi):
+        '''
+        Interpolate the correlation function from a table on the redshift grid.
+
+        Away from z_lo = z_hi, xi falls as a power law, (delta_r / r0)^-gamma, of
+        the comoving separation, so the table is of log(xi) + gamma * log(n),
+        where n is the separation of the pair in grid steps, which varies
+        slowly enough to interpolate bilinearly. xi is calculated exactly
+        outside of the grid, within one grid step of z_lo = z_hi, where it has a
+        cusp, and next to zero redshift, where it diverges.
+        '''
+        z_grid = self.config.redshift_grid
+        key = (self.config.r0, self.config.gamma, self.config.angular_resolution,
+               self.config.omega_mat, self.config.omega_lam, self.config.omega_k,
+               self.config.hubble, z_grid[0], z_grid[-1], len(z_grid))
+        if self._correlation_table_key != key:
+            grid_index = np.arange(len(z_grid))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._correlation_table = np.log(self._calculateCorrelation(
+                    np.minimum.outer(z_grid, z_grid), np.maximum.outer(z_grid, z_grid))) + \
+                    self.config.gamma * np.log(np.abs(np.subtract.outer(grid_index, grid_index)))
+            self._correlation_table_key = key
+        table = self._correlation_table
+        inv_step = (len(z_grid) - 1) / (z_grid[-1] - z_grid[0])
+        pos_lo = (z_lo - z_grid[0]) * inv_step
+        pos_hi = (z_hi - z_grid[0]) * inv_step
+        i = np.clip(pos_lo.astype(int), 0, len(z_grid) - 2)
+        j = np.clip(pos_hi.astype(int), 0, len(z_grid) - 2)
+        t = pos_lo - i
+        u = pos_hi - j
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xi = np.exp((1. - t) * ((1. - u) * table[i, j] + u * table[i, j + 1]) +
+                        t * ((1. - u) * table[i + 1, j] + u * table[i + 1, j + 1]) -
+                        self.config.gamma * np.log(pos_hi - pos_lo))
+        exact = (j - i <= 1) | (pos_lo < 0.) | (pos_hi > len(z_grid) - 1) | ~np.isfinite(xi)
+        if np.any(exact):
+            xi[exact] = self._calculateCorrelation(z_lo[exact], z_hi[exact])
+        return xi
 
     def lnMagnitudePrior(self, magnitude):
         return (self.prior_params_dict['phi'] * magnitude) * np.log(10.)
@@ -162,6 +290,79 @@ class BPZ(ModelBase):
             lnPriorOut[i] = p_z + p_t + p_m
         return lnPriorOut
 
+    def lnPriorArray(self, redshifts, magnitudes):
+        '''
+        Return lnPrior for each pair of elements of the (broadcastable) arrays
+        redshifts and magnitudes, as an array of shape broadcast_shape + (num_types,),
+        evaluated with array operations over the packed parameters of every type.
+        '''
+        #Make sure the parameters are loaded
+        self.prior_params_dict
+        packed = self._packed_prior_params
+        redshifts, magnitudes = np.broadcast_arrays(np.asarray(redshifts, dtype=float),
+                                                    np.asarray(magnitudes, dtype=float))
+        #Add an axis for the type
+        redshifts = redshifts[..., np.newaxis]
+        z_m = packed['z_0t'] + (packed['k_mt'] * (magnitudes[..., np.newaxis] - self.config.ref_mag_lo))
+        with np.errstate(divide='ignore'):
+            #Redshift prior, which is zero at zero redshift
+            first = np.where(redshifts == 0., -np.inf, packed['alpha_t'] * np.log(redshifts))
+        lnRedshiftPrior = first - (redshifts / z_m)**packed['alpha_t']
+        lnMagnitudePrior = self.lnMagnitudePrior(magnitudes)[..., np.newaxis]
+        return lnRedshiftPrior + self._lnMagnitudeTerms(magnitudes) + lnMagnitudePrior
+
+    def _lnMagnitudeTerms(self, magnitudes):
+        '''
+        Return the terms of lnPriorArray that only depend on magnitude, i.e., the
+        template prior and redshift prior normalisation, with shape
+        magnitudes.shape + (num_types,). These are looked up in the prior table
+        if prior_table_tolerance is set, and calculated otherwise.
+        '''
+        if self.config.prior_table_tolerance is not None and self.max_ref_mag_hi is not None:
+            if self._prior_table is None:
+                self._prior_table = self._buildPriorTable(self.config.prior_table_tolerance)
+            #The table is False if it couldn't reach the tolerance
+            if self._prior_table is not False and np.all(magnitudes >= self.config.ref_mag_lo) \
+                    and np.all(magnitudes <= self.max_ref_mag_hi):
+                return np.moveaxis(self._prior_table(magnitudes), 0, -1)
+        return self._calculateMagnitudeTerms(magnitudes)
+
+    def _calculateMagnitudeTerms(self, magnitudes):
+        packed = self._packed_prior_params
+        mag_diff = np.asarray(magnitudes, dtype=float)[..., np.newaxis] - self.config.ref_mag_lo
+        #Template prior, where the final type is one minus the others
+        type_fractions = packed['f_t'] * np.exp(-1. * packed['k_t'] * mag_diff)
+        type_fractions[..., -1] = 1. - np.sum(type_fractions[..., :-1], axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lnTemplatePrior = np.log(type_fractions) - np.log(packed['num_t'])
+        z_m = packed['z_0t'] + (packed['k_mt'] * mag_diff)
+        return lnTemplatePrior + self._lnRedshiftPriorNorm(packed['alpha_t'], z_m)
+
+    def _buildPriorTable(self, tolerance):
+        '''
+        Return an interpolator over a table of the magnitude terms of the prior on
+        a uniform grid of magnitudes from ref_mag_lo to max_ref_mag_hi, fine enough
+        that linear interpolation is within tolerance of the exact log-prior at
+        every cell midpoint, or False if that can't be reached.
+
+        The redshift dependence of the prior is not tabulated: it is cheap to
+        evaluate exactly, and z^alpha is not smooth at zero redshift for
+        alpha < 1, which would need an impractically fine table.
+        '''
+        table_len = 33
+        while table_len <= self.max_prior_table_len:
+            mag_grid = np.linspace(self.config.ref_mag_lo, self.max_ref_mag_hi, table_len)
+            table = self._calculateMagnitudeTerms(mag_grid)
+            midpoints = self._calculateMagnitudeTerms(0.5 * (mag_grid[1:] + mag_grid[:-1]))
+            if not np.all(np.isfinite(table)):
+                break
+            if np.max(np.abs(0.5 * (table[1:] + table[:-1]) - midpoints)) <= tolerance:
+                return UniformGridInterpolator(mag_grid[0], mag_grid[-1], np.ascontiguousarray(table.T))
+            table_len = 2 * table_len - 1
+        warnings.warn('The prior could not be tabulated to within prior_table_tolerance '
+                      + '= {}, so will be calculated exactly.'.format(tolerance))
+        return False
+
     def lnPriorCalibrationPrior(self):
         '''Returns the prior on the prior parameters for the calibration procedure.'''
         #Assume a flat prior, except that sum(type fractions) <= 1. ...
@@ -176,7 +377,6 @@ class BPZ(ModelBase):
     def _lnPriorCalibrationPosterior(self, params, photometry):
         self.prior_params = params
         self._loadParameterDict()
-        self._calculateRedshiftPriorNorm()
         self._calculateMagnitudePriorNorm(photometry)
 
         calibration_prior = self.lnPriorCalibrationPrior()
@@ -275,7 +475,6 @@ class BPZ(ModelBase):
         # Set up self with optimal parameters
         self.prior_params = opt_params
         self._loadParameterDict()
-        self._calculateRedshiftPriorNorm()
 
         #Save out to a config file ready to load into Photoz()
         if config_save_path is not None:
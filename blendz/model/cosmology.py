@@ -0,0 +1,122 @@
+from builtins import *
+import numpy as np
+from scipy.special import roots_legendre
+
+#Speed of light in km/s
+SPEED_OF_LIGHT = 3.e5
+
+class Cosmology(object):
+    '''
+    Comoving distances for a cosmology, looked up in a precalculated table of the
+    cumulative comoving distance rather than integrated for each pair of
+    redshifts.
+
+    The integral of 1/E(z) is calculated on a uniform grid of redshifts, with a
+    Gauss-Legendre rule within each grid cell, and evaluated between grid points
+    by cubic Hermite interpolation using the known derivative 1/E(z). With the
+    default grid spacing, this matches ``scipy.integrate.quad`` to a relative
+    1e-12. The table is extended whenever a redshift beyond it is requested.
+
+    Args:
+        omega_mat (float): Omega-matter cosmological parameter.
+
+        omega_lam (float): Omega-lambda cosmological parameter.
+
+        omega_k (float): Omega-k cosmological parameter.
+
+        hubble (float): Hubble constant in km/s/Mpc.
+
+        z_max (float): Largest redshift of the initial table.
+
+        z_step (float): Spacing of the table.
+    '''
+    def __init__(self, omega_mat, omega_lam, omega_k, hubble, z_max=10., z_step=1e-3):
+        self.omega_mat = omega_mat
+        self.omega_lam = omega_lam
+        self.omega_k = omega_k
+        self.hubble = hubble
+        self.z_step = z_step
+        self._calculateTable(z_max)
+
+    def invE(self, redshift):
+        '''
+        Return 1/E(z), the integrand of the comoving distance.
+        '''
+        return 1. / np.sqrt((self.omega_mat * (1 + redshift)**3.) +
+                            (self.omega_k * (1 + redshift)**2.) +
+                            self.omega_lam)
+
+    def _calculateTable(self, z_max):
+        num_cells = int(np.ceil(z_max / self.z_step))
+        self.z_max = num_cells * self.z_step
+        self.table_z = np.arange(num_cells + 1) * self.z_step
+        #Integral over each cell with an 8-point Gauss-Legendre rule
+        nodes, weights = roots_legendre(8)
+        cell_nodes = self.table_z[:-1, np.newaxis] + 0.5 * self.z_step * (nodes + 1.)
+        cell_integrals = 0.5 * self.z_step * np.dot(self.invE(cell_nodes), weights)
+        self.table_integral = np.concatenate([[0.], np.cumsum(cell_integrals)])
+        self.table_invE = self.invE(self.table_z)
+        #Python lists for _scalarIntegral, which indexes them much faster than arrays
+        self._table_integral = self.table_integral.tolist()
+        self._table_invE = self.table_invE.tolist()
+
+    def _integral(self, redshift):
+        '''
+        Return the integral of 1/E(z) from zero to redshift, which may be a number or an array.
+        '''
+        if np.ndim(redshift) == 0:
+            return self._scalarIntegral(float(redshift))
+        redshift = np.asarray(redshift, dtype=float)
+        if redshift.size > 0 and redshift.max() > self.z_max:
+            self._calculateTable(max(2. * self.z_max, redshift.max()))
+        position = redshift * (1. / self.z_step)
+        lower_index = position.astype(np.intp)
+        np.clip(lower_index, 0, len(self.table_z) - 2, out=lower_index)
+        t = position - lower_index
+        #Cubic Hermite interpolation, in Horner form
+        lower = self.table_integral[lower_index]
+        upper = self.table_integral[lower_index + 1]
+        lower_slope = self.z_step * self.table_invE[lower_index]
+        upper_slope = self.z_step * self.table_invE[lower_index + 1]
+        return lower + t * (lower_slope + t * (3. * (upper - lower) - 2. * lower_slope - upper_slope +
+                                               t * (2. * (lower - upper) + lower_slope + upper_slope)))
+
+    def _scalarIntegral(self, redshift):
+        #Same as _integral, avoiding the overhead of numpy for a single redshift
+        if redshift > self.z_max:
+            self._calculateTable(max(2. * self.z_max, redshift))
+        position = redshift / self.z_step
+        i = min(max(int(position), 0), len(self.table_z) - 2)
+        t = position - i
+        s = 1. - t
+        return (1. + 2. * t) * s * s * self._table_integral[i] + \
+               t * s * s * self.z_step * self._table_invE[i] + \
+               t * t * (3. - 2. * t) * self._table_integral[i + 1] + \
+               t * t * (t - 1.) * self.z_step * self._table_invE[i + 1]
+
+    def comovingDistance(self, redshift):
+        '''
+        Return the line of sight comoving distance in Mpc to one or an array of
+        (non-negative) redshifts.
+        '''
+        return (SPEED_OF_LIGHT / self.hubble) * self._integral(redshift)
+
+    def comovingSeparation(self, z_lo, z_hi):
+        '''
+        Return the comoving distance between objects at redshifts z_lo and z_hi
+        along the line of sight, where each may be a number or an array.
+        '''
+        return (SPEED_OF_LIGHT / self.hubble) * (self._integral(z_hi) - self._integral(z_lo))
+
+
+_cosmologies = {}
+
+def getCosmology(omega_mat, omega_lam, omega_k, hubble):
+    '''
+    Return the Cosmology for a set of parameters, only calculating its table the
+    first time those parameters are used.
+    '''
+    key = (float(omega_mat), float(omega_lam), float(omega_k), float(hubble))
+    if key not in _cosmologies:
+        _cosmologies[key] = Cosmology(*key)
+    return _cosmologies[key]
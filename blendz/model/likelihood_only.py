@@ -3,5 +3,14 @@ import numpy as np
 from blendz.model import ModelBase
 
 class LikelihoodOnly(ModelBase):
+    flat_prior = True
+    has_correlation = False
+
     def lnPrior(self, redshift, magnitude):
         return 0.
+
+    def lnPriorArray(self, redshifts, magnitudes):
+        return np.zeros(np.broadcast(redshifts, magnitudes).shape + (len(self.possible_types),))
+
+    def correlationFunctionArray(self, redshifts):
+        return np.zeros(np.shape(redshifts)[:-1])
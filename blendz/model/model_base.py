@@ -6,12 +6,20 @@ import warnings
 import abc
 from future.utils import with_metaclass
 import numpy as np
-from scipy.integrate import quad
 from scipy.special import erf
 from blendz import Configuration
 from blendz.fluxes import Responses
+from blendz.model.cosmology import getCosmology
 
 class ModelBase(with_metaclass(abc.ABCMeta)):
+    #Models whose prior is constant over the parameter space, with no
+    #correlation function, so that Photoz can skip the prior terms of the
+    #posterior and normalise the prior (up to selection effects) analytically
+    flat_prior = False
+    #Models whose correlationFunction may be non-zero, in which case the prior
+    #for more than two components isn't normalised by quadrature
+    has_correlation = True
+
     def __init__(self, responses=None, config=None, **kwargs):
         #Warn user is config and responses given that config ignored
         if ((responses is not None) and (config is not None)):
@@ -190,21 +198,26 @@ class ModelBase(with_metaclass(abc.ABCMeta)):
             return -np.inf
         else:
             lnPrior = np.log(1. + self.correlationFunction(redshifts))
+            component_priors = self.lnPriorArray(redshifts, magnitudes)
             for a in range(num_components):
                 tmp_ind_a = self.responses.templates.tmp_ind_to_type_ind[int(templates_disc[a])]
-                lnPrior += self.lnPrior(redshifts[a], magnitudes[a])[tmp_ind_a]
+                lnPrior += component_priors[a, tmp_ind_a]
 
             return lnPrior
 
+    @property
+    def cosmology(self):
+        '''The Cosmology of the configured parameters, whose comoving distance
+        table is shared by every model with the same parameters.
+        '''
+        return getCosmology(self.config.omega_mat, self.config.omega_lam,
+                            self.config.omega_k, self.config.hubble)
+
     def comovingSeparation(self, z_lo, z_hi):
         '''Returns the comoving distance between two objects along the
-        line of sight, given their redshifts.
+        line of sight, given their redshifts, which may also be arrays.
         '''
-
-        integral = quad(lambda zp: 1./np.sqrt((self.config.omega_mat * (1+zp)**3.) +
-                                              (self.config.omega_k * (1+zp)**2.) +
-                                              self.config.omega_lam), z_lo, z_hi)[0]
-        return (3.e5 / self.config.hubble) * integral
+        return self.cosmology.comovingSeparation(z_lo, z_hi)
 
     def lnSelection(self, flux, galaxy):
         #Depending on the measurement-component mapping, the galaxy
@@ -217,7 +230,9 @@ class ModelBase(with_metaclass(abc.ABCMeta)):
         #If flux has multiple elements, the selection is a product over S,
         #so return the sum of the log
         #If it's only one element, the sum does nothing anyway
-        return np.sum(np.log(selection))
+        #flux can also be an array of shape (N, len(select_band)), in which
+        #case an array of N selection effects is returned
+        return np.sum(np.log(selection), axis=-1)
 
     def lnPriorCalibrationPrior(self):
         '''Returns the prior on the prior parameters for the calibration procedure.'''
@@ -228,6 +243,37 @@ class ModelBase(with_metaclass(abc.ABCMeta)):
         #Default to no correlation
         return 0.
 
+    def correlationFunctionArray(self, redshifts):
+        '''
+        Return correlationFunction for each set of component redshifts along
+        the last axis of the array redshifts, as an array of shape
+        redshifts.shape[:-1].
+
+        This default calls correlationFunction once for each set, so models
+        with a correlation function should override it with an implementation
+        using array operations.
+        '''
+        out = np.zeros(np.shape(redshifts)[:-1])
+        for index in np.ndindex(*np.shape(out)):
+            out[index] = self.correlationFunction(redshifts[index])
+        return out
+
     @abc.abstractmethod
     def lnPrior(self, redshift, magnitude):
         pass
+
+    def lnPriorArray(self, redshifts, magnitudes):
+        '''
+        Return the single component prior of every type, as given by lnPrior, for
+        each pair of elements of the arrays redshifts and magnitudes. These may
+        have any (broadcastable) shape, and the result has shape
+        broadcast_shape + (num_types,).
+
+        This default calls lnPrior once for each pair, so models should override
+        it with an implementation using array operations.
+        '''
+        redshifts, magnitudes = np.broadcast_arrays(redshifts, magnitudes)
+        out = np.zeros(np.shape(redshifts) + (len(self.possible_types),))
+        for index in np.ndindex(*np.shape(redshifts)):
+            out[index] = self.lnPrior(redshifts[index], magnitudes[index])
+        return out
@@ -0,0 +1,480 @@
+from builtins import *
+import os
+import hashlib
+import itertools as itr
+import warnings
+from math import factorial
+import numpy as np
+from scipy.special import roots_legendre, logsumexp
+from scipy.interpolate import RegularGridInterpolator
+import dill
+
+
+def gaussLegendreRule(breakpoints, order):
+    '''
+    Return the nodes and weights of a composite Gauss-Legendre rule, with
+    ``order`` nodes in each panel between consecutive breakpoints.
+    '''
+    nodes, weights = roots_legendre(order)
+    lo = np.asarray(breakpoints[:-1], dtype=float)[:, np.newaxis]
+    hi = np.asarray(breakpoints[1:], dtype=float)[:, np.newaxis]
+    return (lo + 0.5 * (hi - lo) * (nodes + 1.)).ravel(), (0.5 * (hi - lo) * weights).ravel()
+
+
+class PriorQuadrature(object):
+    '''
+    Deterministic integration of the prior of a galaxy (including the selection
+    effect, marginalised over templates) over the redshifts and magnitudes of
+    its components. This gives the log-normalisation that ``Photoz`` otherwise
+    estimates with a nested sampling run over the prior, together with an
+    estimate of its error.
+
+    When the selection band is the reference band, the integrand is a product
+    of the single component priors P(z_a, m_a), the selection effect S({m})
+    and the clustering term 1 + xi({z}), so the integral over a tensor-product
+    Gauss-Legendre rule is calculated by contracting S with P one component at
+    a time rather than evaluating the full integrand at every node. The
+    redshift panels are graded towards z_lo, where the prior behaves as
+    z^alpha. With more than one exchangeable component, the sorted region is
+    integrated as 1/num_components! of the full box.
+
+    For two components, xi has a narrow ridge along z_1 = z_2 (of width
+    r_2 * angular_resolution in comoving distance) which holds much of its
+    integral and which no fixed rule resolves. This is integrated by singularity
+    subtraction: the integral over z_1 of xi times the rest of the integrand is
+    split into xi times the difference from its value at z_1 = z_2, which the
+    rule integrates, plus that value times the integral of xi over z_1, which is
+    calculated on a rule graded towards the ridge.
+
+    With more than two components, the correlation function isn't a sum over
+    pairs of components, so only models without one are integrated by quadrature.
+
+    For models with a flat prior, only the selection effect is integrated, over
+    the magnitudes of the components.
+
+    The error is estimated as the difference from the same calculation with
+    half as many panels in each dimension.
+
+    Args:
+        model (blendz.model.ModelBase): The model whose prior is normalised.
+
+        config (blendz.Configuration): The configuration of the Photoz object.
+    '''
+    #Gauss-Legendre nodes in each panel
+    order = 8
+    #Number of redshift and magnitude panels of the first rule
+    num_z_panels = 16
+    num_mag_panels = 8
+    #Panels of the graded rule over each side of the ridge of the correlation
+    #function, and the smallest of them as a fraction of the redshift range
+    ridge_panels = 40
+    ridge_min_width = 1e-10
+
+    def __init__(self, model, config):
+        self.model = model
+        self.config = config
+        self._correlation_cache = {}
+
+    def _sortedByComponent(self, num_components):
+        return num_components > 1 and self.model.redshifts_exchangeable
+
+    def canIntegrate(self, num_components):
+        '''
+        Return whether the prior for num_components can be integrated by
+        quadrature, which needs the selection band to be the reference band, a
+        single reference band when the components are sorted, and no
+        correlation function (see ModelBase.has_correlation) for more than two
+        components.
+        '''
+        select_is_ref = np.all(self.config.ref_band == self.config.select_band)
+        symmetric = len(self.config.ref_band) == 1 or not self._sortedByComponent(num_components)
+        if not (select_is_ref and symmetric):
+            return False
+        if num_components > 2 and not self.model.flat_prior:
+            return not self.model.has_correlation
+        return True
+
+    def fingerprint(self, num_components, tolerance):
+        '''
+        Return a hash of everything the normalisation depends on apart from the
+        galaxy: the model and its prior parameters, the settings of the prior,
+        the templates, and the rule (up to tolerance).
+        '''
+        names = ['z_lo', 'z_hi', 'ref_mag_lo', 'sort_redshifts', 'ref_band', 'select_band',
+                 'r0', 'gamma', 'angular_resolution', 'omega_mat', 'omega_lam', 'omega_k',
+                 'hubble', 'prior_table_tolerance', 'correlation_table']
+        values = [type(self.model).__name__, num_components, self.model.redshifts_exchangeable,
+                  np.ravel(self.model.prior_params).tolist(),
+                  list(self.model.possible_types), list(self.model.responses.templates.tmp_ind_to_type_ind),
+                  self.order, self.num_z_panels, self.num_mag_panels, tolerance] + \
+                 [np.ravel(getattr(self.config, name, None)).tolist() for name in names]
+        return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+    def redshiftRule(self, num_panels):
+        #Panels graded quadratically towards z_lo
+        breakpoints = self.config.z_lo + (self.config.z_hi - self.config.z_lo) * \
+                      np.linspace(0., 1., num_panels + 1)**2
+        return gaussLegendreRule(breakpoints, self.order)
+
+    def magnitudeRule(self, num_panels, galaxy):
+        breakpoints = np.linspace(self.config.ref_mag_lo, galaxy.ref_mag_hi, num_panels + 1)
+        #The selection effect is a step at the magnitude limit for a single component
+        if self.config.ref_mag_lo < galaxy.magnitude_limit < galaxy.ref_mag_hi:
+            breakpoints = np.union1d(breakpoints, [galaxy.magnitude_limit])
+        return gaussLegendreRule(breakpoints, self.order)
+
+    def _correlationKey(self, num_components, num_panels):
+        names = ['z_lo', 'z_hi', 'r0', 'gamma', 'angular_resolution', 'omega_mat',
+                 'omega_lam', 'omega_k', 'hubble', 'correlation_table']
+        return (num_components, num_panels) + tuple(getattr(self.config, name, None) for name in names)
+
+    def _correlationTerms(self, num_components, num_panels):
+        '''
+        Return the correlation function at every tuple of redshift nodes, with
+        shape (num_nodes,) * num_components, and for two components, the
+        integral of the correlation function over z_1 at each node z_2.
+        '''
+        key = self._correlationKey(num_components, num_panels)
+        if key not in self._correlation_cache:
+            z_nodes, _ = self.redshiftRule(num_panels)
+            z_tuples = np.stack(np.meshgrid(*([z_nodes] * num_components), indexing='ij'), axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xi = self.model.correlationFunctionArray(z_tuples)
+            ridge_integral = None
+            if num_components == 2:
+                ridge_integral = self._ridgeIntegral(z_nodes)
+                #The subtracted integrand is zero on the ridge itself
+                np.fill_diagonal(xi, 0.)
+            self._correlation_cache[key] = (xi, ridge_integral)
+        return self._correlation_cache[key]
+
+    def _ridgeIntegral(self, z_nodes):
+        '''
+        Return the integral of the two-component correlation function over z_1
+        from z_lo to z_hi, for z_2 at each of z_nodes.
+        '''
+        z_range = self.config.z_hi - self.config.z_lo
+        #Breakpoints in distance from the ridge, geometric from ridge_min_width
+        #up to the full range, with the lengths of each side cut off below
+        widths = np.concatenate([[0.], z_range * np.geomspace(self.ridge_min_width, 1., self.ridge_panels)])
+        unit_nodes, unit_weights = gaussLegendreRule(widths / z_range, self.order)
+        integral = np.zeros(len(z_nodes))
+        for side_length, sign in [(z_nodes - self.config.z_lo, -1.), (self.config.z_hi - z_nodes, 1.)]:
+            #Scale the rule over [0, z_range] onto [0, side_length]
+            offsets = side_length[:, np.newaxis] * unit_nodes[np.newaxis, :]
+            weights = side_length[:, np.newaxis] * unit_weights[np.newaxis, :]
+            z_other = z_nodes[:, np.newaxis] + sign * offsets
+            pairs = np.stack([np.minimum(z_other, z_nodes[:, np.newaxis]),
+                              np.maximum(z_other, z_nodes[:, np.newaxis])], axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xi = self.model.correlationFunctionArray(pairs)
+            integral += np.sum(np.where(weights > 0., xi * weights, 0.), axis=1)
+        return integral
+
+    def _selectionGrid(self, galaxy, num_components, mag_nodes):
+        '''
+        Return the selection effect on the grid of component magnitudes given by
+        mag_nodes, with shape (len(mag_nodes),) * num_components.
+        '''
+        component_fluxes = np.stack(np.meshgrid(*([10.**(-0.4 * mag_nodes)] * num_components),
+                                                indexing='ij'), axis=-1)
+        if len(self.config.ref_band) == 1:
+            ref_flux = np.sum(component_fluxes, axis=-1)[..., np.newaxis]
+        else:
+            ref_flux = component_fluxes
+        with np.errstate(divide='ignore'):
+            return np.exp(self.model.lnSelection(ref_flux, galaxy))
+
+    def _lnNormTerms(self, num_components, galaxy):
+        #Normalisation of the uniform distribution over the box, and the
+        #sorting of exchangeable components
+        ln_terms = -num_components * np.log((self.config.z_hi - self.config.z_lo) *
+                                            (galaxy.ref_mag_hi - self.config.ref_mag_lo))
+        if self._sortedByComponent(num_components):
+            ln_terms -= np.log(factorial(num_components))
+        return ln_terms
+
+    def lnFlatNorm(self, galaxy, num_components, num_mag_panels):
+        '''
+        Return the log-normalisation of a flat prior (see ModelBase.flat_prior)
+        of galaxy for num_components, calculated with num_mag_panels magnitude
+        panels. The integral over the redshifts and the sum over templates are
+        analytic, so only the selection effect is integrated over magnitudes.
+        '''
+        mag_nodes, mag_weights = self.magnitudeRule(num_mag_panels, galaxy)
+        contracted = self._selectionGrid(galaxy, num_components, mag_nodes)
+        for c in range(num_components):
+            contracted = np.tensordot(contracted, mag_weights, axes=([0], [0]))
+        #Every template combination has the same prior, and the integral over
+        #each redshift is the redshift range
+        num_templates = len(self.model.responses.templates.tmp_ind_to_type_ind)
+        with np.errstate(divide='ignore'):
+            ln_norm = np.log(contracted) + num_components * \
+                      np.log(num_templates * (self.config.z_hi - self.config.z_lo))
+        return ln_norm + self._lnNormTerms(num_components, galaxy)
+
+    def lnNorm(self, galaxy, num_components, num_z_panels, num_mag_panels):
+        '''
+        Return the log-normalisation of the prior of galaxy for num_components,
+        calculated with num_z_panels redshift and num_mag_panels magnitude panels.
+        '''
+        if self.model.flat_prior:
+            return self.lnFlatNorm(galaxy, num_components, num_mag_panels)
+        z_nodes, z_weights = self.redshiftRule(num_z_panels)
+        mag_nodes, mag_weights = self.magnitudeRule(num_mag_panels, galaxy)
+
+        #Single component prior marginalised over templates, shape (N_z, N_mag)
+        tmp_ind_to_type_ind = self.model.responses.templates.tmp_ind_to_type_ind
+        lnP = logsumexp(self.model.lnPriorArray(z_nodes[:, np.newaxis], mag_nodes[np.newaxis, :])
+                        [..., tmp_ind_to_type_ind], axis=-1)
+        shift = np.max(lnP)
+        if not np.isfinite(shift):
+            return -np.inf
+        weighted_prior = np.exp(lnP - shift) * mag_weights[np.newaxis, :]
+
+        contracted = self._selectionGrid(galaxy, num_components, mag_nodes)
+
+        #Contract the magnitude axis of each component with its prior, leaving
+        #an array over the redshifts of the components
+        for c in range(num_components):
+            contracted = np.tensordot(contracted, weighted_prior, axes=([0], [1]))
+
+        xi, ridge_integral = self._correlationTerms(num_components, num_z_panels)
+        z_weight_product = z_weights
+        for c in range(num_components - 1):
+            z_weight_product = np.multiply.outer(z_weight_product, z_weights)
+        if num_components == 2:
+            diagonal = np.diagonal(contracted)
+            integral = np.sum(z_weight_product * (contracted + xi * (contracted - diagonal[np.newaxis, :])))
+            integral += np.sum(z_weights * ridge_integral * diagonal)
+        else:
+            integral = np.sum(z_weight_product * (1. + xi) * contracted)
+
+        with np.errstate(divide='ignore'):
+            ln_norm = np.log(integral) + num_components * shift
+        return ln_norm + self._lnNormTerms(num_components, galaxy)
+
+    def __call__(self, galaxy, num_components, tolerance, max_points):
+        '''
+        Return the log-normalisation of the prior of galaxy for num_components
+        and an estimate of its error, doubling the number of panels until the
+        error is within tolerance, or until the arrays over the nodes of the next
+        rule would have more than max_points elements. If even the first rule is
+        too large, the error is infinite.
+        '''
+        def numPoints(z_panels, mag_panels):
+            if self.model.flat_prior:
+                z_panels = 0
+            return (self.order * max(z_panels, mag_panels + 1))**num_components
+
+        num_z_panels, num_mag_panels = self.num_z_panels, self.num_mag_panels
+        if numPoints(num_z_panels, num_mag_panels) > max_points:
+            return np.nan, np.inf
+        coarse = self.lnNorm(galaxy, num_components, num_z_panels // 2, num_mag_panels // 2)
+        while True:
+            fine = self.lnNorm(galaxy, num_components, num_z_panels, num_mag_panels)
+            error = 0. if fine == coarse else np.abs(fine - coarse)
+            if error <= tolerance or numPoints(2 * num_z_panels, 2 * num_mag_panels) > max_points:
+                return fine, error
+            coarse = fine
+            num_z_panels *= 2
+            num_mag_panels *= 2
+
+
+class SelectionInputs(object):
+    '''
+    The properties of a galaxy that the normalisation of its prior depends on,
+    which stand in for the galaxy when calculating the normalisation on a table.
+    '''
+    def __init__(self, ref_mag_hi, magnitude_limit, select_flux_sigma):
+        self.ref_mag_hi = float(ref_mag_hi)
+        self.magnitude_limit = float(magnitude_limit)
+        self.select_flux_sigma = np.atleast_1d(np.asarray(select_flux_sigma, dtype=float))
+
+    @classmethod
+    def fromGalaxy(cls, galaxy):
+        return cls(galaxy.ref_mag_hi, galaxy.magnitude_limit, galaxy.select_flux_sigma)
+
+    @property
+    def key(self):
+        return (self.ref_mag_hi, self.magnitude_limit) + tuple(self.select_flux_sigma.tolist())
+
+
+class PriorNormCache(object):
+    '''
+    Log-normalisations of the prior, shared between galaxies with the same
+    ref_mag_hi, magnitude_limit and select_flux_sigma, and between runs when
+    saved to disk.
+
+    The normalisations are stored for each fingerprint of the model and
+    settings (given by ``PriorQuadrature.fingerprint``) and number of
+    components. Each is reused whenever a galaxy has exactly the same inputs,
+    and otherwise interpolated from a table built by ``buildTable`` over the
+    range of inputs of a set of galaxies. Along each input which varies between
+    the galaxies, the table has a uniform grid (in log(select_flux_sigma) for
+    the selection noise), which is refined until multilinear interpolation is
+    within tolerance at the centre of every cell.
+
+    Args:
+        path (str or None): File the cache is read from (if it exists) and
+            saved to by ``save``. If None, the cache is kept in memory only.
+    '''
+    #Largest number of grid points along each input of a table
+    max_table_len = 65
+
+    def __init__(self, path=None):
+        self.path = path
+        #{(fingerprint, num_components): {SelectionInputs.key: (norm, error)}}
+        self._exact = {}
+        #{(fingerprint, num_components): (interpolator, grid bounds, error)}
+        self._tables = {}
+        #The exact normalisations added since popAdded was last called
+        self._added = {}
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def get(self, fingerprint, num_components, galaxy):
+        '''
+        Return the cached (log-normalisation, error) for a galaxy, or None if it
+        has neither been calculated for the same inputs nor can be interpolated.
+        '''
+        inputs = SelectionInputs.fromGalaxy(galaxy)
+        key = (fingerprint, num_components)
+        try:
+            return self._exact[key][inputs.key]
+        except KeyError:
+            pass
+        if key in self._tables:
+            interpolator, lo, hi, error = self._tables[key]
+            point = self._tablePoint(inputs)
+            if point is not None and np.all(point >= lo) and np.all(point <= hi):
+                return interpolator(point), error
+        return None
+
+    def add(self, fingerprint, num_components, galaxy, norm, error):
+        inputs = SelectionInputs.fromGalaxy(galaxy)
+        self.update({(fingerprint, num_components): {inputs.key: (norm, error)}})
+
+    def update(self, entries):
+        '''
+        Add the exact normalisations of entries, as returned by popAdded, e.g.,
+        those calculated by a copy of this cache in another process.
+        '''
+        for key, norms in entries.items():
+            self._exact.setdefault(key, {}).update(norms)
+            self._added.setdefault(key, {}).update(norms)
+
+    def popAdded(self):
+        '''
+        Return the exact normalisations added since this was last called, so
+        they can be sent to the process that saves the cache.
+        '''
+        added, self._added = self._added, {}
+        return added
+
+    @staticmethod
+    def _tablePoint(inputs):
+        #Tables only cover a single selection band
+        if len(inputs.select_flux_sigma) != 1:
+            return None
+        return np.array([inputs.ref_mag_hi, inputs.magnitude_limit, np.log(inputs.select_flux_sigma[0])])
+
+    def buildTable(self, fingerprint, num_components, galaxies, calculate, tolerance):
+        '''
+        Build the table of log-normalisations over the range of inputs of
+        galaxies, where calculate(inputs, num_components) returns the
+        (log-normalisation, error) for a SelectionInputs object. Returns whether
+        the table reached tolerance; if not, no table is kept.
+        '''
+        key = (fingerprint, num_components)
+        points = [self._tablePoint(SelectionInputs.fromGalaxy(g)) for g in galaxies]
+        if len(points) == 0 or any(point is None for point in points):
+            return False
+        lo, hi = np.min(points, axis=0), np.max(points, axis=0)
+        varying = np.flatnonzero(hi > lo)
+        #If every galaxy has the same inputs, one normalisation covers them all
+        if len(varying) == 0:
+            self.add(fingerprint, num_components, galaxies[0],
+                     *calculate(SelectionInputs.fromGalaxy(galaxies[0]), num_components))
+            return True
+
+        table_len = 5
+        while table_len <= self.max_table_len:
+            axes = [np.linspace(lo[d], hi[d], table_len) for d in varying]
+            values, errors = self._calculateGrid(lo, varying, axes, num_components, calculate)
+            if not (np.all(np.isfinite(values)) and np.all(errors <= tolerance)):
+                break
+            interpolator = RegularGridInterpolator(axes, values)
+            #Check the interpolation at the centre of every cell
+            centres = [0.5 * (axis[1:] + axis[:-1]) for axis in axes]
+            centre_values, centre_errors = self._calculateGrid(lo, varying, centres, num_components, calculate)
+            centre_points = np.array(list(itr.product(*centres)))
+            interp_error = np.max(np.abs(interpolator(centre_points) - centre_values.ravel()))
+            if interp_error <= tolerance:
+                error = interp_error + max(np.max(errors), np.max(centre_errors))
+                self._tables[key] = (_TableLookup(interpolator, varying), lo, hi, error)
+                return True
+            table_len = 2 * table_len - 1
+        warnings.warn('The prior normalisation for {} components could not be '.format(num_components)
+                      + 'tabulated to within prior_norm_tolerance, so will be calculated for each galaxy.')
+        return False
+
+    @staticmethod
+    def _calculateGrid(fixed_point, varying, axes, num_components, calculate):
+        #Normalisations on the grid of axes over the varying inputs, with the
+        #other inputs fixed to those of fixed_point
+        values = np.zeros([len(axis) for axis in axes])
+        errors = np.zeros_like(values)
+        for index in np.ndindex(*values.shape):
+            point = np.array(fixed_point, dtype=float)
+            point[varying] = [axis[i] for axis, i in zip(axes, index)]
+            inputs = SelectionInputs(point[0], point[1], np.exp(point[2]))
+            values[index], errors[index] = calculate(inputs, num_components)
+        return values, errors
+
+    def save(self, path=None):
+        '''
+        Save the cache to path (by default, the path it was created with),
+        merging it with anything saved there in the meantime.
+        '''
+        path = self.path if path is None else path
+        if os.path.exists(path):
+            self.load(path)
+        #Write to a temporary file first and rename, so that other processes
+        #never read a partially written cache
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                dill.dump({'exact': self._exact, 'tables': self._tables}, f)
+            os.rename(tmp_path, path)
+        finally:
+            #Don't leave a partial cache behind if writing it failed, e.g., disk full
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self, path=None):
+        '''
+        Add the cached normalisations saved at path (by default, the path it was
+        created with) to this cache.
+        '''
+        path = self.path if path is None else path
+        try:
+            with open(path, 'rb') as f:
+                saved = dill.load(f)
+        except (IOError, OSError, EOFError, dill.UnpicklingError):
+            warnings.warn('Could not read the prior normalisation cache {}.'.format(path))
+            return
+        for key, norms in saved['exact'].items():
+            self._exact.setdefault(key, {}).update(norms)
+        for key, table in saved['tables'].items():
+            self._tables.setdefault(key, table)
+
+
+class _TableLookup(object):
+    #Interpolate a table over only the inputs which vary between galaxies
+    def __init__(self, interpolator, varying):
+        self.interpolator = interpolator
+        self.varying = varying
+
+    def __call__(self, point):
+        return float(self.interpolator(point[self.varying][np.newaxis, :])[0])
@@ -0,0 +1,226 @@
+'''
+Binary resource packs, which hold every curve of a template set or a folder of
+filters in a single .npz file, so that loading them is one file read instead of
+one np.loadtxt per curve.
+
+A template set file ``<template_set_path>/<template_set>`` is packed into
+``<template_set_path>/<template_set>.npz``, holding the name, type and path of
+each template as well as its curve. A folder of filters is packed into
+``<folder>/filters.npz``. Templates, Filters and the template_dict setting use
+a pack whenever it exists, falling back to the text files for filters missing
+from it. Each pack records the size, modification time and hash of the text
+files it was made from, and a pack whose files have changed since is ignored
+with a warning until it is regenerated, by running
+
+python -m blendz.packs [--templates TEMPLATE_SET_PATH] [--filters FILTER_PATH]
+
+which by default packs the template sets and filters in the included resources.
+'''
+from builtins import *
+import os
+import argparse
+import hashlib
+import warnings
+from os.path import join, isfile, exists
+try:
+    #Python 2
+    import ConfigParser
+except ImportError:
+    #Python 3
+    import configparser as ConfigParser
+import numpy as np
+import blendz
+
+
+FILTER_PACK_NAME = 'filters.npz'
+
+def templatePackPath(template_set_path, template_set):
+    return join(template_set_path, template_set + '.npz')
+
+def filterPackPath(filter_folder):
+    return join(filter_folder, FILTER_PACK_NAME)
+
+def _fileHash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _sourceArrays(base_path, rel_paths):
+    #The path (relative to base_path), size, modification time and hash of
+    #each text file a pack is made from
+    paths = [join(base_path, rel_path) for rel_path in rel_paths]
+    return {'source_paths': np.array(rel_paths),
+            'source_sizes': np.array([os.path.getsize(path) for path in paths]),
+            'source_mtimes': np.array([os.path.getmtime(path) for path in paths]),
+            'source_hashes': np.array([_fileHash(path) for path in paths])}
+
+def isCurrent(pack_path, base_path):
+    '''
+    Return whether none of the text files the pack at pack_path was made from
+    (with paths relative to base_path) have changed since. Files are compared by
+    size and modification time, and by hash if only the modification time differs,
+    e.g., after copying them. Files which no longer exist are ignored, while packs
+    made without a record of their files are never current.
+    '''
+    with np.load(pack_path) as pack:
+        if 'source_paths' not in pack.files:
+            return False
+        sources = list(zip(pack['source_paths'], pack['source_sizes'],
+                           pack['source_mtimes'], pack['source_hashes']))
+    for rel_path, size, mtime, file_hash in sources:
+        path = join(base_path, str(rel_path))
+        if not isfile(path):
+            continue
+        if os.path.getsize(path) != size:
+            return False
+        if os.path.getmtime(path) != mtime and _fileHash(path) != str(file_hash):
+            return False
+    return True
+
+def currentPack(pack_path, base_path):
+    '''
+    Return pack_path if there is a pack there which is current (see isCurrent),
+    and otherwise None, warning if the pack is out of date, so that the text
+    files are read instead.
+    '''
+    if not exists(pack_path):
+        return None
+    if not isCurrent(pack_path, base_path):
+        warnings.warn('The text files of the pack {} have changed since it was made, '.format(pack_path)
+                      + 'so they are read instead. Run python -m blendz.packs to update it.')
+        return None
+    return pack_path
+
+def readTemplateSet(template_set_path, template_set):
+    '''
+    Return a list of dictionaries with the name, (absolute) path and type of
+    each template in a template set file.
+    '''
+    template_config = ConfigParser.SafeConfigParser()
+    template_config.read(join(template_set_path, template_set))
+    template_info = []
+    for template_name in template_config.sections():
+        rel_path_t = template_config.get(template_name, 'path')
+        abs_path_t = join(template_set_path, rel_path_t)
+        type_t = template_config.get(template_name, 'type')
+        template_info.append({'name':template_name, 'path':abs_path_t, 'type':type_t})
+    return template_info
+
+def writeTemplatePack(template_set_path, template_set):
+    '''
+    Pack a template set file and all of the template curves it lists, returning
+    the path of the pack.
+    '''
+    template_info = readTemplateSet(template_set_path, template_set)
+    arrays = {'names': np.array([tmp['name'] for tmp in template_info]),
+              'types': np.array([tmp['type'] for tmp in template_info]),
+              'paths': np.array([os.path.relpath(tmp['path'], template_set_path)
+                                 for tmp in template_info])}
+    for T, tmp in enumerate(template_info):
+        arrays['lambda_{}'.format(T)], arrays['flux_{}'.format(T)] = \
+                    np.loadtxt(tmp['path'], unpack=True)
+    arrays.update(_sourceArrays(template_set_path, [template_set] + list(arrays['paths'])))
+    pack_path = templatePackPath(template_set_path, template_set)
+    np.savez(pack_path, **arrays)
+    return pack_path
+
+def readTemplatePack(pack_path, template_set_path, load_curves=True):
+    '''
+    Return a list of dictionaries with the name, (absolute) path and type of
+    each template in a template pack, as well as its wavelength and flux arrays
+    (under the keys 'lambda' and 'flux') if load_curves is True.
+    '''
+    with np.load(pack_path) as pack:
+        template_info = []
+        for T, (name, type_t, rel_path_t) in enumerate(zip(pack['names'], pack['types'], pack['paths'])):
+            template_info.append({'name':str(name), 'path':join(template_set_path, str(rel_path_t)),
+                                  'type':str(type_t)})
+            if load_curves:
+                template_info[T]['lambda'] = pack['lambda_{}'.format(T)]
+                template_info[T]['flux'] = pack['flux_{}'.format(T)]
+    return template_info
+
+def writeFilterPack(filter_folder):
+    '''
+    Pack every filter curve in a folder, returning the path of the pack, or None
+    if there are no filter curves in the folder.
+    '''
+    filter_names = sorted(name for name in os.listdir(filter_folder)
+                          if isfile(join(filter_folder, name)) and not name.endswith('.npz')
+                          and not name.startswith('.'))
+    if len(filter_names) == 0:
+        return None
+    arrays = {'names': np.array(filter_names)}
+    for F, name in enumerate(filter_names):
+        arrays['lambda_{}'.format(F)], arrays['response_{}'.format(F)] = \
+                    np.loadtxt(join(filter_folder, name), unpack=True)
+    arrays.update(_sourceArrays(filter_folder, filter_names))
+    pack_path = filterPackPath(filter_folder)
+    np.savez(pack_path, **arrays)
+    return pack_path
+
+def readFilterPack(pack_path):
+    '''
+    Return a dictionary of (wavelength, response) array pairs, keyed by the
+    file name of each filter in a filter pack.
+    '''
+    with np.load(pack_path) as pack:
+        return {str(name): (pack['lambda_{}'.format(F)], pack['response_{}'.format(F)])
+                for F, name in enumerate(pack['names'])}
+
+def _isTemplateSet(path):
+    '''
+    Return whether the file at path is a template set file (a configuration
+    file with a path and type for every section).
+    '''
+    template_config = ConfigParser.SafeConfigParser()
+    try:
+        template_config.read(path)
+    except (ConfigParser.Error, UnicodeDecodeError):
+        return False
+    sections = template_config.sections()
+    return len(sections) > 0 and all(template_config.has_option(section, 'path') and
+                                     template_config.has_option(section, 'type')
+                                     for section in sections)
+
+def packTemplateSets(template_set_path):
+    '''
+    Pack every template set file in the folder template_set_path and every
+    folder below it, returning the paths of the packs. As for the template_set
+    setting, template paths in every template set file are relative to
+    template_set_path.
+    '''
+    pack_paths = []
+    for root, dirs, files in os.walk(template_set_path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.npz') or not _isTemplateSet(join(root, name)):
+                continue
+            template_set = os.path.relpath(join(root, name), template_set_path)
+            template_info = readTemplateSet(template_set_path, template_set)
+            if all(isfile(tmp['path']) for tmp in template_info):
+                pack_paths.append(writeTemplatePack(template_set_path, template_set))
+    return pack_paths
+
+def packFilters(filter_path):
+    '''
+    Pack the filter curves in the folder filter_path and every folder below it,
+    returning the paths of the packs.
+    '''
+    pack_paths = []
+    for root, dirs, files in os.walk(filter_path):
+        dirs.sort()
+        pack_path = writeFilterPack(root)
+        if pack_path is not None:
+            pack_paths.append(pack_path)
+    return pack_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack template sets and filter curves into binary resource packs.')
+    parser.add_argument('--templates', default=join(blendz.RESOURCE_PATH, 'templates'),
+                        help='Folder of template set files to pack (the template_set_path).')
+    parser.add_argument('--filters', default=join(blendz.RESOURCE_PATH, 'filters'),
+                        help='Folder of filter folders to pack (the filter_path).')
+    args = parser.parse_args()
+    for pack_path in packTemplateSets(args.templates) + packFilters(args.filters):
+        print(pack_path)
@@ -0,0 +1,4 @@
+from .pool import WorkerPool, sampleParallel
+from .mpi import getComm, rankTasks, rankSavePath, sampleMPI, gatherSamples
+from .work_queue import WorkQueue
+from .scheduler import CostScheduler
@@ -0,0 +1,136 @@
+'''
+Sampling galaxies across the ranks of an MPI job.
+
+In the ``static`` mode, the galaxies are dealt out between the ranks in turn,
+each rank samples its own galaxies, and their results are gathered onto the
+root rank at the end. In the ``dynamic`` mode, the root rank hands out one
+(galaxy index, number of components) task at a time to whichever worker rank
+is idle, longest first as predicted by a CostScheduler, and receives the results
+as they finish, so the ranks stay busy however long each galaxy takes, at the
+cost of the root rank not sampling.
+'''
+from builtins import *
+import time
+try:
+    from mpi4py import MPI
+    MPI_AVAILABLE = True
+except ImportError:
+    MPI_AVAILABLE = False
+from blendz.parallel.scheduler import CostScheduler
+
+MPI_MODES = ['static', 'dynamic']
+ROOT = 0
+#Message tags of the dynamic queue
+READY_TAG = 1
+TASK_TAG = 2
+STOP_TAG = 3
+
+def getComm(mode):
+    '''
+    Return the world communicator for sampling in mode, raising a ValueError
+    if mode is unknown and an ImportError if mpi4py is not installed.
+    '''
+    if mode not in MPI_MODES:
+        raise ValueError('mpi should be one of {}, but got "{}"'.format(MPI_MODES, mode))
+    if not MPI_AVAILABLE:
+        raise ImportError('mpi4py is needed to sample with mpi="{}".'.format(mode))
+    return MPI.COMM_WORLD
+
+def staticTasks(tasks, rank, size):
+    '''
+    Return the tasks of rank when tasks are split between size ranks, with the
+    galaxies dealt out in turn and every task of a galaxy on the same rank.
+    '''
+    galaxies = []
+    for galaxy_index, _ in tasks:
+        if galaxy_index not in galaxies:
+            galaxies.append(galaxy_index)
+    rank_galaxies = set(galaxies[rank::size])
+    return [task for task in tasks if task[0] in rank_galaxies]
+
+def rankTasks(tasks, mode, comm):
+    '''
+    Return the tasks whose results the rank of comm collects, which in
+    the dynamic mode is every task on the root rank and none on the others.
+    '''
+    rank, size = comm.Get_rank(), comm.Get_size()
+    if mode == 'static' or size == 1:
+        return staticTasks(tasks, rank, size)
+    return list(tasks) if rank == ROOT else []
+
+def sampleMPI(photoz, tasks, mode, comm, sample_tasks):
+    '''
+    Sample the tasks of photoz across the ranks of comm in mode, yielding each
+    task that this rank collects (see rankTasks) with the result of
+    Photoz._sampleGalaxy. sample_tasks is a function taking a list of tasks
+    and yielding (task, result) pairs in this process.
+    '''
+    if mode == 'static' or comm.Get_size() == 1:
+        for result in sample_tasks(staticTasks(tasks, comm.Get_rank(), comm.Get_size())):
+            yield result
+    elif comm.Get_rank() == ROOT:
+        for result in _dispatchTasks(photoz, tasks, comm):
+            yield result
+    else:
+        _workOnTasks(photoz, comm, sample_tasks)
+
+def _dispatchTasks(photoz, tasks, comm):
+    #Reply to each worker ready for a task (with the result of its last one,
+    #if any, its runtime and the prior normalisations it added) with the next
+    #task, or tell it to stop once none are left
+    scheduler = CostScheduler.fromPhotoz(photoz, tasks)
+    status = MPI.Status()
+    num_pending = len(tasks)
+    num_stopped = 0
+    while num_stopped < comm.Get_size() - 1:
+        result, runtime, prior_norms = comm.recv(source=MPI.ANY_SOURCE, tag=READY_TAG, status=status)
+        photoz.prior_norm_cache.update(prior_norms)
+        if result is not None:
+            scheduler.observe(result[0], runtime)
+            yield result
+        worker = status.Get_source()
+        if num_pending:
+            comm.send(scheduler.pop(), dest=worker, tag=TASK_TAG)
+            num_pending -= 1
+        else:
+            comm.send(None, dest=worker, tag=STOP_TAG)
+            num_stopped += 1
+
+def _workOnTasks(photoz, comm, sample_tasks):
+    status = MPI.Status()
+    result = None
+    runtime = None
+    while True:
+        comm.send((result, runtime, photoz.prior_norm_cache.popAdded()), dest=ROOT, tag=READY_TAG)
+        task = comm.recv(source=ROOT, tag=MPI.ANY_TAG, status=status)
+        if status.Get_tag() == STOP_TAG:
+            return
+        start_time = time.time()
+        for result in sample_tasks([task]):
+            pass
+        runtime = time.time() - start_time
+
+def gatherSamples(photoz, tasks, mode, comm):
+    '''
+    Gather the results of the static mode onto the root rank of comm, where
+    every task's results are stored in photoz, along with the prior
+    normalisations added to the cache of each rank, so the root saves them all.
+    '''
+    if mode != 'static' or comm.Get_size() == 1:
+        return
+    local_results = [(task, photoz._taskResults(*task)) for task in rankTasks(tasks, mode, comm)]
+    gathered = comm.gather((local_results, photoz.prior_norm_cache.popAdded()), root=ROOT)
+    if comm.Get_rank() == ROOT:
+        for rank_results, prior_norms in gathered:
+            for task, result in rank_results:
+                photoz._storeTaskResults(task, result)
+            photoz.prior_norm_cache.update(prior_norms)
+
+def rankSavePath(save_path, comm):
+    '''
+    Return the path each rank of comm saves its partial results to, which
+    is save_path itself on the root rank.
+    '''
+    if comm.Get_rank() == ROOT:
+        return save_path
+    return '{}.rank{}'.format(save_path, comm.Get_rank())
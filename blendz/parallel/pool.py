@@ -0,0 +1,151 @@
+'''
+Sampling galaxies in a pool of processes.
+
+Each worker process holds its own copy of the Photoz object, restored from its
+saved state when the worker starts, and samples (galaxy index, number of
+components) tasks with Photoz._sampleGalaxy. Only the tasks and their results,
+with any prior normalisations added to the worker's cache, are sent between
+processes. Tasks are handed out one at a time as workers become
+free, longest first as predicted by a CostScheduler. A WorkerPool can be kept for
+several lists of tasks, so its processes are only started once.
+'''
+from builtins import *
+import io
+import time
+import traceback
+from multiprocessing import Pool
+try:
+    #Python 3
+    from queue import Queue, Empty
+except ImportError:
+    #Python 2
+    from Queue import Queue, Empty
+from blendz.parallel.scheduler import CostScheduler
+
+#The Photoz object of each worker process, set up once by _initWorker
+_worker_photoz = None
+#Seconds between checks for failed tasks and dead workers while waiting for results
+POLL_INTERVAL = 1.
+
+def photozState(photoz):
+    '''Return the state of photoz as saved by Photoz.saveState, as bytes.'''
+    f = io.BytesIO()
+    photoz._dumpState(f)
+    return f.getvalue()
+
+def restorePhotoz(photoz_class, state):
+    '''Return a new instance of photoz_class from the bytes given by photozState.'''
+    photoz = photoz_class.__new__(photoz_class)
+    photoz._loadState(io.BytesIO(state))
+    return photoz
+
+def _initWorker(photoz_class, state):
+    global _worker_photoz
+    _worker_photoz = restorePhotoz(photoz_class, state)
+
+def _sampleTask(args):
+    #Return the task, its result, its runtime, the prior normalisations it
+    #added to the worker's cache, and the traceback of any error, which is
+    #raised again in the main process
+    task, kwargs = args
+    galaxy_index, num_components = task
+    start_time = time.time()
+    try:
+        result = _worker_photoz._sampleGalaxy(galaxy_index, num_components, **kwargs)
+    except Exception:
+        return task, None, None, None, traceback.format_exc()
+    return task, result, time.time() - start_time, _worker_photoz.prior_norm_cache.popAdded(), None
+
+def _checkRunning(pool, worker_pids, running):
+    #The callback is never called for a task whose result couldn't be sent
+    #back, or whose worker died, so raise an error for these instead of
+    #waiting for them forever
+    for task, async_result in running.items():
+        if async_result.ready() and not async_result.successful():
+            try:
+                async_result.get()
+            except Exception as error:
+                raise RuntimeError('Sampling galaxy {} with {} components failed: {!r}'.format(task[0], task[1], error))
+    if any(process.exitcode is not None for process in pool._pool) or \
+            not worker_pids.issubset(process.pid for process in pool._pool):
+        raise RuntimeError('A worker process stopped (e.g., it ran out of memory) while sampling '
+                           + 'galaxies {}.'.format(sorted(task[0] for task in running)))
+
+class WorkerPool(object):
+    '''
+    A pool of workers processes, each holding a copy of photoz as it was when
+    the processes were started by the first call to sample, which can sample
+    any number of lists of tasks before it is closed, e.g., each chunk of a
+    WorkQueue or each task sent by MPI. Use it as a context manager, or call
+    close, to stop the processes.
+    '''
+    def __init__(self, photoz, workers):
+        self.photoz = photoz
+        self.num_workers = max(1, workers)
+        self.pool = None
+
+    def _start(self):
+        self.pool = Pool(self.num_workers, initializer=_initWorker,
+                         initargs=(type(self.photoz), photozState(self.photoz)))
+        self.worker_pids = set(process.pid for process in self.pool._pool)
+
+    def sample(self, tasks, **kwargs):
+        '''
+        Sample each (galaxy index, number of components) task, yielding each
+        task with the result of Photoz._sampleGalaxy in the order they finish.
+        Any keyword arguments are passed to Photoz._sampleGalaxy.
+        '''
+        if self.pool is None:
+            self._start()
+        scheduler = CostScheduler.fromPhotoz(self.photoz, tasks)
+        finished = Queue()
+        num_pending = len(tasks)
+        running = {}
+        try:
+            while num_pending or running:
+                #Keep one task per worker, so each is chosen with the latest runtimes
+                while num_pending and len(running) < self.num_workers:
+                    task = scheduler.pop()
+                    num_pending -= 1
+                    running[task] = self.pool.apply_async(_sampleTask, ((task, kwargs),), callback=finished.put)
+                try:
+                    task, result, runtime, prior_norms, error = finished.get(timeout=POLL_INTERVAL)
+                except Empty:
+                    _checkRunning(self.pool, self.worker_pids, running)
+                    continue
+                del running[task]
+                if error is not None:
+                    raise RuntimeError('Sampling galaxy {} with {} components failed:\n{}'.format(task[0], task[1], error))
+                scheduler.observe(task, runtime)
+                #Keep the worker's prior normalisations, so the cache saved by this process has them
+                self.photoz.prior_norm_cache.update(prior_norms)
+                yield task, result
+        except GeneratorExit:
+            #Stopped early, e.g., when a WorkQueue chunk was taken over, so stop the
+            #workers busy with tasks nobody waits for, starting again when needed
+            if running:
+                self.close()
+            raise
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def sampleParallel(photoz, tasks, workers, **kwargs):
+    '''
+    Sample each (galaxy index, number of components) task of photoz in a pool
+    of workers processes, yielding each task with the result of
+    Photoz._sampleGalaxy in the order they finish. Any keyword arguments
+    are passed to Photoz._sampleGalaxy.
+    '''
+    with WorkerPool(photoz, min(workers, len(tasks))) as pool:
+        for task_result in pool.sample(tasks, **kwargs):
+            yield task_result
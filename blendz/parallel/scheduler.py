@@ -0,0 +1,143 @@
+'''
+Ordering sampling tasks by their expected runtime, to balance a pool of workers.
+
+The runtime of nested sampling varies by orders of magnitude between tasks. The
+number of iterations grows with the information gained from the prior to the
+posterior, and each posterior evaluation sums over num_templates**num_components
+template combinations. The log-runtime of each task is therefore predicted as a
+linear function of a few cheap features:
+
+    [1, num_components * log(num_templates), log(1 + H), log(S/N)]
+
+Here H is the information of the single component likelihood on a coarse grid of
+redshifts and templates, relative to a uniform distribution, and S/N is the
+signal-to-noise ratio in the reference band. Handing out the longest tasks first
+stops a few long tasks at the end from leaving the other workers idle. The
+weights start at a rough guess, and are refitted to the observed runtimes as
+tasks finish, by least squares regularised towards that guess. The normal
+equations are accumulated as runtimes arrive, and the remaining tasks are only
+ranked again now and then, so scheduling costs little per task for catalogues of
+any size.
+'''
+from builtins import *
+import numpy as np
+
+
+class CostScheduler(object):
+    '''
+    Predicts the runtime of (galaxy index, number of components) tasks, and
+    hands out the longest remaining task first.
+
+    Use CostScheduler.fromPhotoz to calculate the features of the tasks of
+    a Photoz object.
+
+    Args:
+        tasks (list of tuples): The (galaxy index, number of components) tasks.
+
+        features (numpy.array): The features of each task, with shape
+            (len(tasks), 4).
+    '''
+    #Weights of the features before any runtimes are observed
+    prior_weights = np.array([0., 1., 1., 0.])
+    #Strength of the regularisation towards prior_weights, in units of
+    #observed tasks
+    regularisation = 1.
+    #Redshifts of the grid of the single component likelihood scan
+    num_scan_redshifts = 200
+    #The remaining tasks are ranked again after the first few observed runtimes
+    #(at each power of two) and then after every rerank_interval of them
+    rerank_interval = 2000
+
+    def __init__(self, tasks, features):
+        self.tasks = list(tasks)
+        self.features = np.asarray(features, dtype=float)
+        self._rows = dict((task, row) for row, task in enumerate(self.tasks))
+        self._remaining = np.ones(len(self.tasks), dtype=bool)
+        num_features = len(self.prior_weights)
+        #Normal equations of the observed runtimes, accumulated as they arrive,
+        #and only solved when the weights are next needed
+        self._xtx = np.zeros((num_features, num_features))
+        self._xty = np.zeros(num_features)
+        #The constant isn't regularised, as it only sets the units
+        self._penalty = self.regularisation * np.diag([0.] + [1.] * (num_features - 1))
+        self._weights = self.prior_weights.copy()
+        self._weights_fitted = True
+        self.num_observed = 0
+        self._rank()
+
+    @classmethod
+    def fromPhotoz(cls, photoz, tasks):
+        '''Return a CostScheduler of the tasks of the Photoz object photoz.'''
+        galaxy_features = cls._galaxyFeatures(photoz, set(task[0] for task in tasks))
+        log_num_templates = np.log(photoz.responses.templates.num_templates)
+        features = [[1., num_components * log_num_templates] + list(galaxy_features[galaxy_index])
+                    for galaxy_index, num_components in tasks]
+        return cls(tasks, np.reshape(features, (len(tasks), len(cls.prior_weights))))
+
+    @classmethod
+    def _galaxyFeatures(cls, photoz, galaxy_indices):
+        #Return log(1 + H) and log(S/N) of each galaxy
+        config = photoz.config
+        redshifts = np.linspace(max(config.z_lo, 1e-3), config.z_hi, cls.num_scan_redshifts)
+        #Shape = (N_template, N_band, N_redshift)
+        model_fluxes = photoz.responses.interp(redshifts)
+        ref_model_flux = np.sum(model_fluxes[:, config.ref_band, :], axis=1)
+        non_ref_model_fluxes = model_fluxes[:, config.non_ref_bands, :]
+        features = {}
+        for galaxy_index in galaxy_indices:
+            galaxy = photoz.photometry.all_galaxies[galaxy_index]
+            ref_flux = np.sum(galaxy.ref_flux_data)
+            ref_sigma = np.sqrt(np.sum(galaxy.ref_flux_sigma**2))
+            #Scale each template to the observed reference flux
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scaled = non_ref_model_fluxes * (ref_flux / ref_model_flux)[:, np.newaxis, :]
+                chi_sq = np.sum(((scaled - galaxy.flux_data_noRef[np.newaxis, :, np.newaxis]) /
+                                 galaxy.flux_sigma_noRef[np.newaxis, :, np.newaxis])**2, axis=1)
+            chi_sq = np.where(np.isfinite(chi_sq), chi_sq, np.inf)
+            information = 0.
+            if np.any(np.isfinite(chi_sq)):
+                prob = np.exp(-0.5 * (chi_sq - np.min(chi_sq)))
+                prob = prob[prob > 0.] / np.sum(prob)
+                information = np.sum(prob * np.log(prob * chi_sq.size))
+            features[galaxy_index] = (np.log(1. + information), np.log(max(ref_flux / ref_sigma, 1e-3)))
+        return features
+
+    @property
+    def weights(self):
+        '''The weights of the features, fitted to the runtimes observed so far.'''
+        if not self._weights_fitted:
+            self._weights = np.linalg.solve(self._xtx + self._penalty + 1e-12 * np.eye(len(self._xty)),
+                                            self._xty + np.dot(self._penalty, self.prior_weights))
+            self._weights_fitted = True
+        return self._weights
+
+    def predict(self, task):
+        '''Return the predicted log-runtime of task, up to a constant.'''
+        return np.dot(self.weights, self.features[self._rows[task]])
+
+    def _rank(self):
+        #Order the remaining tasks by increasing predicted runtime, so that
+        #the longest is popped off the end first
+        rows = np.flatnonzero(self._remaining)
+        predictions = np.dot(self.features[rows], self.weights)
+        self._order = rows[np.argsort(predictions)].tolist()
+
+    def pop(self):
+        '''Return the remaining task with the longest predicted runtime, or None if there are none.'''
+        while self._order:
+            row = self._order.pop()
+            if self._remaining[row]:
+                self._remaining[row] = False
+                return self.tasks[row]
+        return None
+
+    def observe(self, task, runtime):
+        '''Record the runtime of task in seconds.'''
+        x = self.features[self._rows[task]]
+        self._xtx += x[:, np.newaxis] * x[np.newaxis, :]
+        self._xty += x * np.log(max(runtime, 1e-6))
+        self._weights_fitted = False
+        self.num_observed += 1
+        is_power_of_two = (self.num_observed & (self.num_observed - 1)) == 0
+        if is_power_of_two or self.num_observed % self.rerank_interval == 0:
+            self._rank()
@@ -0,0 +1,244 @@
+'''
+A work queue on a shared filesystem, for sampling with independent batch jobs.
+
+Every worker started on the same catalogue and settings splits the
+(galaxy index, number of components) tasks into the same chunks of galaxies. The
+queue directory holds a manifest of the chunks, written by the first worker, and
+for each chunk a claim file while a worker holds it and a results file once it
+is done:
+
+    <queue_path>/manifest.pkl
+    <queue_path>/chunk_000012.claim
+    <queue_path>/chunk_000012.pkl
+
+A chunk is claimed by creating its claim file exclusively, so only one worker
+can hold it. Each worker starts looking for a chunk to claim at a random chunk,
+and then carries on from the last chunk it claimed, remembering which chunks it
+has seen done, so claiming a chunk only checks a few files however many chunks
+there are. The holder renews its lease by touching the claim file after each
+task, and a claim that hasn't been touched for lease_timeout seconds is taken
+over by another worker, so the chunks of a worker that died are sampled again.
+Results are written to a temporary file and moved into place, so a results file
+is only ever seen complete.
+'''
+from builtins import *
+import os
+import time
+import socket
+import random
+import dill
+
+
+class WorkQueue(object):
+    '''
+    A queue of chunks of tasks in the directory queue_path, shared by any
+    number of workers.
+
+    Args:
+        queue_path (str): Directory of the queue, created if it doesn't exist.
+
+        tasks (list of tuples): The (galaxy index, number of components) tasks.
+            Every worker on the same queue must have the same tasks.
+
+        galaxies_per_chunk (int or None): Galaxies in each chunk, which must be
+            the same for every worker. Defaults to the class attribute if None.
+
+        lease_timeout (float or None): Seconds since a claim was last renewed
+            before other workers may take it over. Defaults to the class
+            attribute if None.
+    '''
+    #Galaxies in each chunk of tasks
+    galaxies_per_chunk = 10
+    #Seconds since a claim was last renewed before other workers may take it,
+    #which must be longer than sampling a single task takes
+    lease_timeout = 3600.
+    #Seconds to wait before trying again when every remaining chunk is claimed
+    poll_interval = 10.
+
+    def __init__(self, queue_path, tasks, galaxies_per_chunk=None, lease_timeout=None):
+        self.queue_path = queue_path
+        if galaxies_per_chunk is not None:
+            self.galaxies_per_chunk = galaxies_per_chunk
+        if lease_timeout is not None:
+            self.lease_timeout = lease_timeout
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        if not os.path.isdir(queue_path):
+            try:
+                os.makedirs(queue_path)
+            except OSError:
+                #Another worker made it first
+                if not os.path.isdir(queue_path):
+                    raise
+        self.chunks = self._loadManifest(self.chunkTasks(tasks, self.galaxies_per_chunk))
+        #Chunks known to be done, which can't become undone
+        self._done = set()
+        #The chunk to start looking for one to claim from, spread out so that
+        #workers starting together don't all try the same chunks
+        self._cursor = random.randrange(len(self.chunks)) if len(self.chunks) > 0 else 0
+
+    @staticmethod
+    def chunkTasks(tasks, galaxies_per_chunk):
+        '''Split tasks into chunks of galaxies_per_chunk galaxies, in order.'''
+        chunks = []
+        galaxies = []
+        for task in tasks:
+            if task[0] not in galaxies:
+                if len(galaxies) % galaxies_per_chunk == 0:
+                    chunks.append([])
+                galaxies.append(task[0])
+            chunks[-1].append(task)
+        return chunks
+
+    def _loadManifest(self, chunks):
+        #Write the manifest if this is the first worker, then check that every
+        #worker has the same chunks
+        manifest_path = os.path.join(self.queue_path, 'manifest.pkl')
+        if not os.path.exists(manifest_path):
+            tmp_path = self._tmpPath(manifest_path)
+            with open(tmp_path, 'wb') as f:
+                dill.dump(chunks, f)
+            try:
+                #Unlike rename, link fails if another worker wrote the manifest first
+                os.link(tmp_path, manifest_path)
+            except OSError:
+                pass
+            os.remove(tmp_path)
+        with open(manifest_path, 'rb') as f:
+            queue_chunks = dill.load(f)
+        if queue_chunks != chunks:
+            raise ValueError('The tasks of the queue at {} are different, so it '.format(self.queue_path)
+                             + 'was made with a different catalogue or settings.')
+        return queue_chunks
+
+    def _tmpPath(self, path):
+        return '{}.tmp.{}'.format(path, self.worker_id.replace(':', '.'))
+
+    def _claimPath(self, chunk):
+        return os.path.join(self.queue_path, 'chunk_{:06d}.claim'.format(chunk))
+
+    def _resultsPath(self, chunk):
+        return os.path.join(self.queue_path, 'chunk_{:06d}.pkl'.format(chunk))
+
+    def isDone(self, chunk):
+        if chunk in self._done:
+            return True
+        if os.path.exists(self._resultsPath(chunk)):
+            self._done.add(chunk)
+            return True
+        return False
+
+    def allDone(self):
+        #Stops at the first chunk not done, and skips those known to be done
+        return all(self.isDone(chunk) for chunk in range(len(self.chunks)))
+
+    def _createClaim(self, chunk):
+        try:
+            fd = os.open(self._claimPath(chunk), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+        os.write(fd, self.worker_id.encode('utf-8'))
+        os.close(fd)
+        return True
+
+    def _isExpired(self, chunk):
+        try:
+            return time.time() - os.path.getmtime(self._claimPath(chunk)) > self.lease_timeout
+        except OSError:
+            #The claim was released in the meantime
+            return False
+
+    def claim(self):
+        '''
+        Claim the next chunk, after the last one this worker claimed, that is
+        neither done nor held by another worker, taking over expired claims,
+        and return its index, or None if there is no such chunk.
+        '''
+        for offset in range(len(self.chunks)):
+            chunk = (self._cursor + offset) % len(self.chunks)
+            if self._tryClaim(chunk):
+                self._cursor = chunk + 1
+                return chunk
+        return None
+
+    def _tryClaim(self, chunk):
+        if self.isDone(chunk):
+            return False
+        if self._createClaim(chunk):
+            #The chunk may have been finished since it was checked
+            if self.isDone(chunk):
+                self.release(chunk)
+                return False
+            return True
+        if self._isExpired(chunk):
+            #Only one worker can move the expired claim out of the way
+            try:
+                os.rename(self._claimPath(chunk), self._tmpPath(self._claimPath(chunk)))
+            except OSError:
+                return False
+            os.remove(self._tmpPath(self._claimPath(chunk)))
+            return self._createClaim(chunk)
+        return False
+
+    def holds(self, chunk):
+        '''Return whether this worker still holds the claim on chunk.'''
+        try:
+            with open(self._claimPath(chunk), 'rb') as f:
+                return f.read().decode('utf-8') == self.worker_id
+        except (IOError, OSError):
+            return False
+
+    def renew(self, chunk):
+        '''
+        Renew the lease on chunk, returning False if it was taken over by
+        another worker in the meantime.
+        '''
+        if not self.holds(chunk):
+            return False
+        os.utime(self._claimPath(chunk), None)
+        return True
+
+    def release(self, chunk):
+        if self.holds(chunk):
+            os.remove(self._claimPath(chunk))
+
+    def complete(self, chunk, results):
+        '''Write the list of (task, result) pairs of chunk and release it.'''
+        results_path = self._resultsPath(chunk)
+        tmp_path = self._tmpPath(results_path)
+        with open(tmp_path, 'wb') as f:
+            dill.dump(results, f)
+        os.rename(tmp_path, results_path)
+        self._done.add(chunk)
+        self.release(chunk)
+
+    def results(self):
+        '''Yield the (task, result) pairs of every chunk that is done.'''
+        for chunk in range(len(self.chunks)):
+            if self.isDone(chunk):
+                with open(self._resultsPath(chunk), 'rb') as f:
+                    for result in dill.load(f):
+                        yield result
+
+    def sample(self, sample_tasks):
+        '''
+        Claim and sample chunks until every chunk is done, waiting for chunks
+        claimed by other workers to be done or to expire, and yield the
+        (task, result) pairs this worker samples. sample_tasks is a function
+        taking a list of tasks and yielding (task, result) pairs.
+        '''
+        while True:
+            chunk = self.claim()
+            if chunk is None:
+                if self.allDone():
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            chunk_results = []
+            for result in sample_tasks(self.chunks[chunk]):
+                #Give up on the chunk if another worker took it over
+                if not self.renew(chunk):
+                    break
+                chunk_results.append(result)
+                yield result
+            else:
+                self.complete(chunk, chunk_results)
@@ -196,17 +196,19 @@ class SimulatedPhotometry(PhotometryBase):
         num_components = num_params // 3
         out_shape = (num_sims, self.responses.filters.num_filters)
         true_flux = np.zeros(out_shape)
-        for g in range(num_sims):
-            for c in range(num_components):
-                zc = params[g, c]
-                tc = int(params[g, num_components + c])
-                mc = params[g, (2*num_components) + c]
-                resp_c = self.responses.interp(zc)[tc, :]
-                if len(self.config.ref_band)==1:
-                    norm = (10.**(-0.4 * mc)) / resp_c[self.config.ref_band]
-                else:
-                    norm = (10.**(-0.4 * mc)) / resp_c[self.config.ref_band[c]]
-                true_flux[g, :] += resp_c * norm * self.model.mc_map_matrix[c, :]
+        #Interpolation buffer, shape = (N_template, N_band, num_sims)
+        all_resp = np.empty((self.responses.templates.num_templates, out_shape[1], num_sims))
+        for c in range(num_components):
+            zc = params[:, c]
+            tc = params[:, num_components + c].astype(int)
+            mc = params[:, (2*num_components) + c]
+            #Responses of every galaxy's component c, shape = (num_sims, N_band)
+            resp_c = self.responses.interp(zc, out=all_resp)[tc, :, np.arange(num_sims)]
+            if len(self.config.ref_band)==1:
+                norm = (10.**(-0.4 * mc)) / resp_c[:, self.config.ref_band[0]]
+            else:
+                norm = (10.**(-0.4 * mc)) / resp_c[:, self.config.ref_band[c]]
+            true_flux += resp_c * norm[:, np.newaxis] * self.model.mc_map_matrix[c, :]
 
         #Errors
         if self.flux_error is not None:
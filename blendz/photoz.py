@@ -10,9 +10,9 @@ import os
 import warnings
 from math import ceil
 from multiprocessing import cpu_count
-import itertools as itr
 import numpy as np
 from scipy.integrate import simps
+from scipy.special import logsumexp
 import nestle
 import emcee
 from tqdm import tqdm
@@ -20,6 +20,10 @@ import dill
 import blendz
 from blendz import Configuration
 from blendz.fluxes import Responses
+from blendz.likelihood import FluxLikelihood
+from blendz.normalisation import PriorQuadrature, PriorNormCache
+from blendz.parallel import WorkerPool, getComm, rankTasks, rankSavePath, sampleMPI, gatherSamples, \
+                            WorkQueue
 from blendz.photometry import Photometry, SimulatedPhotometry
 from blendz.utilities import incrementCount, Silence
 
@@ -37,6 +41,13 @@ except (SystemExit, OSError):
 
 
 class Photoz(object):
+    #Upper limit in bytes on the arrays built for each chunk of template
+    #combinations when marginalising over templates
+    combination_chunk_bytes = 2**23
+    #Upper limit on the number of elements of the arrays over quadrature nodes
+    #when normalising the prior, before falling back to nested sampling
+    max_prior_quadrature_points = 2**22
+
     def __init__(self, model=None, photometry=None, config=None,\
                  load_state_path=None, **kwargs):
         if load_state_path is not None:
@@ -120,15 +131,31 @@ class Photoz(object):
         Args:
             filepath (str): Path to file to save to.
         """
+        #Write to a temporary file first, so an interrupted save (or several
+        #processes saving at once) can't leave a broken file at filepath
+        tmp_path = '{}.tmp.{}'.format(filepath, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                self._dumpState(f)
+            os.rename(tmp_path, filepath)
+        finally:
+            #Don't leave a partial save behind if writing it failed, e.g., disk full
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def loadState(self, filepath):
+        with open(filepath, 'rb') as f:
+            self._loadState(f)
+
+    def _dumpState(self, f):
         if isinstance(self.photometry, SimulatedPhotometry):
             try:
                 current_seed = self.photometry.sim_seed.next()
                 self.photometry.sim_seed = current_seed
             except:
                 warnings.warn('SimulatedPhotometry seed not saved.')
-        with open(filepath, 'wb') as f:
-            state = {key: val for key, val in self.__dict__.items() if key not in ['pbar', 'breakSilence']}
-            dill.dump(state, f)
+        state = {key: val for key, val in self.__dict__.items() if key not in ['pbar', 'breakSilence']}
+        dill.dump(state, f)
         #Put the random seed back how it was after the saving is done
         if isinstance(self.photometry, SimulatedPhotometry):
             try:
@@ -136,9 +163,8 @@ class Photoz(object):
             except:
                 pass
 
-    def loadState(self, filepath):
-        with open(filepath, 'rb') as f:
-            self.__dict__.update(dill.load(f))
+    def _loadState(self, f):
+        self.__dict__.update(dill.load(f))
         #If the photometry is simulated, replace the seed currently saved as
         #a number with the generator it was before saving
         if isinstance(self.photometry, SimulatedPhotometry):
@@ -149,7 +175,9 @@ class Photoz(object):
                 warnings.warn('SimulatedPhotometry seed not loaded.')
 
     def _lnLikelihood_flux(self, model_flux):
-        chi_sq = -1. * np.sum((self.photometry.current_galaxy.flux_data_noRef - model_flux)**2 / self.photometry.current_galaxy.flux_sigma_noRef**2)
+        #model_flux can be a single set of fluxes or an array of shape (N, N_band),
+        #in which case an array of N likelihoods is returned
+        chi_sq = -1. * np.sum((self.photometry.current_galaxy.flux_data_noRef - model_flux)**2 / self.photometry.current_galaxy.flux_sigma_noRef**2, axis=-1)
         return chi_sq
 
     def _lnLikelihood_mag(self, total_ref_flux):
@@ -169,6 +197,80 @@ class Photoz(object):
         chi_sq = -1. * np.sum((self.photometry.current_galaxy.ref_flux_data - total_ref_flux)**2 / self.photometry.current_galaxy.ref_flux_sigma**2)
         return chi_sq
 
+    def _combinationChunkLength(self, num_components):
+        '''
+        Number of template combinations to evaluate at once so that the arrays
+        built for each chunk stay below combination_chunk_bytes. Each combination
+        needs a blended flux in every band plus a template index per component.
+        '''
+        bytes_per_combination = 8 * (self.num_measurements + num_components + 4)
+        return max(1, int(self.combination_chunk_bytes // bytes_per_combination))
+
+    def _templateCombinations(self, num_components):
+        '''
+        Generator over every combination of templates for num_components components,
+        in the same order as itertools.product. Each item is a chunk of combinations
+        given as a tuple of num_components index arrays, where element nb holds the
+        template index of component nb for each combination in the chunk.
+        '''
+        num_combinations = self.num_templates ** num_components
+        chunk_len = self._combinationChunkLength(num_components)
+        combination_shape = (self.num_templates,) * num_components
+        for start in range(0, num_combinations, chunk_len):
+            stop = min(start + chunk_len, num_combinations)
+            yield np.unravel_index(np.arange(start, stop), combination_shape)
+
+    def _componentScalings(self, model_fluxes, magnitudes):
+        '''
+        Return the scaling of each template for each component, shape
+        (N_template, N_component), that gives the template fluxes from
+        Responses.interp (shape (N_template, N_band, N_component)) the
+        reference-band flux set by the magnitude of that component.
+        '''
+        num_components = len(magnitudes)
+        if len(self.config.ref_band)==1:
+            #Only one reference band but it's still an array, so get element
+            ref_fluxes = model_fluxes[:, self.config.ref_band[0], :]
+        else:
+            ref_fluxes = model_fluxes[:, self.config.ref_band, np.arange(num_components)]
+        return 10.**(-0.4*magnitudes) / ref_fluxes
+
+    def _componentFluxes(self, model_fluxes, magnitudes):
+        '''
+        Scale the template fluxes from Responses.interp, shape
+        (N_template, N_band, N_component), so that each template has the
+        reference-band flux given by the magnitude of that component, and
+        remove each component from the measurements it is not present in.
+        '''
+        component_scaling = self._componentScalings(model_fluxes, magnitudes)
+        return model_fluxes * component_scaling[:, np.newaxis, :] * \
+               self.model.mc_map_matrix.T[np.newaxis, :, :]
+
+    def _galaxyFluxLikelihood(self):
+        '''
+        Return the FluxLikelihood of the current galaxy, which holds the
+        whitened flux data, creating it if the galaxy has changed.
+        '''
+        galaxy = self.photometry.current_galaxy
+        try:
+            cached_galaxy, flux_likelihood = self._flux_likelihood_cache
+        except AttributeError:
+            cached_galaxy = None
+        if cached_galaxy is not galaxy:
+            flux_likelihood = FluxLikelihood(galaxy.flux_data_noRef, galaxy.flux_sigma_noRef)
+            self._flux_likelihood_cache = (galaxy, flux_likelihood)
+        return flux_likelihood
+
+    def _blendFlux(self, component_fluxes, template_combos):
+        '''
+        Sum the scaled component fluxes of each template combination in the chunk
+        template_combos, returning an array of shape (N_combination, N_band).
+        '''
+        blend_flux = component_fluxes[template_combos[0], :, 0]
+        for nb in range(1, len(template_combos)):
+            blend_flux = blend_flux + component_fluxes[template_combos[nb], :, nb]
+        return blend_flux
+
     def _lnPosterior(self, params):
         num_components = int(len(params) // 2)
         redshifts = params[:num_components]
@@ -177,15 +279,18 @@ class Photoz(object):
         if not self.model._obeyPriorConditions(redshifts, magnitudes, self.photometry.current_galaxy.ref_mag_hi):
             return -np.inf
         else:
-            #Precalculate all quantities we'll need in the template loop
+            #Precalculate all quantities we'll need in the template sum
             #Single interp call -> Shape = (N_template, N_band, N_component)
             model_fluxes = self.responses.interp(redshifts)
 
-            priors = np.zeros((num_components, self.num_types))
-            for nb in range(num_components):
-                priors[nb, :] = self.model.lnPrior(redshifts[nb], magnitudes[nb])
-
-            redshift_correlation = np.log(1. + self.model.correlationFunction(redshifts))
+            #A flat prior has no prior or clustering terms to evaluate
+            flat_prior = self.model.flat_prior
+            if flat_prior:
+                redshift_correlation = 0.
+            else:
+                #Shape = (N_component, N_type)
+                priors = self.model.lnPriorArray(redshifts, magnitudes)
+                redshift_correlation = np.log(1. + self.model.correlationFunction(redshifts))
 
             #Get total flux in reference band  = transform to flux & sum
             # total_ref_flux should be either len 1 or len==num_components
@@ -196,57 +301,59 @@ class Photoz(object):
             else:
                 total_ref_flux = 10.**(-0.4 * magnitudes) #Array with len==len(magnitudes)
 
+            #Terms that are the same for every template combination
+            lnConstant = redshift_correlation + self._lnLikelihood_mag(total_ref_flux)
+
             #Check whether the selection band is ref or not
-            #Only need this if it is
-            if np.all(self.config.ref_band == self.config.select_band):
-                selection_effect_ref = self.model.lnSelection(total_ref_flux,
+            #If it is, a single selection effect applies to every template combination
+            select_is_ref = np.all(self.config.ref_band == self.config.select_band)
+            if select_is_ref:
+                lnConstant += self.model.lnSelection(total_ref_flux,
                         self.photometry.current_galaxy)
 
-            #Loop over all templates - discrete marginalisation
-            #All log probabilities so (multiply -> add) and (add -> logaddexp)
+            #Remove each component from the measurements it is not present in
+            #Shape = (N_template, N_band, N_component)
+            mapped_fluxes = model_fluxes * self.model.mc_map_matrix.T[np.newaxis, :, :]
+            #Shape = (N_template, N_component)
+            component_scaling = self._componentScalings(model_fluxes, magnitudes)
+            #Prior of each template for each component, shape = (N_template, N_component)
+            if not flat_prior:
+                template_priors = priors[:, self.tmp_ind_to_type_ind].T
+
+            #Precompute the template cross-products of the flux likelihood
+            #Remove ref_band from the fluxes, as that goes into the ref-mag
+            #likelihood, not the flux likelihood
+            flux_likelihood = self._galaxyFluxLikelihood()
+            flux_likelihood.setTemplates(mapped_fluxes[:, self.config.non_ref_bands, :])
+
+            #If the selection band is not ref, we need the template fluxes in it
+            if not select_is_ref:
+                select_fluxes = mapped_fluxes[:, self.config.select_band, :] * \
+                                component_scaling[:, np.newaxis, :]
+
+            #Sum over all templates - discrete marginalisation
+            #All log probabilities so (multiply -> add) and (add -> logsumexp)
             lnProb = -np.inf
 
-            #At each iteration template_combo is a tuple of (T_1, T_2... T_num_components)
-            for template_combo in itr.product(*itr.repeat(range(self.num_templates), num_components)):
-                #One redshift/template/magnitude prior and model flux for each blend component
-                tmp = 0.
-                blend_flux = np.zeros(self.num_measurements)
-                component_scaling_norm = 0.
-                for nb in range(num_components):
-                    T = template_combo[nb]
-                    #TODO: Check this!
-                    if len(self.config.ref_band)==1:
-                        #Only one reference band but it's still an array, so get element
-                        component_scaling = 10.**(-0.4*magnitudes[nb]) / model_fluxes[T, self.config.ref_band[0], nb]
-                    else:
-                        component_scaling = 10.**(-0.4*magnitudes[nb]) / model_fluxes[T, self.config.ref_band[nb], nb]
-                    blend_flux += model_fluxes[T, :, nb] * component_scaling * self.model.mc_map_matrix[nb, :]
-                    type_ind = self.tmp_ind_to_type_ind[T]
-                    tmp += priors[nb, type_ind]
-
-                #Check whether the selection band is ref or not
-                #If not, we need to use the template fluxes
-                if np.all(self.config.ref_band == self.config.select_band):
-                    tmp += selection_effect_ref
-                else:
-                    select_flux = blend_flux[self.config.select_band]
+            #Each chunk is a tuple of index arrays (T_1, T_2... T_num_components)
+            for template_combos in self._templateCombinations(num_components):
+                #One redshift/template/magnitude prior for each blend component
+                tmp = np.zeros(len(template_combos[0]))
+                if not flat_prior:
+                    for nb in range(num_components):
+                        tmp += template_priors[template_combos[nb], nb]
+
+                if not select_is_ref:
+                    select_flux = self._blendFlux(select_fluxes, template_combos)
                     tmp += self.model.lnSelection(select_flux,
                                                   self.photometry.current_galaxy)
 
-                #Remove ref_band from blend_fluxes, as that goes into the ref-mag
-                #likelihood, not the flux likelihood
-                blend_flux = blend_flux[self.config.non_ref_bands]
-
-                #Other terms only appear once per summation-step
-                tmp += redshift_correlation
-                tmp += self._lnLikelihood_flux(blend_flux)
-                tmp += self._lnLikelihood_mag(total_ref_flux)
-
+                tmp += flux_likelihood.lnLikelihood(template_combos, component_scaling)
 
-                #logaddexp contribution from this template to marginalise
-                lnProb = np.logaddexp(lnProb, tmp)
+                #logsumexp contribution from this chunk of templates to marginalise
+                lnProb = np.logaddexp(lnProb, logsumexp(tmp))
 
-            return lnProb - self.prior_norm
+            return lnProb + lnConstant - self.prior_norm
 
 
     def _priorTransform(self, params):
@@ -316,9 +423,8 @@ class Photoz(object):
             return -np.inf
         else:
 
-            cmp_priors = np.zeros((num_components, self.num_types))
-            for nb in range(num_components):
-                cmp_priors[nb, :] = self.model.lnPrior(redshifts[nb], magnitudes[nb])
+            cmp_priors = self.model.lnPriorArray(redshifts, magnitudes)
+            template_priors = cmp_priors[:, self.tmp_ind_to_type_ind].T
 
             redshift_correlation = np.log(1. + self.model.correlationFunction(redshifts))
 
@@ -329,46 +435,96 @@ class Photoz(object):
 
             #Check whether the selection band is ref or not
             #If it is, we can use a single selection effect for every template
-            if np.all(self.config.ref_band == self.config.select_band):
-                selection_effect_ref = self.model.lnSelection(total_ref_flux,
+            select_is_ref = np.all(self.config.ref_band == self.config.select_band)
+            lnConstant = redshift_correlation
+            if select_is_ref:
+                lnConstant += self.model.lnSelection(total_ref_flux,
                         self.photometry.current_galaxy)
             #If not, we need to use the model fluxes, so get them here
             else:
                 model_fluxes = self.responses.interp(redshifts)
+                component_fluxes = self._componentFluxes(model_fluxes, magnitudes)
 
             lnProb = -np.inf
-            for template_combo in itr.product(*itr.repeat(range(self.num_templates), num_components)):
-                tmp = 0.
-                blend_flux = np.zeros(self.num_measurements)
+            for template_combos in self._templateCombinations(num_components):
+                tmp = np.zeros(len(template_combos[0]))
                 for nb in range(num_components):
-                    T = template_combo[nb]
-                    type_ind = self.tmp_ind_to_type_ind[T]
-                    tmp += cmp_priors[nb, type_ind]
-                    #If selection band is not reference, we need the template fluxes
-                    if not np.all(self.config.ref_band == self.config.select_band):
-                        if len(self.config.ref_band)==1:
-                            #Only one reference band but it's still an array, so get element
-                            component_scaling = 10.**(-0.4*magnitudes[nb]) / model_fluxes[T, self.config.ref_band[0], nb]
-                        else:
-                            component_scaling = 10.**(-0.4*magnitudes[nb]) / model_fluxes[T, self.config.ref_band[nb], nb]
-                        blend_flux += model_fluxes[T, :, nb] * component_scaling * self.model.mc_map_matrix[nb, :]
-
-                #Check whether the selection band is ref or not
-                #If not, we need to use the template fluxes
-                if np.all(self.config.ref_band == self.config.select_band):
-                    tmp += selection_effect_ref
-                else:
-                    select_flux = blend_flux[self.config.select_band]
+                    tmp += template_priors[template_combos[nb], nb]
+
+                #If selection band is not reference, we need the template fluxes
+                if not select_is_ref:
+                    blend_flux = self._blendFlux(component_fluxes, template_combos)
+                    select_flux = blend_flux[:, self.config.select_band]
                     tmp += self.model.lnSelection(select_flux,
                                                   self.photometry.current_galaxy)
-                #Other terms only appear once per summation-step
-                tmp += redshift_correlation
-                lnProb = np.logaddexp(lnProb, tmp)
+                lnProb = np.logaddexp(lnProb, logsumexp(tmp))
+
+            return lnProb + lnConstant
 
-            return lnProb
+    @property #getter, no setter so read-only
+    def prior_quadrature(self):
+        try:
+            return self._prior_quadrature
+        except AttributeError:
+            self._prior_quadrature = PriorQuadrature(self.model, self.config)
+            return self._prior_quadrature
+
+    @property #getter, no setter so read-only
+    def prior_norm_cache(self):
+        try:
+            return self._prior_norm_cache
+        except AttributeError:
+            self._prior_norm_cache = PriorNormCache(self.config.prior_norm_cache_path)
+            return self._prior_norm_cache
+
+    def _quadraturePriorNorm(self, galaxy, num_components):
+        return self.prior_quadrature(galaxy, num_components, self.config.prior_norm_tolerance,
+                                     self.max_prior_quadrature_points)
+
+    def buildPriorNormTable(self, num_components, galaxies=None):
+        '''
+        Tabulate the prior normalisation for num_components over the range of
+        ref_mag_hi, magnitude_limit and select_flux_sigma of galaxies (by default,
+        every galaxy), so that it is interpolated for each galaxy rather than
+        calculated. Returns whether the table could be built within
+        prior_norm_tolerance.
+        '''
+        if galaxies is None:
+            galaxies = list(self.photometry)
+        self.model._setMeasurementComponentMapping(num_components)
+        if not self.prior_quadrature.canIntegrate(num_components):
+            return False
+        fingerprint = self.prior_quadrature.fingerprint(num_components, self.config.prior_norm_tolerance)
+        return self.prior_norm_cache.buildTable(fingerprint, num_components, galaxies,
+                                                self._quadraturePriorNorm,
+                                                self.config.prior_norm_tolerance)
 
     def normalise_prior(self, galind, num_components,
                         npoints=50, seed=False, method='multi'):
+        self.model._setMeasurementComponentMapping(num_components)
+
+        if self.config.prior_norm_method not in ['quadrature', 'nested']:
+            raise ValueError('prior_norm_method should be either "quadrature" or "nested", '
+                             + 'but got "{}"'.format(self.config.prior_norm_method))
+        #The normalisation of a flat prior is analytic apart from the selection
+        #effect, so it is always calculated by quadrature where possible
+        use_quadrature = self.config.prior_norm_method == 'quadrature' or self.model.flat_prior
+        if use_quadrature and self.prior_quadrature.canIntegrate(num_components):
+            galaxy = self.photometry.current_galaxy
+            fingerprint = self.prior_quadrature.fingerprint(num_components, self.config.prior_norm_tolerance)
+            cached = self.prior_norm_cache.get(fingerprint, num_components, galaxy)
+            if cached is not None:
+                self.prior_norm, self.prior_norm_error = cached
+                return
+            prior_norm, prior_norm_error = self._quadraturePriorNorm(galaxy, num_components)
+            if prior_norm_error <= self.config.prior_norm_tolerance:
+                self.prior_norm = prior_norm
+                self.prior_norm_error = prior_norm_error
+                self.prior_norm_cache.add(fingerprint, num_components, galaxy, prior_norm, prior_norm_error)
+                return
+            warnings.warn('The prior for {} components could not be normalised by '.format(num_components)
+                          + 'quadrature to within prior_norm_tolerance, so falling back to nested sampling.')
+
         #Setup random seeding
         if seed is False:
             rstate = np.random.RandomState()
@@ -377,25 +533,26 @@ class Photoz(object):
         else:
             rstate = np.random.RandomState(seed + galind)
 
-        self.model._setMeasurementComponentMapping(num_components)
         results = nestle.sample(self._full_lnPrior, self._priorTransform,
                                 num_components*2, method=method, npoints=npoints,
                                 rstate=rstate)#, callback=self._sampleProgressUpdate)
         self.prior_norm = results.logz
+        self.prior_norm_error = results.logzerr
 
 
     def sample(self, num_components, galaxy=None, nresample=1000, seed=False,
                mc_map_matrix=None, npoints=150, print_interval=10,
-               use_pymultinest=None, save_path=None, save_interval=None):
+               use_pymultinest=None, save_path=None, save_interval=None, workers=1,
+               mpi=False, queue_path=None):
         """Sample the posterior for a particular number of components.
 
         Args:
             num_components (int):
                 Sample the posterior defined for this number of components in the source.
 
-            galaxy (int or None):
-                Index of the galaxy to sample. If None, sample every galaxy in the
-                photometry. Defaults to None.
+            galaxy (int, list of int or None):
+                Index of the galaxy to sample, or a list of indices of galaxies to
+                sample. If None, sample every galaxy in the photometry. Defaults to None.
 
             nresample (int):
                 Number of non-weighted samples to draw from the weighted samples
@@ -428,17 +585,57 @@ class Photoz(object):
 
             save_interval (None or int)
                 If given and save_path is not None, the Photoz object will be
-                saved to save_path every save_interval galaxies. Defaults to None.
+                saved to save_path every time another save_interval galaxies have
+                been sampled (by this process, when using MPI). Defaults to None.
 
             use_pymultinest (bool or None)
                 If True, sample using the pyMultinest sampler. This requires PyMultiNest
                 to be installed separately. If False, sample using the Nestle sampler,
                 which is always installed when blendz is. If None, check whether pyMultinest
                 is installed and use it if it is, otherwise use Nestle. Defaults to None.
+
+            workers (int or None)
+                Number of processes to sample with. If more than 1, each galaxy and
+                number of components is sampled as a separate task in a pool of
+                processes, and with seed set, the results are the same as for a
+                single process. If None, use one process per CPU. Defaults to 1.
+
+            mpi (False or str)
+                If False, every MPI rank samples every galaxy. Otherwise, split the
+                galaxies between the ranks of an MPI job (which requires mpi4py). If
+                'static', the galaxies are dealt out between the ranks in turn. If
+                'dynamic', the root rank hands out one galaxy and number of components
+                at a time to the other ranks as they become idle. Every result is
+                stored on the root rank, which saves to save_path, while with 'static',
+                the other ranks save their own results to save_path + '.rank<rank>'.
+                Only 'static' can be used with more than one worker. Defaults to False.
+
+            queue_path (None or str)
+                If given, sample from a work queue in this directory, which can be shared
+                by any number of processes started independently with the same catalogue
+                and settings (see blendz.parallel.WorkQueue). Each process claims chunks
+                of galaxies in turn and saves their results in the queue, and chunks
+                claimed by a process that stopped are sampled again. Each process returns
+                once every chunk is done, with every result loaded. The chunks hold
+                config.queue_galaxies_per_chunk galaxies, and claims expire after
+                config.queue_lease_timeout seconds. Defaults to None.
         """
 
+        if workers is None:
+            workers = cpu_count()
+        if mpi and (queue_path is not None):
+            raise ValueError('mpi and queue_path cannot both be set.')
+        if mpi:
+            comm = getComm(mpi)
+            if mpi == 'dynamic' and workers != 1:
+                raise ValueError('mpi="dynamic" cannot be used with more than one worker.')
         if use_pymultinest is None:
-            use_pymultinest = PYMULTINEST_AVAILABLE
+            #PyMultinest writes its output to a fixed path (and runs across every
+            #MPI rank itself), so only use it in one process
+            use_pymultinest = PYMULTINEST_AVAILABLE and workers == 1 and not mpi and queue_path is None
+        elif use_pymultinest and (workers != 1 or mpi or queue_path is not None):
+            raise ValueError('use_pymultinest cannot be set when sampling with more than one worker, '
+                             + 'with mpi or with queue_path.')
 
         if isinstance(num_components, int):
             num_components = [num_components]
@@ -452,87 +649,189 @@ class Photoz(object):
         self.num_between_print = float(round(print_interval))
 
         if galaxy is None:
-            start = None
-            stop = None
-            self.num_galaxies_sampling = self.num_galaxies
+            galaxies = self.photometry.all_galaxies
         elif isinstance(galaxy, int):
-            start = galaxy
-            stop = galaxy + 1
-            self.num_galaxies_sampling = 1
+            galaxies = [self.photometry.all_galaxies[galaxy]]
+        elif isinstance(galaxy, (list, tuple, range, np.ndarray)):
+            galaxies = [self.photometry.all_galaxies[int(g)] for g in galaxy]
+        else:
+            raise TypeError('galaxy may be either None, an integer or a list of integers, '
+                            + 'but got {} instead'.format(type(galaxy)))
+        self.num_galaxies_sampling = len(galaxies)
+
+        #Interpolate the prior normalisation of every galaxy from one table
+        if self.config.prior_norm_table and self.config.prior_norm_method == 'quadrature':
+            for nb in num_components:
+                self.buildPriorNormTable(nb, galaxies)
+
+        tasks = [(gal.index, nb) for gal in galaxies for nb in num_components]
+
+        #The tasks whose results this process collects, and where it saves them
+        if mpi:
+            local_tasks = rankTasks(tasks, mpi, comm)
+            if save_path is not None:
+                save_path = rankSavePath(save_path, comm)
         else:
-            raise TypeError('galaxy may be either None or an integer, but got {} instead'.format(type(galaxy)))
+            local_tasks = tasks
+        num_local_galaxies = len(set(galaxy_index for galaxy_index, _ in local_tasks))
+
+        #One pool for every list of tasks, e.g., each chunk of a queue, only started if workers > 1
+        with tqdm(total=num_local_galaxies, unit='galaxy') as self.pbar, \
+                WorkerPool(self, min(workers, len(tasks))) as worker_pool:
+            def sampleTasks(task_list):
+                if workers == 1:
+                    return self._sampleSerial(task_list, nresample, seed, npoints, use_pymultinest)
+                return worker_pool.sample(task_list, nresample=nresample, seed=seed,
+                                          npoints=npoints, use_pymultinest=use_pymultinest)
 
-        with tqdm(total=self.num_galaxies_sampling, unit='galaxy') as self.pbar:
             self.gal_count = 1
-            for gal in self.photometry.iterate(start, stop):
-                self.blend_count = 1
-                for nb in num_components:
-
-                    if seed is False:
-                        rstate = np.random.RandomState()
-                    elif seed is True:
-                        rstate = np.random.RandomState(gal.index)
-                    else:
-                        rstate = np.random.RandomState(seed + gal.index)
-
-                    num_param = 2 * nb
-                    self.model._setMeasurementComponentMapping(nb)
-
-                    self.normalise_prior(gal.index, nb)
-
-                    if use_pymultinest:
-                        if not os.path.exists('chains'):
-                            os.makedirs('chains')
-                        with Silence() as self.breakSilence:
-                            self.num_posterior_evals = 0
-                            pymultinest.run(self._lnPosterior_multinest, self._priorTransform_multinest,
-                                            num_param, resume=False, verbose=False, sampling_efficiency='model',
-                                            n_live_points=npoints)#,
-                                            #outputfiles_basename=os.path.join(blendz.CHAIN_PATH, 'chain_'))
-                            results = pymultinest.analyse.Analyzer(num_param)#, outputfiles_basename=os.path.join(blendz.CHAIN_PATH, 'chain_'))
-
-                        self._samples[gal.index][nb] = results.get_equal_weighted_posterior()[:, :-1]
-                        self._logevd[gal.index][nb] = results.get_mode_stats()['global evidence']
-                        self._logevd_error[gal.index][nb] = results.get_mode_stats()['global evidence error']
-
-                    else:
-                        results = nestle.sample(self._lnPosterior, self._priorTransform,
-                                                num_param, method='multi', npoints=npoints,
-                                                rstate=rstate, callback=self._sampleProgressUpdate)
-                        self._samples[gal.index][nb] = results.samples[rstate.choice(len(results.weights), size=nresample, p=results.weights)]
-                        self._logevd[gal.index][nb] = results.logz
-                        self._logevd_error[gal.index][nb] = results.logzerr
-
-                    self.blend_count += 1
+            self.blend_count = 1
+            if mpi:
+                results = sampleMPI(self, tasks, mpi, comm, sampleTasks)
+            elif queue_path is not None:
+                #The queue keeps the results of each chunk, so there's no need to save as it goes
+                work_queue = WorkQueue(queue_path, tasks, self.config.queue_galaxies_per_chunk,
+                                       self.config.queue_lease_timeout)
+                results = work_queue.sample(sampleTasks)
+                save_interval = None
+            else:
+                results = sampleTasks(tasks)
+            self._collectSamples(results, len(num_components), save_path, save_interval)
+
+        if mpi:
+            gatherSamples(self, tasks, mpi, comm)
+        elif queue_path is not None:
+            for task, result in work_queue.results():
+                self._storeTaskResults(task, result)
+        #Only save ranks with results of their own
+        if (save_path is not None) and (not mpi or len(local_tasks) > 0):
+            self.saveState(save_path)
+        #The root rank has the prior normalisations of every rank
+        if (self.config.prior_norm_cache_path is not None) and MPI_RANK==0:
+            self.prior_norm_cache.save()
+
+    def mergeSamples(self, other):
+        '''
+        Add the sampling results of other, a Photoz object of the same catalogue
+        and configuration (e.g., one that sampled a different subset of galaxies),
+        to this one, replacing any results of this one for the same galaxies and
+        numbers of components.
+        '''
+        if (other.config != self.config) or (other.num_galaxies != self.num_galaxies):
+            raise ValueError('Only sampling results from the same catalogue and configuration can be merged.')
+        for galaxy_index in range(other.num_galaxies):
+            for num_components in other._samples[galaxy_index]:
+                self._storeTaskResults((galaxy_index, num_components),
+                                       other._taskResults(galaxy_index, num_components))
+
+    def _taskResults(self, galaxy_index, num_components):
+        return (self._samples[galaxy_index][num_components],
+                self._logevd[galaxy_index][num_components],
+                self._logevd_error[galaxy_index][num_components])
+
+    def _storeTaskResults(self, task, result):
+        galaxy_index, num_components = task
+        self._samples[galaxy_index][num_components], \
+            self._logevd[galaxy_index][num_components], \
+            self._logevd_error[galaxy_index][num_components] = result
+
+    def _sampleSerial(self, tasks, nresample, seed, npoints, use_pymultinest):
+        '''
+        Sample each (galaxy index, number of components) task in turn, yielding
+        the task and the result of _sampleGalaxy.
+        '''
+        for galaxy_index, num_components in tasks:
+            yield (galaxy_index, num_components), \
+                self._sampleGalaxy(galaxy_index, num_components, nresample, seed,
+                                   npoints, use_pymultinest, progress=True)
+
+    def _collectSamples(self, results, num_tasks_per_galaxy, save_path, save_interval):
+        '''
+        Store the (task, result) pairs of results as they arrive, updating the
+        progress bar and saving every save_interval galaxies as each galaxy
+        is finished.
+        '''
+        tasks_done = {}
+        for (galaxy_index, num_components), result in results:
+            self._storeTaskResults((galaxy_index, num_components), result)
 
+            tasks_done[galaxy_index] = tasks_done.get(galaxy_index, 0) + 1
+            self.blend_count = tasks_done[galaxy_index] + 1
+            if tasks_done[galaxy_index] == num_tasks_per_galaxy:
                 self.gal_count += 1
+                self.blend_count = 1
                 if MPI_RANK==0:
                     self.pbar.update()
+                #Count the galaxies finished here rather than using their index, which
+                #may never be a multiple of save_interval for a subset of the catalogue
                 if (save_path is not None) and (save_interval is not None):
-                    if gal.index % save_interval == 0:
+                    if (self.gal_count - 1) % save_interval == 0:
                         self.saveState(save_path)
-        if save_path is not None:
-            self.saveState(save_path)
+
+    def _sampleGalaxy(self, galaxy_index, num_components, nresample, seed, npoints,
+                      use_pymultinest, progress=False):
+        '''
+        Sample the posterior of a single galaxy for num_components, returning
+        the resampled (equally weighted) samples, and the log-evidence and its error.
+
+        The galaxy is only the current galaxy of the photometry while it is
+        sampled, and the random state depends only on seed and galaxy_index,
+        so tasks give the same results in any order and in any process.
+        '''
+        if seed is False:
+            rstate = np.random.RandomState()
+        elif seed is True:
+            rstate = np.random.RandomState(galaxy_index)
+        else:
+            rstate = np.random.RandomState(seed + galaxy_index)
+
+        num_param = 2 * num_components
+        self.model._setMeasurementComponentMapping(num_components)
+
+        with self.photometry.galaxy(galaxy_index):
+            self.normalise_prior(galaxy_index, num_components, seed=seed)
+
+            if use_pymultinest:
+                if not os.path.exists('chains'):
+                    os.makedirs('chains')
+                with Silence() as self.breakSilence:
+                    self.num_posterior_evals = 0
+                    pymultinest.run(self._lnPosterior_multinest, self._priorTransform_multinest,
+                                    num_param, resume=False, verbose=False, sampling_efficiency='model',
+                                    n_live_points=npoints)#,
+                                    #outputfiles_basename=os.path.join(blendz.CHAIN_PATH, 'chain_'))
+                    results = pymultinest.analyse.Analyzer(num_param)#, outputfiles_basename=os.path.join(blendz.CHAIN_PATH, 'chain_'))
+
+                return (results.get_equal_weighted_posterior()[:, :-1],
+                        results.get_mode_stats()['global evidence'],
+                        results.get_mode_stats()['global evidence error'])
+
+            else:
+                callback = self._sampleProgressUpdate if progress else None
+                results = nestle.sample(self._lnPosterior, self._priorTransform,
+                                        num_param, method='multi', npoints=npoints,
+                                        rstate=rstate, callback=callback)
+                return (results.samples[rstate.choice(len(results.weights), size=nresample, p=results.weights)],
+                        results.logz, results.logzerr)
 
     def _cacheTruthLikelihood(self):
         self.model._setMeasurementComponentMapping(1)
-        #Single interp call -> Shape = (N_template, N_band, N_component)
-        fixed_model_fluxes = {}
         fixed_lnLikelihood_flux = np.zeros((self.photometry.num_galaxies,
                                             self.responses.templates.num_templates))
+        #Every template, for a single component
+        template_combos = (np.arange(self.responses.templates.num_templates),)
         for g in self.photometry:
-            fixed_model_fluxes[g.index] = self.responses.interp(np.array([g.truth[0]['redshift']]))
-            for T in range(self.responses.templates.num_templates):
-                #For the calibration, we know sources are one component only, so
-                #we can assume that ref_band is only length 1
-                scaling = 10.**(-0.4*g.ref_mag_data) / fixed_model_fluxes[g.index][T, self.config.ref_band[0], 0]
-                fixed_model_fluxes[g.index][T, :, 0] *= scaling
-                #Cache the flux likelihoods
-                non_ref_flux = fixed_model_fluxes[g.index][T, self.config.non_ref_bands, 0]
-                fixed_lnLikelihood_flux[g.index, T] = self._lnLikelihood_flux(non_ref_flux)
+            #Single interp call -> Shape = (N_template, N_band, N_component)
+            fixed_model_fluxes = self.responses.interp(np.array([g.truth[0]['redshift']]))
+            #For the calibration, we know sources are one component only, so
+            #we can assume that ref_band is only length 1
+            scaling = 10.**(-0.4*g.ref_mag_data[0]) / fixed_model_fluxes[:, self.config.ref_band[0], :]
+            #Cache the flux likelihoods
+            flux_likelihood = FluxLikelihood(g.flux_data_noRef, g.flux_sigma_noRef)
+            flux_likelihood.setTemplates(fixed_model_fluxes[:, self.config.non_ref_bands, :])
+            fixed_lnLikelihood_flux[g.index, :] = flux_likelihood.lnLikelihood(template_combos, scaling)
         return fixed_lnLikelihood_flux
 
-
     def calibrate(self, **kwargs):
         cached_likelihood = self._cacheTruthLikelihood()
         self.model.calibrate(self.photometry, cached_likelihood, **kwargs)
@@ -1,4 +1,21 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Command
+
+
+class BuildResponses(Command):
+    description = 'calculate the response tables included in the package resources'
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        from blendz.fluxes.prebuilt import buildPrebuiltResponses
+        for table_path in buildPrebuiltResponses():
+            print(table_path)
+
 
 setup(name = 'blendz',
       version = '1.0.0',
@@ -17,5 +34,7 @@ setup(name = 'blendz',
         'future',
         'emcee',
       ],
-      include_package_data = True)#,
+      include_package_data = True,
+      entry_points = {'console_scripts': ['blendz = blendz.cli:main']},
+      cmdclass = {'build_responses': BuildResponses})#,
 #      zip_safe = False)
@@ -42,6 +42,8 @@ class TestConfiguration(object):
             assert isinstance(cfg.z_lo, float)
             assert isinstance(cfg.z_hi, float)
             assert isinstance(cfg.z_len, int)
+            assert isinstance(cfg.z_interpolation, str)
+            assert isinstance(cfg.response_engine, str)
             assert isinstance(cfg.ref_band, np.ndarray)
             assert isinstance(cfg.template_set, str)
             assert isinstance(cfg.template_set_path, str)
@@ -1,14 +1,15 @@
 from builtins import *
 from os.path import join
+import numpy as np
 import pytest
 import blendz
 
 
 class TestFilters(object):
-    def loadFilters(self):
+    def loadFilters(self, **kwargs):
         data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
         run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
-        test_config = blendz.config.Configuration(config_path=[data_path, run_path])
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path], **kwargs)
         test_filters = blendz.fluxes.Filters(config=test_config)
         return test_filters
 
@@ -82,3 +83,24 @@ class TestFilters(object):
         filters = self.loadFilters()
         for i in range(filters.num_filters):
             assert len(filters.wavelength(i)) == len(filters.response(i))
+
+    def test_reduction_boundedError(self):
+        filters = self.loadFilters()
+        tolerance = 1e-3
+        reduced = self.loadFilters(filter_tolerance=tolerance)
+        for F in range(filters.num_filters):
+            original_len, reduced_len = reduced.reduction()[F]
+            assert original_len == len(filters.wavelength(F))
+            assert reduced_len == len(reduced.wavelength(F))
+            assert reduced_len <= original_len
+            #L1 change in the curve, evaluated at the original points
+            change = np.abs(np.interp(filters.wavelength(F), reduced.wavelength(F), reduced.response(F))
+                            - filters.response(F))
+            assert np.trapz(change, x=filters.wavelength(F)) <= \
+                   tolerance * np.trapz(np.abs(filters.response(F)), x=filters.wavelength(F))
+            assert np.max(np.diff(reduced.wavelength(F))) <= \
+                   max(reduced.max_reduced_step, np.max(np.diff(filters.wavelength(F))))
+        #The (finely sampled) HST curves are reduced
+        assert sum(after for before, after in reduced.reduction()) < \
+               sum(before for before, after in reduced.reduction())
+        assert filters.reduction() == [(len(filters.wavelength(F)),) * 2 for F in range(filters.num_filters)]
@@ -0,0 +1,168 @@
+from builtins import *
+from os.path import join
+import numpy as np
+import pytest
+import blendz
+
+
+class TestResponses(object):
+    def loadConfig(self, **kwargs):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        return blendz.config.Configuration(config_path=[data_path, run_path], **kwargs)
+
+    def loadResponses(self, **kwargs):
+        return blendz.fluxes.Responses(config=self.loadConfig(**kwargs))
+
+    def test_responses_matchDirectIntegral(self):
+        responses = self.loadResponses(z_len=50)
+        templates = responses.templates
+        filters = responses.filters
+        assert np.shape(responses._all_responses) == (templates.num_templates,
+                                                      filters.num_filters, 50)
+        for F in range(filters.num_filters):
+            for iZ in [0, 17, 49]:
+                Z = responses.zGrid[iZ]
+                for T in range(templates.num_templates):
+                    shifted = templates.interp(T, filters.wavelength(F) / (1. + Z))
+                    integrand = shifted * filters.response(F) * filters.wavelength(F) / \
+                                (filters.norm(F) * 2.99792458e18)
+                    expected = np.trapz(integrand, x=filters.wavelength(F))
+                    assert np.isclose(responses._all_responses[T, F, iZ], expected,
+                                      rtol=1e-12, atol=0.)
+
+    def test_responses_chunkingUnchanged(self):
+        responses = self.loadResponses(z_len=50)
+        all_responses = responses._all_responses.copy()
+        responses.chunk_bytes = 1
+        responses._calculate_responses()
+        assert np.allclose(responses._all_responses, all_responses, rtol=1e-14, atol=0.)
+
+    def test_responses_cache(self, tmpdir):
+        cache_path = str(tmpdir.join('cache'))
+        responses = self.loadResponses(z_len=50, response_cache_path=cache_path)
+        assert len(tmpdir.join('cache').listdir()) == 1
+        #Second time, the table is memory-mapped from the cache
+        cached = self.loadResponses(z_len=50, response_cache_path=cache_path)
+        assert isinstance(cached._all_responses, np.memmap)
+        assert np.all(cached._all_responses == responses._all_responses)
+        assert np.all(cached.interp(0.5) == responses.interp(0.5))
+        #Changing the redshift grid changes the key
+        self.loadResponses(z_len=51, response_cache_path=cache_path)
+        assert len(tmpdir.join('cache').listdir()) == 2
+
+    def test_responses_cacheWriteFails(self, tmpdir, monkeypatch):
+        def failingSave(f, array):
+            f.write(b'partial')
+            raise IOError('No space left on device')
+        monkeypatch.setattr(np, 'save', failingSave)
+        cache_path = str(tmpdir.join('cache'))
+        with pytest.warns(UserWarning):
+            responses = self.loadResponses(z_len=50, response_cache_path=cache_path)
+        assert np.shape(responses._all_responses)[-1] == 50
+        #Neither a table nor its partially written temporary file are left behind
+        assert len(tmpdir.join('cache').listdir()) == 0
+
+    def test_interp_matchesInterp1d(self):
+        from scipy.interpolate import interp1d
+        responses = self.loadResponses(z_len=50)
+        reference = interp1d(responses.zGrid, responses._all_responses,
+                             bounds_error=False, fill_value=0.)
+        redshifts = np.concatenate([np.linspace(-1., 12., 101), responses.zGrid])
+        assert np.allclose(responses.interp(redshifts), reference(redshifts),
+                           rtol=1e-12, atol=0.)
+        assert np.allclose(responses.interp(1.23), reference(1.23), rtol=1e-12, atol=0.)
+        #Zero outside of the redshift grid
+        assert np.all(responses.interp(np.array([-0.1, 10.1])) == 0.)
+        #Write into a preallocated buffer
+        out = np.empty(np.shape(responses._all_responses)[:-1] + (3, 2))
+        zz = np.array([[0.1, 0.2], [3., 4.], [5., 20.]])
+        result = responses.interp(zz, out=out)
+        assert result is out
+        assert np.allclose(out, reference(zz), rtol=1e-12, atol=0.)
+
+    def test_interp_cubic(self):
+        linear = self.loadResponses(z_len=200)
+        cubic = self.loadResponses(z_len=200, z_interpolation='cubic')
+        #Both pass through the grid points and are zero outside of the grid
+        assert np.allclose(cubic.interp(cubic.zGrid), cubic._all_responses, rtol=1e-10, atol=0.)
+        assert np.all(cubic.interp(np.array([-0.1, 10.1])) == 0.)
+        #Typical error is smaller for the spline
+        assert cubic.interpolation_error(q=50) < linear.interpolation_error(q=50)
+        with pytest.raises(ValueError):
+            self.loadResponses(z_len=20, z_interpolation='quadratic')
+
+    def test_responses_parallel(self):
+        serial = self.loadResponses(z_len=50)
+        parallel = self.loadResponses(z_len=50, response_workers=2)
+        assert parallel._all_responses.flags['C_CONTIGUOUS']
+        assert np.all(parallel._all_responses == serial._all_responses)
+
+    def test_responses_compact(self):
+        full = self.loadResponses(z_len=50)
+        compact = self.loadResponses(z_len=50, compact_responses=True)
+        assert compact._all_responses.dtype == np.float32
+        assert np.allclose(compact._all_responses, full._all_responses, rtol=2**-24, atol=0.)
+        redshifts = np.linspace(0., 10., 77)
+        assert compact.interp(redshifts).dtype == np.float64
+        assert np.allclose(compact.interp(redshifts), full.interp(redshifts),
+                           rtol=1e-7, atol=1e-7 * np.max(full._all_responses))
+
+    def test_responses_compactCubic(self):
+        full = self.loadResponses(z_len=50, z_interpolation='cubic')
+        compact = self.loadResponses(z_len=50, z_interpolation='cubic', compact_responses=True)
+        redshifts = np.linspace(0., 10., 77)
+        assert compact.interp(redshifts).dtype == np.float64
+        assert np.allclose(compact.interp(redshifts), full.interp(redshifts),
+                           rtol=1e-6, atol=1e-6 * np.max(full._all_responses))
+
+    def test_pairInterpolators_lazy(self):
+        responses = self.loadResponses(z_len=50)
+        assert responses._pair_interpolators is None
+        redshifts = np.linspace(0., 10., 77)
+        all_interp = responses.interp(redshifts)
+        for T in range(responses.templates.num_templates):
+            for F in range(responses.filters.num_filters):
+                pair_interp = responses._interpolators[T][F]
+                #Views of the full table rather than copies
+                assert np.may_share_memory(pair_interp.table, responses._all_responses)
+                assert np.all(pair_interp(redshifts) == all_interp[T, F, :])
+
+    def test_responses_prebuilt(self, tmpdir):
+        from blendz.fluxes.prebuilt import _UnbuiltResponses
+        #A filter of the included folders, and a modified copy of one, which
+        #is not in the prebuilt tables
+        filter_path = tmpdir.mkdir('filters')
+        filter_path.mkdir('hst')
+        wavelength, response = np.loadtxt(join(blendz.RESOURCE_PATH, 'filters/hst/F435W'), unpack=True)
+        np.savetxt(str(filter_path.join('hst', 'F435W')), np.array([wavelength, response]).T)
+        np.savetxt(str(filter_path.join('hst', 'F435W_half')), np.array([wavelength, 0.5 * response]).T)
+        config = blendz.config.Configuration(filter_path=str(filter_path),
+                                             filters=['hst/F435W_half', 'hst/F435W'],
+                                             template_set='BPZ6')
+        responses = blendz.fluxes.Responses(config=config)
+        assert responses._load_prebuilt_responses() == [0]
+        calculated = _UnbuiltResponses(config=config)
+        assert np.all(responses._all_responses == calculated._all_responses)
+        #Nothing is prebuilt for a different redshift grid
+        config.z_len = 50
+        assert blendz.fluxes.Responses(config=config)._load_prebuilt_responses() == [0, 1]
+
+    def test_responses_fft(self):
+        direct = self.loadResponses(z_len=50)
+        fft = self.loadResponses(z_len=50, response_engine='fft')
+        scale = np.max(np.abs(direct._all_responses), axis=-1)[:, :, np.newaxis]
+        frac_diff = np.abs(fft._all_responses - direct._all_responses) / scale
+        assert np.median(frac_diff) < 1e-5
+        assert np.max(frac_diff) < 1e-2
+        with pytest.raises(ValueError):
+            self.loadResponses(z_len=50, response_engine='fourier')
+        #On the default grid, prebuilt direct tables aren't used in their place,
+        #and the engine is still checked
+        settings = {'filters': ['hst/F435W', 'sdss/z'], 'template_set': 'BPZ6'}
+        prebuilt = blendz.fluxes.Responses(config=blendz.config.Configuration(**settings))
+        assert prebuilt._load_prebuilt_responses() == []
+        fft = blendz.fluxes.Responses(config=blendz.config.Configuration(response_engine='fft', **settings))
+        assert not np.all(fft._all_responses == prebuilt._all_responses)
+        with pytest.raises(ValueError):
+            blendz.fluxes.Responses(config=blendz.config.Configuration(response_engine='fourier', **settings))
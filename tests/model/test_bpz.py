@@ -0,0 +1,109 @@
+from builtins import *
+from os.path import join
+import numpy as np
+import pytest
+import blendz
+
+
+class TestBPZ(object):
+    def loadModel(self, **kwargs):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path], **kwargs)
+        return blendz.model.BPZ(config=test_config)
+
+    def numericalRedshiftPriorNorm(self, model, template_type, mag):
+        from scipy.integrate import quad
+        prior = lambda z: np.exp(model.lnRedshiftPrior(z, template_type, mag, norm=False))
+        integral, _ = quad(prior, model.config.z_lo, model.config.z_hi, epsabs=0., epsrel=1e-10, limit=200)
+        return -np.log(integral)
+
+    def test_lnRedshiftPriorNorm_matchesNumerical(self):
+        model = self.loadModel()
+        mags = np.array([20., 24.5, 32.])
+        for template_type in model.possible_types:
+            norms = model.lnRedshiftPriorNorm(template_type, mags)
+            assert np.shape(norms) == (3,)
+            for mag, norm in zip(mags, norms):
+                expected = self.numericalRedshiftPriorNorm(model, template_type, mag)
+                assert np.isclose(norm, expected, rtol=1e-6, atol=1e-8)
+
+    def test_lnRedshiftPriorNorm_truncatedAndFlat(self):
+        model = self.loadModel(z_lo=2., z_hi=4.)
+        #Both ends in the upper tail of the prior
+        for template_type in model.possible_types:
+            norm = model.lnRedshiftPriorNorm(template_type, 20.)
+            assert np.isfinite(norm)
+            assert np.isclose(norm, self.numericalRedshiftPriorNorm(model, template_type, 20.),
+                              rtol=1e-6, atol=1e-8)
+        model.prior_params_dict['alpha_t'][model.possible_types[0]] = 0.
+        assert np.isclose(model.lnRedshiftPriorNorm(model.possible_types[0], 25.),
+                          1. - np.log(2.))
+
+    def test_lnPriorArray_matchesLnPrior(self):
+        model = self.loadModel()
+        redshifts = np.array([[0., 0.01, 0.5], [1.2, 3., 9.9]])
+        magnitudes = np.array([[20., 21.3, 24.], [26.5, 29., 31.9]])
+        priors = model.lnPriorArray(redshifts, magnitudes)
+        assert np.shape(priors) == (2, 3, len(model.possible_types))
+        for index in np.ndindex(*np.shape(redshifts)):
+            expected = model.lnPrior(redshifts[index], magnitudes[index])
+            assert np.allclose(priors[index], expected, rtol=1e-12, atol=0.)
+        #Matches the default implementation, and broadcasts
+        default = blendz.model.ModelBase.lnPriorArray(model, redshifts, 25.)
+        assert np.allclose(model.lnPriorArray(redshifts, 25.), default, rtol=1e-12, atol=0.)
+        assert np.shape(model.lnPriorArray(1., 25.)) == (len(model.possible_types),)
+
+    def test_lnPriorArray_table(self):
+        tolerance = 1e-6
+        model = self.loadModel()
+        tabulated = self.loadModel(prior_table_tolerance=tolerance)
+        redshifts = np.random.RandomState(5).uniform(0., 10., 1000)
+        magnitudes = np.random.RandomState(6).uniform(20., 32., 1000)
+        assert np.allclose(tabulated.lnPriorArray(redshifts, magnitudes),
+                           model.lnPriorArray(redshifts, magnitudes), rtol=0., atol=tolerance)
+        assert tabulated._prior_table is not None
+        #Changing the parameters or magnitude range rebuilds the table
+        params = tabulated.prior_params.copy()
+        params[-1] = 0.5
+        tabulated.prior_params = params
+        assert tabulated._prior_table is None
+        model.prior_params = params
+        assert np.allclose(tabulated.lnPriorArray(redshifts, magnitudes),
+                           model.lnPriorArray(redshifts, magnitudes), rtol=0., atol=tolerance)
+        tabulated.max_ref_mag_hi = 30.
+        assert tabulated._prior_table is None
+        #Magnitudes outside of the table are calculated exactly
+        assert np.allclose(tabulated.lnPriorArray(redshifts, magnitudes),
+                           model.lnPriorArray(redshifts, magnitudes), rtol=0., atol=tolerance)
+
+    def test_correlationFunction(self):
+        from itertools import combinations
+        from scipy.special import logsumexp
+        model = self.loadModel()
+        model.config.angular_resolution = 1e-5
+        redshifts = np.array([0.3, 1.7, 0.9, 2.4])
+        pair_xi = [model.correlationFunction(np.array(pair)) for pair in combinations(redshifts, 2)]
+        #Pairs are symmetric, and combined over components by logsumexp
+        assert model.correlationFunction(redshifts[[1, 0]]) == pair_xi[0]
+        assert np.isclose(model.correlationFunction(redshifts), logsumexp(pair_xi), rtol=1e-10, atol=0.)
+        assert np.allclose(model.pairCorrelation(np.array([0.3, 0.9]), np.array([1.7, 2.4])),
+                           [pair_xi[0], pair_xi[5]], rtol=1e-10, atol=0.)
+        assert model.correlationFunction(redshifts[:1]) == 0.
+
+    def test_correlationFunction_table(self):
+        model = self.loadModel()
+        model.config.angular_resolution = 1e-5
+        z_lo = np.random.RandomState(5).uniform(0., 9., 500)
+        z_hi = z_lo + np.random.RandomState(6).uniform(0., 3., 500)
+        exact = model.pairCorrelation(z_lo, z_hi)
+        model.config.correlation_table = True
+        table = model.pairCorrelation(z_lo, z_hi)
+        assert np.allclose(table, exact, rtol=1e-4, atol=0.)
+        assert np.isclose(model.pairCorrelation(z_lo[0], z_hi[0]), table[0], rtol=1e-12, atol=0.)
+        #Changing the settings recalculates the table
+        model.config.r0 = 2. * model.config.r0
+        model.config.correlation_table = False
+        exact = model.pairCorrelation(z_lo, z_hi)
+        model.config.correlation_table = True
+        assert np.allclose(model.pairCorrelation(z_lo, z_hi), exact, rtol=1e-4, atol=0.)
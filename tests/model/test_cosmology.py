@@ -0,0 +1,29 @@
+from builtins import *
+import numpy as np
+from scipy.integrate import quad
+from blendz.model.cosmology import Cosmology, getCosmology
+
+
+class TestCosmology(object):
+    def quadSeparation(self, cosmology, z_lo, z_hi):
+        integral, _ = quad(cosmology.invE, z_lo, z_hi, epsabs=0., epsrel=1e-13)
+        return (3.e5 / cosmology.hubble) * integral
+
+    def test_comovingSeparation_matchesQuad(self):
+        cosmology = Cosmology(0.3, 0.6, 0.1, 70., z_max=2.)
+        z_lo = np.array([0., 0.1, 0.5, 1.2345, 3.])
+        z_hi = np.array([0.05, 1.9, 0.5, 7.89, 14.])
+        expected = [self.quadSeparation(cosmology, lo, hi) for lo, hi in zip(z_lo, z_hi)]
+        #Vectorised, extending the table beyond z_max
+        assert np.allclose(cosmology.comovingSeparation(z_lo, z_hi), expected, rtol=1e-10, atol=1e-10)
+        assert cosmology.z_max >= 14.
+        #Scalars
+        for lo, hi, sep in zip(z_lo, z_hi, expected):
+            assert np.isclose(cosmology.comovingSeparation(lo, hi), sep, rtol=1e-10, atol=1e-10)
+        assert np.isclose(cosmology.comovingDistance(2.5), self.quadSeparation(cosmology, 0., 2.5),
+                          rtol=1e-10, atol=0.)
+
+    def test_getCosmology_cached(self):
+        cosmology = getCosmology(0.3, 0.7, 0., 70.)
+        assert getCosmology(0.3, 0.7, 0, 70) is cosmology
+        assert getCosmology(0.3, 0.7, 0., 67.) is not cosmology
@@ -0,0 +1,134 @@
+from builtins import *
+from os.path import join
+import pytest
+import blendz
+import blendz.parallel.mpi
+from blendz.parallel.mpi import MPI_AVAILABLE, staticTasks, rankTasks, rankSavePath, gatherSamples
+from blendz.parallel.scheduler import CostScheduler
+
+
+class RankInfo(object):
+    '''Just the rank and size of a communicator, for splitting tasks.'''
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+
+
+class GatherComm(RankInfo):
+    '''The root rank of a communicator, where the other rank sent other_rank.'''
+    def __init__(self, other_rank):
+        super(GatherComm, self).__init__(0, 2)
+        self.other_rank = other_rank
+
+    def gather(self, value, root):
+        return [value, self.other_rank]
+
+
+class FakeStatus(object):
+    def Get_source(self):
+        return 1
+
+
+class FakeMPI(object):
+    '''Just enough of mpi4py.MPI for the root rank of the dynamic mode.'''
+    ANY_SOURCE = -1
+    Status = FakeStatus
+
+
+class DispatchComm(RankInfo):
+    '''The root rank of a communicator with one worker rank, which runs each task it's sent.'''
+    def __init__(self, runtime):
+        super(DispatchComm, self).__init__(0, 2)
+        self.runtime = runtime
+        self.sent = []
+        self.message = (None, None, {})
+
+    def recv(self, source, tag, status):
+        return self.message
+
+    def send(self, task, dest, tag):
+        self.sent.append(task)
+        if tag == blendz.parallel.mpi.TASK_TAG:
+            self.message = ((task, 'result'), self.runtime(task), {})
+
+
+class TestMPI(object):
+    def test_staticTasks(self):
+        tasks = [(g, nb) for g in [3, 4, 5, 6, 7] for nb in [1, 2]]
+        split = [staticTasks(tasks, rank, 2) for rank in range(2)]
+        assert split[0] == [(3, 1), (3, 2), (5, 1), (5, 2), (7, 1), (7, 2)]
+        assert split[1] == [(4, 1), (4, 2), (6, 1), (6, 2)]
+        #Every task on exactly one rank, for any number of ranks
+        for size in [1, 3, 7]:
+            split = [staticTasks(tasks, rank, size) for rank in range(size)]
+            assert sorted(sum(split, [])) == tasks
+
+    def test_rankTasks(self):
+        tasks = [(g, 1) for g in range(4)]
+        assert rankTasks(tasks, 'dynamic', RankInfo(0, 3)) == tasks
+        assert rankTasks(tasks, 'dynamic', RankInfo(1, 3)) == []
+        assert rankTasks(tasks, 'static', RankInfo(1, 3)) == [(1, 1)]
+        #A single rank samples every task itself
+        assert rankTasks(tasks, 'dynamic', RankInfo(0, 1)) == tasks
+        assert rankSavePath('out.pkl', RankInfo(0, 3)) == 'out.pkl'
+        assert rankSavePath('out.pkl', RankInfo(2, 3)) == 'out.pkl.rank2'
+
+    def test_sample_mpiMode(self):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        pz = blendz.Photoz(config=blendz.config.Configuration(config_path=[data_path, run_path]))
+        with pytest.raises(ValueError):
+            pz.sample(1, mpi='everywhere')
+        if not MPI_AVAILABLE:
+            with pytest.raises(ImportError):
+                pz.sample(1, mpi='static')
+
+    def test_sample_singleRank(self):
+        pytest.importorskip('mpi4py')
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path])
+        test_config.angular_resolution = 1e-5
+        pz_serial = blendz.Photoz(config=test_config)
+        pz_serial.sample(1, galaxy=0, seed=5, npoints=10, nresample=20, use_pymultinest=False)
+        for mode in ['static', 'dynamic']:
+            pz_mpi = blendz.Photoz(config=test_config)
+            pz_mpi.sample(1, galaxy=0, seed=5, npoints=10, nresample=20, mpi=mode)
+            assert pz_mpi.logevd(1, galaxy=0) == pz_serial.logevd(1, galaxy=0)
+
+    def test_gatherSamples(self):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        pz = blendz.Photoz(config=blendz.config.Configuration(config_path=[data_path, run_path]))
+        pz._storeTaskResults((0, 1), ('samples 0', 0., 0.1))
+        pz.prior_norm_cache.update({('model', 1): {'galaxy 0': (-1., 0.01)}})
+        other_rank = ([((1, 1), ('samples 1', 1., 0.2))], {('model', 1): {'galaxy 1': (-2., 0.02)}})
+        gatherSamples(pz, [(0, 1), (1, 1)], 'static', GatherComm(other_rank))
+        assert pz._taskResults(1, 1) == ('samples 1', 1., 0.2)
+        #The root saves the prior normalisations of every rank
+        assert pz.prior_norm_cache._exact[('model', 1)] == {'galaxy 0': (-1., 0.01), 'galaxy 1': (-2., 0.02)}
+
+    def test_dispatchTasks_scheduled(self, monkeypatch):
+        monkeypatch.setattr(blendz.parallel.mpi, 'MPI', FakeMPI, raising=False)
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        pz = blendz.Photoz(config=blendz.config.Configuration(config_path=[data_path, run_path]))
+        tasks = [(g, nb) for g in range(pz.num_galaxies) for nb in [1, 2]]
+        runtime = lambda task: 1. + task[0] % 3
+        comm = DispatchComm(runtime)
+        results = list(blendz.parallel.mpi._dispatchTasks(pz, tasks, comm))
+        assert results == [(task, 'result') for task in comm.sent[:-1]]
+        #Tasks are handed out as the scheduler chooses, given the runtimes sent back
+        scheduler = CostScheduler.fromPhotoz(pz, tasks)
+        expected = []
+        for _ in tasks:
+            expected.append(scheduler.pop())
+            scheduler.observe(expected[-1], runtime(expected[-1]))
+        assert comm.sent == expected + [None]
@@ -0,0 +1,86 @@
+from builtins import *
+import os
+from os.path import join
+import numpy as np
+import pytest
+import blendz
+from blendz.parallel.pool import photozState, restorePhotoz, sampleParallel, WorkerPool
+
+
+class TestPool(object):
+    def loadPhotoz(self):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path])
+        test_config.angular_resolution = 1e-5
+        return blendz.Photoz(config=test_config)
+
+    def test_restorePhotoz(self):
+        pz = self.loadPhotoz()
+        pz_restored = restorePhotoz(blendz.Photoz, photozState(pz))
+        assert pz_restored.config == pz.config
+        assert pz_restored.num_galaxies == pz.num_galaxies
+
+    def test_sample_workers(self):
+        pz_serial = self.loadPhotoz()
+        pz_serial.sample(1, seed=5, npoints=10, nresample=20, use_pymultinest=False)
+        pz_parallel = self.loadPhotoz()
+        pz_parallel.sample(1, seed=5, npoints=10, nresample=20, workers=2)
+        #Seeding depends only on the galaxy, so results match the serial run
+        for g in range(pz_serial.num_galaxies):
+            assert np.all(pz_serial.chain(1, galaxy=g) == pz_parallel.chain(1, galaxy=g))
+            assert pz_serial.logevd(1, galaxy=g) == pz_parallel.logevd(1, galaxy=g)
+
+    def test_sample_workers_priorNormCache(self, tmpdir):
+        #The normalisations calculated by the workers are saved by the main process
+        exact = []
+        for workers in [1, 2]:
+            cache_path = str(tmpdir.join('prior_norms_{}.pkl'.format(workers)))
+            pz = self.loadPhotoz()
+            pz.config.prior_norm_cache_path = cache_path
+            pz.sample(1, galaxy=[0, 1, 2], seed=5, npoints=10, nresample=20, workers=workers,
+                      use_pymultinest=False)
+            exact.append(blendz.normalisation.PriorNormCache(cache_path)._exact)
+        assert sum(len(norms) for norms in exact[0].values()) == 3
+        assert exact[1] == exact[0]
+
+    def test_WorkerPool_reuse(self):
+        pz = self.loadPhotoz()
+        kwargs = dict(seed=5, npoints=10, nresample=20, use_pymultinest=False)
+        with WorkerPool(pz, 2) as pool:
+            assert pool.pool is None
+            assert sorted(task for task, _ in pool.sample([(0, 1), (1, 1)], **kwargs)) == [(0, 1), (1, 1)]
+            worker_pids = pool.worker_pids
+            assert sorted(task for task, _ in pool.sample([(2, 1)], **kwargs)) == [(2, 1)]
+            assert pool.worker_pids == worker_pids
+            #Stopping early leaves a task running, so the workers are stopped
+            results = pool.sample([(0, 1), (1, 1), (2, 1)], **kwargs)
+            next(results)
+            results.close()
+            assert pool.pool is None
+            assert len(list(pool.sample([(3, 1)], **kwargs))) == 1
+            assert pool.worker_pids != worker_pids
+        assert pool.pool is None
+
+
+class FailingPhotoz(blendz.Photoz):
+    '''Photoz whose workers fail in the ways that never call back with a result.'''
+    def _sampleGalaxy(self, galaxy_index, num_components, **kwargs):
+        if self.failure == 'unpicklable':
+            return lambda: None
+        os._exit(1)
+
+
+class TestPoolFailures(object):
+    def loadPhotoz(self, failure):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        pz = FailingPhotoz(config=blendz.config.Configuration(config_path=[data_path, run_path]))
+        pz.failure = failure
+        return pz
+
+    @pytest.mark.parametrize('failure', ['unpicklable', 'worker_died'])
+    def test_sampleParallel_failure(self, failure):
+        pz = self.loadPhotoz(failure)
+        with pytest.raises(RuntimeError):
+            list(sampleParallel(pz, [(0, 1), (1, 1)], 2))
@@ -0,0 +1,56 @@
+from builtins import *
+import time
+from os.path import join
+import numpy as np
+import blendz
+from blendz.parallel import CostScheduler
+
+
+class TestCostScheduler(object):
+    def loadScheduler(self):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        pz = blendz.Photoz(config=blendz.config.Configuration(config_path=[data_path, run_path]))
+        tasks = [(g, nb) for g in range(pz.num_galaxies) for nb in [1, 2]]
+        return CostScheduler.fromPhotoz(pz, tasks), tasks
+
+    def test_pop_longestFirst(self):
+        scheduler, tasks = self.loadScheduler()
+        assert scheduler.features.shape == (len(tasks), 4)
+        assert np.all(np.isfinite(scheduler.features))
+        order = [scheduler.pop() for task in tasks]
+        assert scheduler.pop() is None
+        assert sorted(order) == sorted(tasks)
+        #Blends sum over many more template combinations, so come first
+        assert [nb for g, nb in order] == [2] * (len(tasks) // 2) + [1] * (len(tasks) // 2)
+
+    def test_observe(self):
+        scheduler, tasks = self.loadScheduler()
+        #Runtimes that depend only on the signal-to-noise
+        true_weights = np.array([-2., 0., 0., 1.5])
+        for i in range(200):
+            task = tasks[i % len(tasks)]
+            scheduler.observe(task, np.exp(np.dot(true_weights, scheduler.features[tasks.index(task)])))
+        for row, task in enumerate(tasks):
+            assert np.isclose(scheduler.predict(task), np.dot(true_weights, scheduler.features[row]), atol=0.05)
+
+    def test_largeCatalogue(self):
+        #Scheduling every task of 10^5 galaxies with two numbers of components
+        #should take a small fraction of the time of sampling them
+        rstate = np.random.RandomState(0)
+        num_tasks = 2 * 10**5
+        tasks = [(g, nb) for g in range(num_tasks // 2) for nb in [1, 2]]
+        features = np.column_stack([np.ones(num_tasks), rstate.uniform(1., 5., num_tasks),
+                                    rstate.uniform(0., 2., num_tasks), rstate.uniform(0., 6., num_tasks)])
+        true_weights = np.array([-1., 1., 0.5, 0.2])
+        scheduler = CostScheduler(tasks, features)
+        start_time = time.time()
+        order = []
+        for i in range(num_tasks):
+            task = scheduler.pop()
+            order.append(task)
+            scheduler.observe(task, np.exp(np.dot(true_weights, features[2 * task[0] + task[1] - 1])))
+        assert time.time() - start_time < 30.
+        assert scheduler.pop() is None
+        assert len(set(order)) == num_tasks
+        assert np.allclose(scheduler.weights, true_weights, atol=1e-4)
@@ -0,0 +1,94 @@
+from builtins import *
+import os
+from os.path import join
+import numpy as np
+import pytest
+import blendz
+from blendz.parallel import WorkQueue
+
+
+class TestWorkQueue(object):
+    def loadPhotoz(self):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path])
+        test_config.angular_resolution = 1e-5
+        return blendz.Photoz(config=test_config)
+
+    def loadQueue(self, queue_path, tasks, worker_id):
+        work_queue = WorkQueue(queue_path, tasks)
+        work_queue.worker_id = worker_id
+        #Start from the first chunk rather than a random one
+        work_queue._cursor = 0
+        return work_queue
+
+    def test_chunkTasks(self):
+        tasks = [(g, nb) for g in range(5) for nb in [1, 2]]
+        chunks = WorkQueue.chunkTasks(tasks, 2)
+        assert chunks == [tasks[:4], tasks[4:8], tasks[8:]]
+
+    def test_claims(self, tmpdir):
+        queue_path = str(tmpdir.join('queue'))
+        tasks = [(g, 1) for g in range(25)]
+        queue_a = self.loadQueue(queue_path, tasks, 'a')
+        queue_b = self.loadQueue(queue_path, tasks, 'b')
+        assert len(queue_a.chunks) == 3
+        assert queue_a.claim() == 0
+        assert queue_b.claim() == 1
+        assert queue_a.renew(0) and not queue_b.renew(0)
+
+        #An expired claim is taken over, after the free chunks following the
+        #last one claimed, and its old holder gives it up
+        old_time = os.path.getmtime(queue_a._claimPath(0)) - 2. * queue_a.lease_timeout
+        os.utime(queue_a._claimPath(0), (old_time, old_time))
+        assert queue_b.claim() == 2
+        assert queue_b.claim() == 0
+        assert not queue_a.renew(0)
+
+        queue_b.complete(0, [((0, 1), 'result')])
+        assert queue_a.isDone(0) and not queue_a.allDone()
+        assert list(queue_a.results()) == [((0, 1), 'result')]
+        assert queue_a.claim() is None
+        queue_b.complete(1, [])
+        queue_b.complete(2, [])
+        assert queue_a.allDone()
+
+        #Every worker needs the same tasks
+        with pytest.raises(ValueError):
+            WorkQueue(queue_path, tasks[:-1])
+
+    def test_claims_checkDoneOnce(self, tmpdir, monkeypatch):
+        queue_path = str(tmpdir.join('queue'))
+        tasks = [(g, 1) for g in range(50)]
+        queue_a = WorkQueue(queue_path, tasks, galaxies_per_chunk=5, lease_timeout=60.)
+        assert len(queue_a.chunks) == 10 and queue_a.lease_timeout == 60.
+        assert WorkQueue.galaxies_per_chunk == 10 and WorkQueue.lease_timeout == 3600.
+        #Each chunk a worker has seen done isn't checked again
+        for chunk in range(10):
+            queue_a.complete(queue_a.claim(), [])
+        queue_b = WorkQueue(queue_path, tasks, galaxies_per_chunk=5)
+        assert queue_b.allDone()
+        checked = []
+        exists = os.path.exists
+        monkeypatch.setattr(os.path, 'exists', lambda path: checked.append(path) or exists(path))
+        assert queue_a.allDone() and queue_b.allDone()
+        assert queue_a.claim() is None and queue_b.claim() is None
+        assert checked == []
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_sample_queue(self, tmpdir, workers):
+        queue_path = str(tmpdir.join('queue'))
+        pz_serial = self.loadPhotoz()
+        pz_serial.sample(1, seed=5, npoints=10, nresample=20, use_pymultinest=False)
+        #Several chunks, which share one pool of workers
+        pz_queue = self.loadPhotoz()
+        pz_queue.config.queue_galaxies_per_chunk = 2
+        pz_queue.sample(1, seed=5, npoints=10, nresample=20, queue_path=queue_path, workers=workers)
+        assert len(os.listdir(queue_path)) == 1 + (pz_serial.num_galaxies + 1) // 2
+        #A worker joining a finished queue only loads the results
+        pz_late = self.loadPhotoz()
+        pz_late.config.queue_galaxies_per_chunk = 2
+        pz_late.sample(1, seed=5, npoints=10, nresample=20, queue_path=queue_path)
+        for g in range(pz_serial.num_galaxies):
+            assert np.all(pz_serial.chain(1, galaxy=g) == pz_queue.chain(1, galaxy=g))
+            assert np.all(pz_serial.chain(1, galaxy=g) == pz_late.chain(1, galaxy=g))
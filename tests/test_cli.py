@@ -0,0 +1,54 @@
+from builtins import *
+import argparse
+from os.path import join
+import numpy as np
+import pytest
+import blendz
+from blendz.cli import main, parseShard, shardGalaxies
+
+
+class TestCLI(object):
+    def test_parseShard(self):
+        assert parseShard('3/10') == (3, 10)
+        for shard in ['3', '10/10', '-1/4', 'a/b']:
+            with pytest.raises(argparse.ArgumentTypeError):
+                parseShard(shard)
+
+    def test_shardGalaxies(self):
+        shards = [shardGalaxies(10, index, 3) for index in range(3)]
+        assert shards[1] == [1, 4, 7]
+        assert sorted(sum(shards, [])) == list(range(10))
+
+    def test_runMerge(self, tmpdir):
+        config_paths = [join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt'),
+                        join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')]
+        shard_paths = [str(tmpdir.join('shard_{}.pkl'.format(i))) for i in range(2)]
+        merged_path = str(tmpdir.join('merged.pkl'))
+        for i, shard_path in enumerate(shard_paths):
+            main(['run'] + config_paths + ['--components', '1', '--npoints', '10', '--nresample', '20',
+                  '--seed', '5', '--shard', '{}/2'.format(i), '--output', shard_path])
+        main(['merge', merged_path] + shard_paths)
+
+        pz_merged = blendz.Photoz(load_state_path=merged_path)
+        pz = blendz.Photoz(config=pz_merged.config)
+        pz.sample(1, npoints=10, nresample=20, seed=5, use_pymultinest=False)
+        for g in range(pz.num_galaxies):
+            assert np.all(pz.chain(1, galaxy=g) == pz_merged.chain(1, galaxy=g))
+
+    def test_multinestOptions(self):
+        config_paths = [join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')]
+        for option in [['--seed', '5'], ['--workers', '2']]:
+            with pytest.raises(SystemExit):
+                main(['run'] + config_paths + ['--sampler', 'multinest', '--output', 'x.pkl'] + option)
+
+    def test_saveInterval(self, tmpdir, monkeypatch):
+        config_paths = [join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt'),
+                        join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')]
+        saved = []
+        monkeypatch.setattr(blendz.Photoz, 'saveState', lambda self, path: saved.append(self.gal_count))
+        #Shard 1/2 only has odd indices, so none of its galaxies has an even index
+        main(['run'] + config_paths + ['--components', '1', '--npoints', '10', '--nresample', '20',
+              '--shard', '1/2', '--save-interval', '2', '--output', str(tmpdir.join('shard.pkl'))])
+        num_galaxies = blendz.Photoz(config=blendz.Configuration(config_path=config_paths)).num_galaxies
+        #One save every 2 galaxies of the shard, plus the final save
+        assert len(saved) == (num_galaxies // 2) // 2 + 1 > 1
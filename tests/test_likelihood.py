@@ -0,0 +1,27 @@
+from builtins import *
+import itertools as itr
+import numpy as np
+from blendz.likelihood import FluxLikelihood
+
+
+class TestFluxLikelihood(object):
+    def test_lnLikelihood_matchesDirect(self):
+        rstate = np.random.RandomState(42)
+        num_templates, num_bands, num_components = 4, 7, 3
+        flux_data = rstate.uniform(1., 2., num_bands)
+        flux_sigma = rstate.uniform(0.05, 0.2, num_bands)
+        template_fluxes = rstate.uniform(0.5, 1.5, (num_templates, num_bands, num_components))
+        scalings = rstate.uniform(0.2, 0.6, (num_templates, num_components))
+
+        flux_likelihood = FluxLikelihood(flux_data, flux_sigma)
+        flux_likelihood.setTemplates(template_fluxes)
+        combos = list(itr.product(range(num_templates), repeat=num_components))
+        template_combos = tuple(np.array(combos).T)
+        lnLike = flux_likelihood.lnLikelihood(template_combos, scalings)
+
+        for i, combo in enumerate(combos):
+            model_flux = np.zeros(num_bands)
+            for c, T in enumerate(combo):
+                model_flux += template_fluxes[T, :, c] * scalings[T, c]
+            expected = -1. * np.sum((flux_data - model_flux)**2 / flux_sigma**2)
+            assert np.isclose(lnLike[i], expected, rtol=1e-10)
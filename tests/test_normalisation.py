@@ -0,0 +1,189 @@
+from builtins import *
+from os.path import join
+import numpy as np
+import pytest
+from scipy.special import logsumexp
+from scipy.integrate import quad, dblquad
+import blendz
+from blendz.normalisation import gaussLegendreRule
+
+
+class TestPriorQuadrature(object):
+    def loadPhotoz(self, **kwargs):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path], **kwargs)
+        test_config.angular_resolution = 1e-2
+        return blendz.Photoz(config=test_config)
+
+    def trapezoidLnNorm(self, pz, galaxy, num_components, num_z=1001, num_mag=401):
+        '''Log-normalisation of the prior on a fine trapezoid grid (for one or
+        two components), for comparison with the quadrature.'''
+        model = pz.model
+        redshifts = np.linspace(pz.config.z_lo, pz.config.z_hi, num_z)
+        magnitudes = np.linspace(pz.config.ref_mag_lo, galaxy.ref_mag_hi, num_mag)
+        lnP = logsumexp(model.lnPriorArray(redshifts[:, np.newaxis], magnitudes[np.newaxis, :])
+                        [..., pz.tmp_ind_to_type_ind], axis=-1)
+        shift = np.max(lnP)
+        z_weights = np.full(num_z, redshifts[1] - redshifts[0])
+        z_weights[[0, -1]] *= 0.5
+        mag_weights = np.full(num_mag, magnitudes[1] - magnitudes[0])
+        mag_weights[[0, -1]] *= 0.5
+        weighted_prior = np.exp(lnP - shift) * mag_weights
+        flux = 10.**(-0.4 * magnitudes)
+        volume = (pz.config.z_hi - pz.config.z_lo) * (galaxy.ref_mag_hi - pz.config.ref_mag_lo)
+        if num_components == 1:
+            selection = np.exp(model.lnSelection(flux[:, np.newaxis], galaxy))
+            integral = np.sum(z_weights * np.dot(weighted_prior, selection))
+            return np.log(integral) + shift - np.log(volume)
+        else:
+            selection = np.exp(model.lnSelection((flux[:, np.newaxis] + flux[np.newaxis, :])[..., np.newaxis], galaxy))
+            contracted = np.dot(np.dot(weighted_prior, selection), weighted_prior.T)
+            z_lo = np.minimum.outer(redshifts, redshifts)
+            z_hi = np.maximum.outer(redshifts, redshifts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xi = model.pairCorrelation(z_lo, z_hi)
+            xi[~np.isfinite(xi)] = 0.
+            integral = np.sum(np.outer(z_weights, z_weights) * (1. + xi) * contracted)
+            return np.log(integral / 2.) + 2. * shift - 2. * np.log(volume)
+
+    def test_gaussLegendreRule(self):
+        nodes, weights = gaussLegendreRule(np.array([0., 0.5, 2.]), 4)
+        assert len(nodes) == 8
+        #Exact for polynomials up to degree 7 on each panel
+        assert np.isclose(np.sum(weights * nodes**7), 2.**8 / 8., rtol=1e-12)
+
+    def test_lnNorm_matchesTrapezoid(self):
+        pz = self.loadPhotoz()
+        with pz.photometry.galaxy(0) as galaxy:
+            for num_components in [1, 2]:
+                pz.model._setMeasurementComponentMapping(num_components)
+                prior_norm, error = pz.prior_quadrature(galaxy, num_components, 1e-4, 2**22)
+                assert error < 1e-4
+                expected = self.trapezoidLnNorm(pz, galaxy, num_components)
+                assert np.isclose(prior_norm, expected, rtol=0., atol=1e-3)
+
+    def test_normalise_prior(self):
+        pz = self.loadPhotoz()
+        with pz.photometry.galaxy(0) as galaxy:
+            pz.normalise_prior(galaxy.index, 2)
+            assert pz.prior_norm_error <= pz.config.prior_norm_tolerance
+            quadrature_norm = pz.prior_norm
+            #Unsorted components cover the full box, twice the sorted region
+            pz.model._setMeasurementComponentMapping(2)
+            pz.model.redshifts_exchangeable = False
+            unsorted_norm, _ = pz.prior_quadrature(galaxy, 2, 1e-4, 2**22)
+            assert np.isclose(unsorted_norm, quadrature_norm + np.log(2.), rtol=0., atol=1e-6)
+            #The correlation function of more than two components is not a sum over pairs
+            pz.model._setMeasurementComponentMapping(3)
+            assert not pz.prior_quadrature.canIntegrate(3)
+            pz.config.prior_norm_method = 'nested'
+            pz.normalise_prior(galaxy.index, 1, npoints=20)
+            assert np.isfinite(pz.prior_norm)
+            pz.config.prior_norm_method = 'trapezoid'
+            with pytest.raises(ValueError):
+                pz.normalise_prior(galaxy.index, 1)
+
+    def test_canIntegrate_manyComponents(self):
+        pz = self.loadPhotoz()
+        #Checking for a correlation function mustn't evaluate it on the grid of nodes
+        pz.model._setMeasurementComponentMapping(4)
+        assert not pz.prior_quadrature.canIntegrate(4)
+        assert len(pz.prior_quadrature._correlation_cache) == 0
+        #Models declare whether they have one, rather than it being guessed from a few values
+        pz.model.has_correlation = False
+        assert pz.prior_quadrature.canIntegrate(4)
+        assert blendz.model.ModelBase.has_correlation and not blendz.model.LikelihoodOnly.has_correlation
+        #Without one, the rule for four components is over the point budget
+        flat_pz = blendz.Photoz(model=blendz.model.LikelihoodOnly(config=pz.config))
+        flat_pz.model._setMeasurementComponentMapping(4)
+        assert flat_pz.prior_quadrature.canIntegrate(4)
+        with flat_pz.photometry.galaxy(0) as galaxy:
+            prior_norm, error = flat_pz.prior_quadrature(galaxy, 4, 1e-2, 2**10)
+            assert np.isinf(error)
+
+
+class TestPriorNormCache(object):
+    def loadPhotoz(self, **kwargs):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path], **kwargs)
+        test_config.angular_resolution = 1e-5
+        return blendz.Photoz(config=test_config)
+
+    def test_table_matchesQuadrature(self):
+        pz = self.loadPhotoz()
+        assert pz.buildPriorNormTable(2)
+        fingerprint = pz.prior_quadrature.fingerprint(2, pz.config.prior_norm_tolerance)
+        for galaxy in pz.photometry:
+            pz.normalise_prior(galaxy.index, 2)
+            assert pz.prior_norm_error <= pz.config.prior_norm_tolerance
+            assert (pz.prior_norm, pz.prior_norm_error) == pz.prior_norm_cache.get(fingerprint, 2, galaxy)
+            expected, _ = pz.prior_quadrature(galaxy, 2, 1e-6, 2**22)
+            assert np.isclose(pz.prior_norm, expected, rtol=0., atol=pz.prior_norm_error)
+        #A different model setting has a different fingerprint
+        pz.config.r0 = 2. * pz.config.r0
+        assert pz.prior_quadrature.fingerprint(2, pz.config.prior_norm_tolerance) != fingerprint
+
+    def test_cache_save(self, tmpdir):
+        cache_path = str(tmpdir.join('prior_norms.pkl'))
+        pz = self.loadPhotoz(prior_norm_cache_path=cache_path)
+        pz.buildPriorNormTable(1)
+        with pz.photometry.galaxy(0) as galaxy:
+            pz.normalise_prior(galaxy.index, 1)
+            pz.prior_norm_cache.save()
+            fingerprint = pz.prior_quadrature.fingerprint(1, pz.config.prior_norm_tolerance)
+            loaded = blendz.normalisation.PriorNormCache(cache_path)
+            assert loaded.get(fingerprint, 1, galaxy) == (pz.prior_norm, pz.prior_norm_error)
+            #Galaxies with no exact match are interpolated from the saved table
+            galaxy.select_flux_sigma = 1.01 * galaxy.select_flux_sigma
+            assert loaded.get(fingerprint, 1, galaxy) is not None
+            assert loaded.get(fingerprint, 2, galaxy) is None
+
+    def test_cache_saveFails(self, tmpdir, monkeypatch):
+        def failingDump(obj, f):
+            f.write(b'partial')
+            raise IOError('No space left on device')
+        monkeypatch.setattr(blendz.normalisation.dill, 'dump', failingDump)
+        cache = blendz.normalisation.PriorNormCache(str(tmpdir.join('prior_norms.pkl')))
+        with pytest.raises(IOError):
+            cache.save()
+        #Neither the cache nor its partially written temporary file are left behind
+        assert len(tmpdir.listdir()) == 0
+
+
+class TestFlatPrior(object):
+    def loadPhotoz(self):
+        data_path = join(blendz.RESOURCE_PATH, 'config/testDataConfig.txt')
+        run_path = join(blendz.RESOURCE_PATH, 'config/testRunConfig.txt')
+        test_config = blendz.config.Configuration(config_path=[data_path, run_path],
+                                                  prior_norm_method='nested')
+        test_config.angular_resolution = 1e-5
+        return blendz.Photoz(model=blendz.model.LikelihoodOnly(config=test_config))
+
+    def test_normalise_prior_analytic(self):
+        pz = self.loadPhotoz()
+        with pz.photometry.galaxy(0) as galaxy:
+            mag_lo, mag_hi = pz.config.ref_mag_lo, galaxy.ref_mag_hi
+            def selection(*magnitudes):
+                flux = np.sum(10.**(-0.4 * np.array(magnitudes)))
+                return np.exp(pz.model.lnSelection(np.array([flux]), galaxy))
+            for num_components in [1, 2]:
+                pz.normalise_prior(galaxy.index, num_components)
+                if num_components == 1:
+                    integral = quad(selection, mag_lo, mag_hi, points=[galaxy.magnitude_limit])[0]
+                else:
+                    #Sorted components cover half of the box
+                    integral = dblquad(selection, mag_lo, mag_hi, mag_lo, mag_hi, epsabs=1e-12)[0] / 2.
+                expected = np.log(integral) + num_components * np.log(pz.num_templates / (mag_hi - mag_lo))
+                assert np.isclose(pz.prior_norm, expected, rtol=0., atol=1e-6)
+
+    def test_lnPosterior_flatPath(self):
+        pz = self.loadPhotoz()
+        with pz.photometry.galaxy(0) as galaxy:
+            pz.model._setMeasurementComponentMapping(2)
+            pz.prior_norm = 0.
+            params = np.array([0.5, 1.5, 20., 21.])
+            flat = pz._lnPosterior(params)
+            pz.model.flat_prior = False
+            assert np.isclose(flat, pz._lnPosterior(params), rtol=1e-12)
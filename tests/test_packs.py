@@ -0,0 +1,84 @@
+from builtins import *
+import os
+import shutil
+from os.path import join, exists
+import numpy as np
+import pytest
+import blendz
+from blendz import packs
+
+
+class TestPacks(object):
+    def copyResources(self, tmpdir):
+        template_path = str(tmpdir.join('templates'))
+        filter_path = str(tmpdir.join('filters'))
+        shutil.copytree(join(blendz.RESOURCE_PATH, 'templates'), template_path)
+        shutil.copytree(join(blendz.RESOURCE_PATH, 'filters'), filter_path)
+        return {'template_set_path': template_path, 'filter_path': filter_path,
+                'filters': ['hst/F435W', 'hst/F606W', 'lsst/g', 'sdss/z']}
+
+    def test_packs_matchTextFiles(self, tmpdir):
+        paths = self.copyResources(tmpdir)
+        text_templates = blendz.fluxes.Templates(**paths)
+        text_filters = blendz.fluxes.Filters(**paths)
+        pack_paths = packs.packTemplateSets(paths['template_set_path']) + \
+                     packs.packFilters(paths['filter_path'])
+        assert join(paths['template_set_path'], 'BPZ8.npz') in pack_paths
+        assert join(paths['template_set_path'], 'single', 'El_B2004a.npz') in pack_paths
+        assert join(paths['filter_path'], 'hst', 'filters.npz') in pack_paths
+        #Templates and filters are now read from the packs
+        pack_templates = blendz.fluxes.Templates(**paths)
+        pack_filters = blendz.fluxes.Filters(**paths)
+        assert pack_templates.template_dict == text_templates.template_dict
+        for T in range(text_templates.num_templates):
+            assert np.all(pack_templates.wavelength(T) == text_templates.wavelength(T))
+            assert np.all(pack_templates.flux(T) == text_templates.flux(T))
+        for F in range(text_filters.num_filters):
+            assert np.all(pack_filters.wavelength(F) == text_filters.wavelength(F))
+            assert np.all(pack_filters.response(F) == text_filters.response(F))
+            assert pack_filters.norm(F) == text_filters.norm(F)
+
+    def test_packs_usedWhenPresent(self, tmpdir):
+        paths = self.copyResources(tmpdir)
+        packs.packTemplateSets(paths['template_set_path'])
+        packs.packFilters(paths['filter_path'])
+        #Removing the text files makes no difference once packed
+        shutil.rmtree(join(paths['template_set_path'], 'bpz'))
+        shutil.rmtree(join(paths['filter_path'], 'hst'))
+        with pytest.raises(IOError):
+            blendz.fluxes.Filters(**paths)
+        paths['filters'] = ['lsst/g', 'sdss/z']
+        blendz.fluxes.Filters(**paths)
+        templates = blendz.fluxes.Templates(template_set='single/Sbc_B2004a', **paths)
+        assert templates.num_templates == 1
+        assert templates.name(0) == 'Sbc_B2004a'
+
+    def test_packs_staleAfterEdit(self, tmpdir):
+        paths = self.copyResources(tmpdir)
+        packs.packTemplateSets(paths['template_set_path'])
+        packs.packFilters(paths['filter_path'])
+        filter_pack = join(paths['filter_path'], 'sdss', 'filters.npz')
+        template_pack = join(paths['template_set_path'], 'BPZ8.npz')
+        #Only the modification time changing, e.g., after copying, leaves them current
+        for path in [join(paths['filter_path'], 'sdss', 'z'), join(paths['template_set_path'], 'bpz', 'El_B2004a')]:
+            os.utime(path, (1e9, 1e9))
+        assert packs.isCurrent(filter_pack, join(paths['filter_path'], 'sdss'))
+        assert packs.isCurrent(template_pack, paths['template_set_path'])
+        #Editing the text files (keeping their size) means they're read instead, with a warning
+        edits = [(join(paths['filter_path'], 'sdss', 'z'), '1.413590e-04', '2.413590e-04'),
+                 (join(paths['template_set_path'], 'bpz', 'El_B2004a'), '500.0  0.0', '500.0  1.0')]
+        for path, old, new in edits:
+            with open(path) as f:
+                text = f.read()
+            with open(path, 'w') as f:
+                f.write(text.replace(old, new, 1))
+        assert not packs.isCurrent(filter_pack, join(paths['filter_path'], 'sdss'))
+        assert not packs.isCurrent(template_pack, paths['template_set_path'])
+        with pytest.warns(UserWarning):
+            filters = blendz.fluxes.Filters(**paths)
+        with pytest.warns(UserWarning):
+            templates = blendz.fluxes.Templates(**paths)
+        z_lambda, z_response = np.loadtxt(join(paths['filter_path'], 'sdss', 'z'), unpack=True)
+        assert np.all(filters.response(3) == z_response[np.argsort(z_lambda)])
+        el_lambda, el_flux = np.loadtxt(join(paths['template_set_path'], 'bpz', 'El_B2004a'), unpack=True)
+        assert np.all(templates.flux(0) == el_flux[np.argsort(el_lambda)])
@@ -1,6 +1,7 @@
 from builtins import *
 from os.path import join
 import numpy as np
+import pytest
 import blendz
 
 
@@ -81,3 +82,51 @@ class TestPhotoz(object):
         pz.saveState('testPZ_one_component_samples_nestle.pkl')
         pz_load3 = blendz.Photoz(load_state_path='testPZ_one_component_samples_nestle.pkl')
         self.checkPhotoz(pz, pz_load3, done_sample=True)
+
+    def test_lnPosterior_templateSum(self):
+        test_config = self.loadConfig()
+        test_config.angular_resolution = 1e-5
+        pz = blendz.Photoz(config=test_config)
+        pz.prior_norm = 0.
+        params = np.array([0.4, 1.2, 25., 26.])
+        pz.model._setMeasurementComponentMapping(2)
+        with pz.photometry.galaxy(0) as gal:
+            #Explicit sum over every template combination
+            model_fluxes = pz.responses.interp(params[:2])
+            priors = [pz.model.lnPrior(params[c], params[2+c]) for c in range(2)]
+            lnConstant = np.log(1. + pz.model.correlationFunction(params[:2]))
+            total_ref_flux = np.sum(10.**(-0.4 * params[2:]))
+            lnConstant += pz._lnLikelihood_mag(total_ref_flux)
+            lnConstant += pz.model.lnSelection(total_ref_flux, gal)
+            terms = []
+            for T1 in range(pz.num_templates):
+                for T2 in range(pz.num_templates):
+                    blend_flux = np.zeros(pz.num_measurements)
+                    tmp = lnConstant
+                    for c, T in enumerate([T1, T2]):
+                        ref_flux = model_fluxes[T, pz.config.ref_band[0], c]
+                        blend_flux += model_fluxes[T, :, c] * 10.**(-0.4 * params[2+c]) / ref_flux
+                        tmp += priors[c][pz.tmp_ind_to_type_ind[T]]
+                    tmp += pz._lnLikelihood_flux(blend_flux[pz.config.non_ref_bands])
+                    terms.append(tmp)
+            expected = np.logaddexp.reduce(terms)
+
+            assert np.isclose(pz._lnPosterior(params), expected, rtol=1e-10)
+            #Chunking the template combinations shouldn't change the result
+            pz.combination_chunk_bytes = 1
+            assert np.isclose(pz._lnPosterior(params), expected, rtol=1e-10)
+
+    def test_saveState_fails(self, tmpdir, monkeypatch):
+        pz = blendz.Photoz(config=self.loadConfig())
+        save_path = str(tmpdir.join('photoz.pkl'))
+        pz.saveState(save_path)
+        def failingDump(self, f):
+            f.write(b'partial')
+            raise IOError('No space left on device')
+        monkeypatch.setattr(blendz.Photoz, '_dumpState', failingDump)
+        with pytest.raises(IOError):
+            pz.saveState(save_path)
+        #The earlier save is kept, and the partial one is removed
+        assert tmpdir.listdir() == [tmpdir.join('photoz.pkl')]
+        monkeypatch.undo()
+        blendz.Photoz(load_state_path=save_path)